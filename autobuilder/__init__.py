@@ -1,4 +1,4 @@
 from autobuilder.abconfig import AutobuilderConfig, Buildtype, Distro, Repo, TargetImageSet
-from autobuilder.abconfig import AutobuilderWorker, EC2Params, AutobuilderEC2Worker
+from autobuilder.abconfig import AutobuilderWorker, EC2Params, AutobuilderEC2Worker, HashEquivServer
 from autobuilder.abconfig import AutobuilderGithubEventHandler
 from autobuilder.ec2 import MyEC2LatentWorker
@@ -14,7 +14,9 @@ from buildbot.www.hooks.github import GitHubEventHandler
 from buildbot.config import BuilderConfig
 from autobuilder import factory, settings
 from autobuilder.ec2 import MyEC2LatentWorker
+from autobuilder.hashserv import HashEquivService
 from autobuilder import utils
+from autobuilder.utils import archive, impact
 
 DEFAULT_BLDTYPES = ['ci', 'no-sstate', 'snapshot', 'release', 'pr']
 RNG = SystemRandom()
@@ -26,7 +28,8 @@ class Buildtype(object):
     def __init__(self, name, build_sdk=False, install_sdk=False,
                  sdk_root=None, current_symlink=False, defaulttype=False,
                  pullrequesttype=False, production_release=False,
-                 disable_sstate=False, extra_config=None):
+                 disable_sstate=False, extra_config=None,
+                 incremental=None):
         self.name = name
         self.build_sdk = build_sdk
         self.install_sdk = install_sdk
@@ -37,25 +40,46 @@ class Buildtype(object):
         self.production_release = production_release
         self.disable_sstate = disable_sstate
         self.extra_config = extra_config or ''
+        # None: use the worker's setting
+        self.incremental = incremental
 
 
 class Repo(object):
     def __init__(self, name, uri, pollinterval=None,
-                 submodules=False):
+                 submodules=False, shallow=None, use_reference=True):
         self.name = name
         self.uri = uri
         self.pollinterval = pollinterval
         self.submodules = submodules
+        # clone depth (None for a full clone)
+        self.shallow = shallow
+        # borrow objects from the worker's git reference repository, if it has one
+        self.use_reference = use_reference
 
 
 class TargetImageSet(object):
-    def __init__(self, name, images=None, sdkimages=None):
+    def __init__(self, name, images=None, sdkimages=None, multiconfig=False,
+                 paths=None, layers=None, distributed=False):
         self.name = name
         if images is None and sdkimages is None:
             raise RuntimeError('No images or SDK images defined for %s' %
                                name)
         self.images = images
         self.sdkimages = sdkimages
+        self.multiconfig = multiconfig and images is not None
+        if distributed and self.multiconfig:
+            raise RuntimeError('Imageset %s cannot be both multiconfig and distributed' % name)
+        # Path patterns (layer directories are just paths) for the files
+        # that affect this imageset; None means every change does
+        if paths is None and layers is None:
+            self.paths = None
+        else:
+            self.paths = (paths or []) + (layers or [])
+        # Build each MACHINE (or SDK target) in a separate child build
+        self.distributed = distributed
+
+    def machines(self):
+        return sorted(set(list(self.images or {}) + list(self.sdkimages or {})))
 
 
 class Distro(object):
@@ -74,7 +98,19 @@ class Distro(object):
                  weekly_type=None,
                  push_type='__default__',
                  pullrequest_type=None,
-                 extra_config=None):
+                 extra_config=None,
+                 buildhistory_index=False,
+                 persistent_bbserver=False,
+                 fetch_all=False,
+                 archive_format='gzip',
+                 archive_threads=0,
+                 buildhistory_store=False,
+                 parallel_postbuild=False,
+                 buildstats=False,
+                 pr_sstate_mirror=None,
+                 pr_sstate_max_age=14,
+                 build_avoidance=False,
+                 common_paths=None):
         self.name = name
         self.reponame = reponame
         self.branch = branch
@@ -118,6 +154,41 @@ class Distro(object):
         else:
             self.pullrequest_type = None
         self.extra_config = extra_config or ''
+        self.buildhistory_index = buildhistory_index
+        # Keep one bitbake server resident for the whole build.  The
+        # server reparses whenever the client environment changes, and
+        # the image and SDK steps each pass their own MACHINE (and
+        # SDKMACHINE), so the parse is only shared between steps for
+        # the same machine -- in practice, imagesets with a single
+        # MACHINE or built with multiconfig=True.
+        self.persistent_bbserver = persistent_bbserver
+        self.fetch_all = fetch_all
+        if archive_format not in archive.FORMATS:
+            raise RuntimeError('Unknown archive format for %s: %s' % (self.name, archive_format))
+        self.archive_format = archive_format
+        self.archive_threads = archive_threads
+        self.buildhistory_store = buildhistory_store
+        self.parallel_postbuild = parallel_postbuild
+        self.buildstats = buildstats
+        if pr_sstate_mirror and not ssmirror:
+            raise RuntimeError('PR sstate staging mirror for %s requires an sstate mirror to promote into' %
+                               self.name)
+        self.pr_sstate_mirror = pr_sstate_mirror
+        self.pr_sstate_max_age = pr_sstate_max_age
+        # Reuse a published build with the same fingerprint (revision and
+        # configuration) instead of building again.  The fingerprint can't
+        # see recipes using AUTOREV (SRCREV = "${AUTOREV}"), whose sources
+        # change without the distro repository changing, so distros that
+        # rely on AUTOREV should leave this off, or use the 'force_rebuild'
+        # force-build option to pick up upstream changes.
+        self.build_avoidance = build_avoidance
+        self.common_paths = common_paths or []
+
+    def builder_paths(self):
+        return {self.name + '-' + imgset.name: imgset.paths for imgset in self.targets}
+
+    def wants_impact_analysis(self):
+        return any([imgset.paths is not None for imgset in self.targets])
 
     def codebases(self, repos):
         cbdict = {self.reponame: {'repository': repos[self.reponame].uri}}
@@ -131,12 +202,38 @@ class Distro(object):
 
 
 class AutobuilderWorker(object):
-    def __init__(self, name, password, conftext=None, max_builds=1):
+    def __init__(self, name, password, conftext=None, max_builds=1,
+                 incremental=False, fast_clean=False, min_free_space=50,
+                 local_cache_dir=None, local_cache_size=100,
+                 dynamic_threads=False, mem_per_thread=2, pressure_limits=None,
+                 git_reference_dir=None):
         self.name = name
         self.password = password
         self.conftext = conftext
         self.max_builds = max_builds
-        if max_builds > 1:
+        # Keep the build directory between builds: the parse cache and
+        # tmp stay, except for tmp/deploy and the tasks that populate it
+        self.incremental = incremental
+        self.fast_clean = fast_clean
+        # in GB
+        self.min_free_space = min_free_space
+        # worker-local sstate/downloads cache tier, size in GB
+        self.local_cache_dir = local_cache_dir
+        self.local_cache_size = local_cache_size
+        # Compute thread counts at build start from the builds running
+        # on the worker and its memory (GB per thread), instead of a
+        # fixed split; optional BB_PRESSURE_MAX_xxx limits, keyed by
+        # 'cpu', 'io' and 'memory'
+        self.dynamic_threads = dynamic_threads
+        self.mem_per_thread = mem_per_thread
+        self.pressure_limits = pressure_limits or {}
+        unknown = [key for key in self.pressure_limits if key not in factory.PRESSURE_VARS]
+        if unknown:
+            raise RuntimeError('Unknown pressure limit(s) for worker %s: %s (must be one of %s)' %
+                               (name, ', '.join(sorted(unknown)), ', '.join(sorted(factory.PRESSURE_VARS))))
+        # persistent git reference repositories for checkouts
+        self.git_reference_dir = git_reference_dir
+        if max_builds > 1 and not dynamic_threads:
             threadconf = '\n'.join(['BB_NUMBER_THREADS = "${@oe.utils.cpu_count() // %d}"' % max_builds,
                                     'PARALLEL_MAKE = "-j ${@oe.utils.cpu_count() // %d}"' % max_builds]) + '\n'
             if self.conftext:
@@ -170,10 +267,18 @@ class EC2Params(object):
 class AutobuilderEC2Worker(AutobuilderWorker):
     master_ip_address = os.getenv('MASTER_IP_ADDRESS')
 
-    def __init__(self, name, password, ec2params, conftext=None, max_builds=1):
+    def __init__(self, name, password, ec2params, conftext=None, max_builds=1,
+                 incremental=False, fast_clean=False, min_free_space=50,
+                 local_cache_dir=None, local_cache_size=100,
+                 dynamic_threads=False, mem_per_thread=2, pressure_limits=None,
+                 git_reference_dir=None):
         if not password:
             password = ''.join(RNG.choice(string.ascii_letters + string.digits) for _ in range(16))
-        AutobuilderWorker.__init__(self, name, password, conftext, max_builds)
+        AutobuilderWorker.__init__(self, name, password, conftext, max_builds,
+                                   incremental, fast_clean, min_free_space,
+                                   local_cache_dir, local_cache_size,
+                                   dynamic_threads, mem_per_thread, pressure_limits,
+                                   git_reference_dir)
         self.ec2params = ec2params
         self.ec2tags = ec2params.tags
         if self.ec2tags:
@@ -208,6 +313,27 @@ class AutobuilderEC2Worker(AutobuilderWorker):
                'MASTER="{}"\n'.format(self.master_ip_address)
 
 
+class HashEquivServer(object):
+    """
+    Settings for a bitbake hash equivalence server shared by
+    the builds of an autobuilder config.  With run_on_master,
+    the master runs bitbake-hashserv itself, listening on 'port'
+    and keeping its database in 'dbfile'; otherwise the server
+    is expected to be running on 'host' already.  The master only
+    runs the server if the config's services are added to
+    c['services'] in master.cfg.
+    """
+    def __init__(self, host, port=8686, dbfile=None, run_on_master=True,
+                 command='bitbake-hashserv'):
+        if run_on_master and not dbfile:
+            raise RuntimeError('Hash equivalence server on the master requires a database file')
+        self.address = '%s:%d' % (host, port)
+        self.bind = '0.0.0.0:%d' % port
+        self.dbfile = dbfile
+        self.run_on_master = run_on_master
+        self.command = command
+
+
 def get_project_for_url(repo_url, branch):
     for abcfg in settings.settings_dict():
         cfg = settings.get_config_for_builder(abcfg)
@@ -307,13 +433,42 @@ class AutobuilderGithubEventHandler(GitHubEventHandler):
         log.msg('Processing GitHub PR #{}'.format(number),
                 logLevel=logging.DEBUG)
 
+        action = payload.get('action')
+        if action == 'closed':
+            # Closed PRs are passed along regardless of skip patterns, so
+            # the shared state their builds staged gets promoted or discarded
+            if not something_wants_pullrequests(payload):
+                defer.returnValue(([], 'git'))
+            merged = payload['pull_request'].get('merged')
+            properties = {'event': event, 'prnumber': number,
+                          'merged': 'yes' if merged else 'no'}
+            change = {
+                'revision': head_sha,
+                'when_timestamp': dateparse(payload['pull_request']['closed_at']),
+                'branch': refname,
+                'revlink': payload['pull_request']['_links']['html']['href'],
+                'repository': payload['repository']['html_url'],
+                'project': get_project_for_url(payload['pull_request']['base']['repo']['html_url'],
+                                               payload['pull_request']['base']['ref']),
+                'category': 'pull-closed',
+                'author': payload['sender']['login'],
+                'comments': u'GitHub Pull Request #{0} {1}\n{2}'.format(
+                    number, 'merged' if merged else 'closed', title),
+                'properties': properties,
+            }
+            if callable(self._codebase):
+                change['codebase'] = self._codebase(payload)
+            elif self._codebase is not None:
+                change['codebase'] = self._codebase
+            log.msg("GitHub PR #{} {}".format(number, 'merged' if merged else 'closed'))
+            defer.returnValue(([change], 'git'))
+
         head_msg = yield self._get_commit_msg(repo_full_name, head_sha)
         if self._has_skip(head_msg):
             log.msg("GitHub PR #{}, Ignoring: "
                     "head commit message contains skip pattern".format(number))
             defer.returnValue(([], 'git'))
 
-        action = payload.get('action')
         if action not in ('opened', 'reopened', 'synchronize'):
             log.msg("GitHub PR #{} {}, ignoring".format(number, action))
             defer.returnValue((pr_changes, 'git'))
@@ -360,8 +515,36 @@ class AutobuilderForceScheduler(schedulers.ForceScheduler):
         yield defer.returnValue(self.builderNames)
 
 
+class ImpactScheduler(schedulers.SingleBranchScheduler):
+    """
+    Schedules only the builders whose imagesets are affected
+    by the files touched in the changes being built.
+    """
+    def __init__(self, name, builder_paths, common_paths=None, **kwargs):
+        self.builder_paths = builder_paths
+        self.common_paths = common_paths
+        schedulers.SingleBranchScheduler.__init__(self, name, **kwargs)
+
+    @defer.inlineCallbacks
+    def addBuildsetForChanges(self, **kwargs):
+        files = []
+        for changeid in kwargs.get('changeids') or []:
+            chdict = yield self.master.data.get(('changes', changeid))
+            if chdict is not None:
+                files += chdict['files'] or []
+        builder_names = impact.affected_builders(files, self.builder_paths, self.common_paths)
+        if not builder_names:
+            log.msg('{}: no imagesets affected by changes {}, nothing scheduled'.format(
+                self.name, kwargs.get('changeids')))
+            defer.returnValue((None, {}))
+        log.msg('{}: scheduling {}'.format(self.name, ', '.join(builder_names)))
+        kwargs['builderNames'] = builder_names
+        result = yield schedulers.SingleBranchScheduler.addBuildsetForChanges(self, **kwargs)
+        defer.returnValue(result)
+
+
 class AutobuilderConfig(object):
-    def __init__(self, name, workers, repos, distros):
+    def __init__(self, name, workers, repos, distros, hashserv=None, fanout_workers=None):
         if name in settings.settings_dict():
             raise RuntimeError('Autobuilder config {} already exists'.format(name))
         self.name = name
@@ -388,6 +571,12 @@ class AutobuilderConfig(object):
             self.worker_cfgs[w.name] = w
 
         self.worker_names = [w.name for w in workers]
+        # The parents of distributed builds just wait for their children,
+        # so they run on their own workers rather than tying up build slots
+        self.fanout_worker_names = fanout_workers
+        if fanout_workers is None and any([imgset.distributed for d in distros for imgset in d.targets]):
+            self.workers.append(worker.LocalWorker(name + '-fanout'))
+            self.fanout_worker_names = [name + '-fanout']
 
         self.repos = repos
         self.distros = distros
@@ -401,8 +590,15 @@ class AutobuilderConfig(object):
         self.non_pr_scheduler_names = sorted([d.name for d in self.distros] +
                                              [d.name + '-force' for d in self.distros])
         self.pr_scheduler_names = sorted([d.name + '-pr' for d in self.distros if d.pullrequest_type])
-        self.all_scheduler_names = sorted(self.non_pr_scheduler_names + self.pr_scheduler_names)
+        self.pr_scheduler_names += [d.name + '-pr-closed' for d in self.distros
+                                    if d.pullrequest_type and d.pr_sstate_mirror]
+        self.pr_scheduler_names.sort()
+        self.fanout_scheduler_names = sorted([d.name + '-' + imgset.name + '-fanout' for d in self.distros
+                                              for imgset in d.targets if imgset.distributed])
+        self.all_scheduler_names = sorted(self.non_pr_scheduler_names + self.pr_scheduler_names +
+                                          self.fanout_scheduler_names)
         self.codebasemap = {self.repos[r].uri: r for r in self.repos}
+        self.hashserv = hashserv
         settings.set_config_for_builder(name, self)
 
     def codebase_generator(self, change_dict):
@@ -434,13 +630,24 @@ class AutobuilderConfig(object):
                                               branch=d.branch, codebase=d.reponame,
                                               category=['push'])
                 props = {'buildtype': d.push_type}
-                s.append(schedulers.SingleBranchScheduler(name=d.name,
-                                                          change_filter=md_filter,
-                                                          treeStableTimer=d.repotimer,
-                                                          properties=props,
-                                                          codebases=d.codebases(self.repos),
-                                                          createAbsoluteSourceStamps=True,
-                                                          builderNames=d.builder_names))
+                if d.wants_impact_analysis():
+                    s.append(ImpactScheduler(name=d.name,
+                                             builder_paths=d.builder_paths(),
+                                             common_paths=d.common_paths,
+                                             change_filter=md_filter,
+                                             treeStableTimer=d.repotimer,
+                                             properties=props,
+                                             codebases=d.codebases(self.repos),
+                                             createAbsoluteSourceStamps=True,
+                                             builderNames=d.builder_names))
+                else:
+                    s.append(schedulers.SingleBranchScheduler(name=d.name,
+                                                              change_filter=md_filter,
+                                                              treeStableTimer=d.repotimer,
+                                                              properties=props,
+                                                              codebases=d.codebases(self.repos),
+                                                              createAbsoluteSourceStamps=True,
+                                                              builderNames=d.builder_names))
             if d.pullrequest_type is not None:
                 # No branch filter here - check is done in the event handler
                 md_filter = util.ChangeFilter(project=d.name,
@@ -453,15 +660,33 @@ class AutobuilderConfig(object):
                                                           codebases=d.codebases(self.repos),
                                                           createAbsoluteSourceStamps=True,
                                                           builderNames=d.builder_names))
+                if d.pr_sstate_mirror:
+                    md_filter = util.ChangeFilter(project=d.name,
+                                                  codebase=d.reponame,
+                                                  category=['pull-closed'])
+                    s.append(schedulers.SingleBranchScheduler(name=d.name + '-pr-closed',
+                                                              change_filter=md_filter,
+                                                              codebases=d.codebases(self.repos),
+                                                              builderNames=[d.name + '-pr-sstate']))
             # noinspection PyTypeChecker
             forceprops = [util.ChoiceStringParameter(name='buildtype',
                                                      label='Build type',
                                                      choices=[bt.name for bt in d.buildtypes],
                                                      default=d.default_buildtype)]
+            if d.build_avoidance:
+                forceprops.append(util.BooleanParameter(name='force_rebuild',
+                                                        label='Build even if an identical build exists',
+                                                        default=False))
             s.append(AutobuilderForceScheduler(name=d.name + '-force',
                                                codebases=d.codebaseparamlist(self.repos),
                                                properties=forceprops,
                                                builderNames=d.builder_names))
+            for imgset in d.targets:
+                if imgset.distributed:
+                    s.append(schedulers.Triggerable(name=d.name + '-' + imgset.name + '-fanout',
+                                                    codebases=d.codebases(self.repos),
+                                                    builderNames=[d.name + '-' + imgset.name + '-' + m
+                                                                  for m in imgset.machines()]))
             if d.weekly_type is not None:
                 slot = settings.get_weekly_slot()
                 s.append(schedulers.Nightly(name=d.name + '-' + 'weekly',
@@ -474,6 +699,15 @@ class AutobuilderConfig(object):
                                             minute=slot.minute))
         return s
 
+    @property
+    def services(self):
+        # Must be added to c['services'] in master.cfg, along with the
+        # workers, schedulers and builders, or hashserv never starts
+        if self.hashserv is None or not self.hashserv.run_on_master:
+            return []
+        return [HashEquivService(self.hashserv.command, self.hashserv.bind, self.hashserv.dbfile,
+                                 name='hashserv-' + self.name)]
+
     @property
     def builders(self):
         b = []
@@ -495,20 +729,71 @@ class AutobuilderConfig(object):
                      'distro': d.name,
                      'buildnum_template': d.buildnum_template,
                      'release_buildname_variable': d.release_buildname_variable,
-                     'extraconf': d.extra_config}
+                     'extraconf': d.extra_config,
+                     'buildhistory_index': 'yes' if d.buildhistory_index else 'no',
+                     'persistent_bbserver': 'yes' if d.persistent_bbserver else 'no',
+                     'fetch_all': 'yes' if d.fetch_all else 'no',
+                     'archive_format': d.archive_format,
+                     'archive_threads': d.archive_threads,
+                     'buildhistory_store': 'yes' if d.buildhistory_store else 'no',
+                     'buildstats': 'yes' if d.buildstats else 'no',
+                     'pr_sstate_mirror': d.pr_sstate_mirror or '',
+                     'pr_sstate_max_age': d.pr_sstate_max_age,
+                     'build_avoidance': 'yes' if d.build_avoidance else 'no',
+                     'hashserve': self.hashserv.address if self.hashserv else ''}
             repo = self.repos[d.reponame]
             b += [BuilderConfig(name=d.name + '-' + imgset.name,
                                 workernames=self.worker_names,
                                 nextWorker=nextEC2Worker,
-                                properties=utils.dict_merge(props, {'imageset': imgset.name}),
+                                properties=utils.dict_merge(props, {'imageset': imgset.name,
+                                                                    'multiconfigs': (' '.join(imgset.images)
+                                                                                     if imgset.multiconfig
+                                                                                     else '')}),
                                 factory=factory.DistroImage(repourl=repo.uri,
                                                             submodules=repo.submodules,
                                                             branch=d.branch,
                                                             codebase=d.reponame,
                                                             imagedict=imgset.images,
                                                             sdkmachines=d.sdkmachines,
-                                                            sdktargets=imgset.sdkimages))
-                  for imgset in d.targets]
+                                                            sdktargets=imgset.sdkimages,
+                                                            multiconfig=imgset.multiconfig,
+                                                            parallel_postbuild=d.parallel_postbuild,
+                                                            shallow=repo.shallow,
+                                                            use_reference=repo.use_reference))
+                  for imgset in d.targets if not imgset.distributed]
+            for imgset in [i for i in d.targets if i.distributed]:
+                imgprops = utils.dict_merge(props, {'imageset': imgset.name, 'multiconfigs': ''})
+                b.append(BuilderConfig(name=d.name + '-' + imgset.name,
+                                       workernames=self.fanout_worker_names,
+                                       properties=imgprops,
+                                       factory=factory.DistributedImage(d.name + '-' + imgset.name + '-fanout',
+                                                                        imgset.machines(),
+                                                                        repourl=repo.uri,
+                                                                        branch=d.branch,
+                                                                        codebase=d.reponame)))
+                b += [BuilderConfig(name=d.name + '-' + imgset.name + '-' + m,
+                                    workernames=self.worker_names,
+                                    nextWorker=nextEC2Worker,
+                                    properties=utils.dict_merge(imgprops, {'fanout_part': m}),
+                                    factory=factory.DistroImage(repourl=repo.uri,
+                                                                submodules=repo.submodules,
+                                                                branch=d.branch,
+                                                                codebase=d.reponame,
+                                                                imagedict=({m: imgset.images[m]}
+                                                                           if m in (imgset.images or {}) else None),
+                                                                sdkmachines=d.sdkmachines,
+                                                                sdktargets=({m: imgset.sdkimages[m]}
+                                                                            if m in (imgset.sdkimages or {}) else None),
+                                                                parallel_postbuild=d.parallel_postbuild,
+                                                                shallow=repo.shallow,
+                                                                use_reference=repo.use_reference))
+                      for m in imgset.machines()]
+            if d.pullrequest_type and d.pr_sstate_mirror:
+                b.append(BuilderConfig(name=d.name + '-pr-sstate',
+                                       workernames=self.worker_names,
+                                       nextWorker=nextEC2Worker,
+                                       properties=props,
+                                       factory=factory.PRSstateFinish()))
         return b
 
 
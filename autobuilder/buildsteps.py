@@ -0,0 +1,364 @@
+# Copyright (c) 2018 by Matthew Madison
+# Distributed under license.
+
+"""
+Custom build steps used by the autobuilder factories.
+"""
+
+import re
+import json
+import time
+import collections
+
+from twisted.internet import defer
+from buildbot.process import buildstep, logobserver
+from buildbot.process.results import SUCCESS, WARNINGS, FAILURE, SKIPPED, CANCELLED, Results, worst_status
+from buildbot.steps.shell import ShellCommand
+
+MC_ERROR_PAT = re.compile(r'^ERROR: .*?\b(?:mc|multiconfig):([^:\s]+):')
+SSTATE_SUMMARY_PAT = re.compile(r'^(?:NOTE: )?Sstate summary: (Wanted \d+.*)')
+SSTATE_COUNT_PAT = re.compile(r'(\w+) (\d+)')
+SSTATE_COUNT_NAMES = {'Wanted': 'wanted', 'Local': 'local', 'Mirrors': 'mirrors', 'Network': 'mirrors',
+                      'Found': 'found', 'Missed': 'missed', 'Current': 'current'}
+
+
+def parse_sstate_summary(line):
+    """
+    Parses bitbake's 'Sstate summary:' line into a dict of counts
+    (wanted, local, mirrors, missed, current).  Older bitbake versions
+    report only a combined 'found' count, which is kept as is.
+    """
+    m = SSTATE_SUMMARY_PAT.match(line)
+    if m is None:
+        return None
+    counts = {}
+    for name, count in SSTATE_COUNT_PAT.findall(m.group(1)):
+        if name in SSTATE_COUNT_NAMES:
+            counts[SSTATE_COUNT_NAMES[name]] = int(count)
+    return counts
+
+
+class SstateBitbake(ShellCommand):
+    """
+    Runs bitbake, recording the setscene counts from its 'Sstate
+    summary' line under 'machine' in the 'sstate_summary' property
+    (a dict with one entry per machine).
+    """
+
+    def __init__(self, machine, **kwargs):
+        ShellCommand.__init__(self, **kwargs)
+        self.machine = machine
+        self.sstate_counts = None
+        self.addLogObserver('stdio', logobserver.LineConsumerLogObserver(self.consume_sstate_lines))
+
+    def consume_sstate_lines(self):
+        while True:
+            _, line = yield
+            counts = parse_sstate_summary(line)
+            if counts is not None:
+                self.sstate_counts = counts
+
+    def evaluateCommand(self, cmd):
+        if self.sstate_counts is not None:
+            summary = dict(self.getProperty('sstate_summary') or {})
+            summary[self.machine] = self.sstate_counts
+            self.setProperty('sstate_summary', summary, 'SstateBitbake')
+        return ShellCommand.evaluateCommand(self, cmd)
+
+
+SSTATE_DROP_PAT = re.compile(r'^Warning: (\S+): sstate mirror hit rate dropped')
+
+
+class SstateHistory(ShellCommand):
+    """
+    Runs sstate-history to record the build's sstate counts, and
+    marks the step with warnings (listing the affected machines in
+    the 'sstate_hit_rate_drops' property) if it reports a sudden
+    drop in the mirror hit rate.
+    """
+
+    def __init__(self, **kwargs):
+        ShellCommand.__init__(self, **kwargs)
+        self.drops = []
+        self.addLogObserver('stdio', logobserver.LineConsumerLogObserver(self.consume_lines))
+
+    def consume_lines(self):
+        while True:
+            _, line = yield
+            m = SSTATE_DROP_PAT.match(line)
+            if m is not None:
+                self.drops.append(m.group(1))
+
+    def evaluateCommand(self, cmd):
+        result = ShellCommand.evaluateCommand(self, cmd)
+        if self.drops:
+            self.setProperty('sstate_hit_rate_drops', self.drops, 'SstateHistory')
+            if result == SUCCESS:
+                result = WARNINGS
+        return result
+
+    def getResultSummary(self):
+        summary = ShellCommand.getResultSummary(self)
+        if self.drops and 'step' in summary:
+            summary['step'] += u' (mirror hit rate dropped: %s)' % u', '.join(self.drops)
+        return summary
+
+
+class MulticonfigBitbake(SstateBitbake):
+    """
+    Runs a single bitbake invocation that builds targets for several
+    multiconfigs, tracking which multiconfigs reported errors.  The
+    per-multiconfig error counts are stored in the 'multiconfig_errors'
+    property for use by MulticonfigResult steps.
+    """
+
+    def __init__(self, multiconfigs, **kwargs):
+        SstateBitbake.__init__(self, machine='multiconfig', **kwargs)
+        self.multiconfigs = multiconfigs
+        self.mc_errors = {}
+        self.addLogObserver('stdio', logobserver.LineConsumerLogObserver(self.consume_lines))
+
+    def consume_lines(self):
+        while True:
+            _, line = yield
+            m = MC_ERROR_PAT.match(line)
+            if m is not None and m.group(1) in self.multiconfigs:
+                self.mc_errors[m.group(1)] = self.mc_errors.get(m.group(1), 0) + 1
+
+    def evaluateCommand(self, cmd):
+        result = SstateBitbake.evaluateCommand(self, cmd)
+        errors = dict(self.mc_errors)
+        # A failure that can't be attributed to particular multiconfigs
+        # (a parse error, for example) is a failure for all of them.
+        if result == FAILURE and len(errors) == 0:
+            errors = {mc: 0 for mc in self.multiconfigs}
+        self.setProperty('multiconfig_errors', errors, 'MulticonfigBitbake')
+        return result
+
+
+class MulticonfigResult(buildstep.BuildStep):
+    """
+    Reports the result of a MulticonfigBitbake step for one
+    multiconfig, so each MACHINE gets its own step summary.
+    """
+
+    def __init__(self, multiconfig, **kwargs):
+        kwargs.setdefault('alwaysRun', True)
+        buildstep.BuildStep.__init__(self, **kwargs)
+        self.multiconfig = multiconfig
+
+    def run(self):
+        errors = self.getProperty('multiconfig_errors')
+        if errors is None:
+            return defer.succeed(SKIPPED)
+        return defer.succeed(FAILURE if self.multiconfig in errors else SUCCESS)
+
+
+TRANSFER_STATS_PAT = re.compile(r'^(\w+) statistics: bytes=(-?\d+) seconds=(\d+)')
+
+
+class TransferStatistics(ShellCommand):
+    """
+    Runs a command that reports '<Label> statistics: bytes=N seconds=M',
+    recording the values as step statistics (and as the '<label>_bytes'
+    and '<label>_seconds' properties).
+    """
+
+    def __init__(self, label, **kwargs):
+        ShellCommand.__init__(self, **kwargs)
+        self.label = label
+        self.transfer_bytes = None
+        self.transfer_seconds = None
+        self.addLogObserver('stdio', logobserver.LineConsumerLogObserver(self.consume_lines))
+
+    def consume_lines(self):
+        while True:
+            _, line = yield
+            m = TRANSFER_STATS_PAT.match(line)
+            if m is not None and m.group(1).lower() == self.label:
+                self.transfer_bytes = max(int(m.group(2)), 0)
+                self.transfer_seconds = int(m.group(3))
+
+    def evaluateCommand(self, cmd):
+        if self.transfer_bytes is not None:
+            for name, value in [('bytes', self.transfer_bytes), ('seconds', self.transfer_seconds)]:
+                self.setStatistic('%s_%s' % (self.label, name), value)
+                self.setProperty('%s_%s' % (self.label, name), value, self.__class__.__name__)
+        return ShellCommand.evaluateCommand(self, cmd)
+
+    def getResultSummary(self):
+        summary = ShellCommand.getResultSummary(self)
+        if self.transfer_bytes is not None and 'step' in summary:
+            summary['step'] += u' (%.1f MiB in %ds)' % (self.transfer_bytes / (1024.0 * 1024.0),
+                                                        self.transfer_seconds)
+        return summary
+
+
+class BitbakeFetch(TransferStatistics):
+    """
+    Runs a fetch-only bitbake pass, recording the time taken
+    and the number of bytes added to DL_DIR as step statistics
+    (and as the 'fetch_seconds' and 'fetch_bytes' properties).
+    """
+
+    def __init__(self, **kwargs):
+        TransferStatistics.__init__(self, label='fetch', **kwargs)
+
+
+BUILDSTATS_PREFIX = 'Buildstats summary: '
+
+
+class BuildstatsSummary(ShellCommand):
+    """
+    Runs buildstats-report for the most recent bitbake invocation,
+    and records the summary it prints under 'label' in the
+    'buildstats_summary' property (a dict with one entry per image step).
+    """
+
+    def __init__(self, label, **kwargs):
+        ShellCommand.__init__(self, **kwargs)
+        self.label = label
+        self.summary = None
+        self.addLogObserver('stdio', logobserver.LineConsumerLogObserver(self.consume_lines))
+
+    def consume_lines(self):
+        while True:
+            _, line = yield
+            if line.startswith(BUILDSTATS_PREFIX):
+                try:
+                    self.summary = json.loads(line[len(BUILDSTATS_PREFIX):])
+                except ValueError:
+                    pass
+
+    def evaluateCommand(self, cmd):
+        if self.summary is not None:
+            stats = dict(self.getProperty('buildstats_summary') or {})
+            stats[self.label] = self.summary
+            self.setProperty('buildstats_summary', stats, 'BuildstatsSummary')
+        return ShellCommand.evaluateCommand(self, cmd)
+
+    def getResultSummary(self):
+        summary = ShellCommand.getResultSummary(self)
+        if self.summary is not None and 'critical_path' in self.summary and 'step' in summary:
+            summary['step'] += u' (%d tasks, %.0fs CPU, critical path %.0fs)' % (
+                self.summary['tasks'], self.summary['cpu'], self.summary['critical_path']['seconds'])
+        return summary
+
+
+class PostBuildTask(object):
+    """
+    One command run by a ParallelPostBuild step.  The task starts
+    once every task named in 'after' has finished; if any of those
+    failed, the task is skipped.  doStepIf has the same meaning as
+    for an ordinary step.
+    """
+
+    def __init__(self, name, command, doStepIf=True, after=None):
+        self.name = name
+        self.command = command
+        self.doStepIf = doStepIf
+        self.after = after or []
+
+    def should_run(self, step):
+        if callable(self.doStepIf):
+            return self.doStepIf(step)
+        return self.doStepIf
+
+
+class ParallelPostBuild(buildstep.ShellMixin, buildstep.BuildStep):
+    """
+    Runs a set of post-build commands concurrently on the worker,
+    honoring the ordering constraints between them.  Each command
+    gets its own log, named after the task, and its result and
+    elapsed time are shown in the step summary and recorded as a
+    step statistic.  Interrupting the step interrupts every command
+    that is running, and no further tasks are started.
+    """
+
+    def __init__(self, tasks, **kwargs):
+        kwargs = self.setupShellMixin(kwargs)
+        buildstep.BuildStep.__init__(self, **kwargs)
+        self.tasks = tasks
+        self.task_status = collections.OrderedDict((task.name, None) for task in tasks)
+        self.running = {}
+
+    @defer.inlineCallbacks
+    def run(self):
+        finished = {}
+        for task in self.tasks:
+            deps = defer.DeferredList([finished[name] for name in task.after if name in finished])
+            finished[task.name] = deps.addCallback(lambda depresults, t=task: self._run_task(t, depresults))
+        results = yield defer.gatherResults([finished[task.name] for task in self.tasks])
+        result = SUCCESS
+        for r in results:
+            result = worst_status(result, SUCCESS if r == SKIPPED else r)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def _run_task(self, task, depresults):
+        if not task.should_run(self):
+            self._set_status(task, SKIPPED)
+            defer.returnValue(SKIPPED)
+        if self.stopped:
+            self._set_status(task, CANCELLED, note='interrupted')
+            defer.returnValue(CANCELLED)
+        if any([not ok or r not in (SUCCESS, WARNINGS, SKIPPED) for ok, r in depresults]):
+            failed = [name for name in task.after
+                      if self.task_status.get(name) and self.task_status[name][0] not in (SUCCESS, WARNINGS, SKIPPED)]
+            yield self.addCompleteLog(task.name, u'Skipped: dependency failed (%s)\n' % u', '.join(failed))
+            self._set_status(task, SKIPPED, note='dependency failed')
+            defer.returnValue(SKIPPED)
+        self._set_status(task, 'running')
+        start = time.time()
+        command = yield self.build.render(task.command)
+        cmd = yield self.makeRemoteShellCommand(command=command, stdioLogName=task.name)
+        self.running[task.name] = cmd
+        try:
+            yield self.runCommand(cmd)
+        finally:
+            del self.running[task.name]
+        elapsed = int(time.time() - start)
+        result = cmd.results()
+        self.setStatistic('%s_seconds' % task.name, elapsed)
+        self._set_status(task, result, elapsed=elapsed)
+        defer.returnValue(result)
+
+    @defer.inlineCallbacks
+    def interrupt(self, reason):
+        # BuildStep.interrupt only knows about the most recently
+        # started command, so interrupt the others here
+        yield buildstep.BuildStep.interrupt(self, reason)
+        others = [cmd for cmd in self.running.values() if cmd is not self.cmd]
+        yield defer.DeferredList([cmd.interrupt(reason) for cmd in others], consumeErrors=True)
+
+    def _set_status(self, task, status, elapsed=None, note=None):
+        self.task_status[task.name] = (status, elapsed, note)
+        self.updateSummary()
+
+    def _task_summary(self):
+        items = []
+        for name, status in self.task_status.items():
+            if status is None or status[0] == 'running':
+                continue
+            result, elapsed, note = status
+            if result == SKIPPED and note is None:
+                continue
+            text = u'%s: %s' % (name, note or Results[result])
+            if elapsed is not None:
+                text += u' (%ds)' % elapsed
+            items.append(text)
+        return items
+
+    def getCurrentSummary(self):
+        running = [name for name, status in self.task_status.items()
+                   if status is not None and status[0] == 'running']
+        summary = self._task_summary()
+        if running:
+            summary.append(u'running: ' + u', '.join(running))
+        return {u'step': u', '.join(summary) if summary else u'starting'}
+
+    def getResultSummary(self):
+        summary = self._task_summary()
+        if not summary:
+            return buildstep.BuildStep.getResultSummary(self)
+        return {u'step': u', '.join(summary)}
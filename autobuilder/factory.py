@@ -3,12 +3,17 @@
 
 import re
 import os
+import json
 import time
+import hashlib
 
 from buildbot.plugins import steps, util
 from buildbot.process.factory import BuildFactory
 import buildbot.status.builder as bbres
 from autobuilder import settings
+from autobuilder.utils import archive, histstore
+from autobuilder.buildsteps import BitbakeFetch, BuildstatsSummary, MulticonfigBitbake, MulticonfigResult, \
+    ParallelPostBuild, PostBuildTask, SstateBitbake, SstateHistory, TransferStatistics
 
 ENV_VARS = {'PATH': util.Property('PATH'),
             'BB_ENV_EXTRAWHITE': util.Property('BB_ENV_EXTRAWHITE'),
@@ -45,7 +50,11 @@ def without_sstate(props):
 
 
 def update_current_symlink(props):
-    return _get_btinfo(props).current_symlink
+    return _get_btinfo(props).current_symlink and not props.getProperty('fanout_part')
+
+
+def persistent_bitbake_server(props):
+    return props.getProperty('persistent_bbserver') == 'yes'
 
 
 @util.renderer
@@ -59,7 +68,9 @@ def sdk_root(props):
 
 @util.renderer
 def sdk_use_current(props):
-    return '--update-current' if update_current_symlink(props) else ''
+    # Not update_current_symlink(): the children of a distributed
+    # build install the SDKs, so they update the SDK links
+    return '--update-current' if _get_btinfo(props).current_symlink else ''
 
 
 @util.renderer
@@ -70,14 +81,18 @@ def sdk_stamp(props):
         return '--date-stamp=' + (props.getProperty('datestamp') or time.strftime('%Y%m%d'))
 
 
-@util.renderer
-def dl_dir(props):
+def _dl_dir(props):
     dldir = props.getProperty('downloads_dir')
     if dldir:
         return dldir
     return 'downloads'
 
 
+@util.renderer
+def dl_dir(props):
+    return _dl_dir(props)
+
+
 # noinspection PyUnusedLocal
 def extract_env_vars(rc, stdout, stderr):
     pat = re.compile('^(' + '|'.join(ENV_VARS.keys()) + ')=(.*)')
@@ -90,6 +105,9 @@ def extract_env_vars(rc, stdout, stderr):
 
 
 def build_tag(props):
+    # Child builds of a distributed build use the parent's tag
+    if props.getProperty('fanout_tag'):
+        return props.getProperty('fanout_tag')
     if is_pull_request(props):
         return '%s-PR-%d' % (props.getProperty('datestamp') or time.strftime('%y%m%d'),
                              props.getProperty('prnumber'))
@@ -97,24 +115,260 @@ def build_tag(props):
                         props.getProperty('buildnumber'))
 
 
+def imageset_output_path(props):
+    return '%s/%s' % (props.getProperty('artifacts_path'), props.getProperty('imageset'))
+
+
+def fanout_parts_path(props):
+    return '%s/.%s.parts' % (imageset_output_path(props), build_tag(props))
+
+
 def build_output_path(props, current_symlink=False):
-    return '%s/%s/%s' % (props.getProperty('artifacts_path'), props.getProperty('imageset'),
-                         'current' if current_symlink else build_tag(props))
+    # Child builds of a distributed build publish into a parts
+    # directory, which the parent collects into the build directory
+    if props.getProperty('fanout_part') and not current_symlink:
+        return '%s/%s' % (fanout_parts_path(props), props.getProperty('fanout_part'))
+    return '%s/%s' % (imageset_output_path(props), 'current' if current_symlink else build_tag(props))
 
 
-def worker_extraconfig(props):
+def _get_workercfg(props):
     abcfg = settings.get_config_for_builder(props.getProperty('autobuilder'))
-    wcfg = abcfg.worker_cfgs[props.getProperty('workername')]
+    return abcfg.worker_cfgs.get(props.getProperty('workername'))
+
+
+def worker_extraconfig(props):
+    wcfg = _get_workercfg(props)
     if wcfg:
         return wcfg.conftext or ''
     return ''
 
 
+def incremental_build(props):
+    bt = _get_btinfo(props)
+    if bt.incremental is not None:
+        return bt.incremental
+    if bt.disable_sstate or bt.production_release:
+        return False
+    wcfg = _get_workercfg(props)
+    return wcfg is not None and wcfg.incremental
+
+
+def fast_clean(props):
+    if incremental_build(props):
+        return False
+    wcfg = _get_workercfg(props)
+    return wcfg is not None and wcfg.fast_clean
+
+
 @util.renderer
-def make_autoconf(props):
+def min_free_space(props):
+    wcfg = _get_workercfg(props)
+    return '--min-free=%d' % (wcfg.min_free_space if wcfg else 0)
+
+
+def pr_sstate_staging_dir(props):
+    """
+    Returns the PR's directory in the distro's staging sstate
+    mirror, or None if there is no staging mirror.
+    """
+    stagingbase = props.getProperty('pr_sstate_mirror')
+    if not stagingbase or props.getProperty('prnumber') is None:
+        return None
+    return os.path.join(stagingbase, 'pr-%s' % props.getProperty('prnumber'))
+
+
+@util.renderer
+def pr_sstate_staging(props):
+    return pr_sstate_staging_dir(props)
+
+
+def local_cache_dir(props, kind):
+    """
+    Returns the location of the worker-local cache tier
+    for 'kind' (sstate or downloads), or None.
+    """
+    wcfg = _get_workercfg(props)
+    if wcfg is None or not wcfg.local_cache_dir:
+        return None
+    return os.path.join(wcfg.local_cache_dir, kind)
+
+
+def update_local_cache_cmd(kind, cachedir, shared_prop):
+    """
+    Returns a renderer for the command that updates the worker-local
+    cache tier for 'kind' from the build's cache directory (as returned
+    by cachedir(props)), reporting the hits in each tier.
+    """
+    @util.renderer
+    def local_cache_cmd(props):
+        cmd = ['update-local-cache', '-v', '--summarize', '--kind=' + kind,
+               '--max-size=%d' % _get_workercfg(props).local_cache_size,
+               cachedir(props), local_cache_dir(props, kind)]
+        if props.getProperty(shared_prop):
+            cmd.append(props.getProperty(shared_prop))
+        return cmd
+    return local_cache_cmd
+
+
+def dynamic_threads(props):
+    wcfg = _get_workercfg(props)
+    return wcfg is not None and wcfg.dynamic_threads
+
+
+@util.renderer
+def running_builds(props):
+    """
+    Returns the number of builds running on the build's worker,
+    counting this one.
+    """
+    build = props.getBuild()
+    try:
+        wrk = build.workerforbuilder.worker
+        return max(1, len([wfb for wfb in wrk.workerforbuilders.values() if wfb.isBusy()]))
+    except AttributeError:
+        return 1
+
+
+WORKER_RESOURCES_CMD = ['bash', '-c', 'echo "cpus=$(nproc)"; awk \'/^MemTotal:/ {print "mem_kb=" $2}\' /proc/meminfo']
+
+
+# noinspection PyUnusedLocal
+def extract_worker_resources(rc, stdout, stderr):
+    result = {}
+    for line in stdout.split('\n'):
+        name, sep, value = line.strip().partition('=')
+        if sep and name in ('cpus', 'mem_kb') and value.isdigit():
+            result['worker_' + name] = int(value)
+    return result
+
+
+PRESSURE_VARS = {'cpu': 'BB_PRESSURE_MAX_CPU', 'io': 'BB_PRESSURE_MAX_IO', 'memory': 'BB_PRESSURE_MAX_MEMORY'}
+
+
+def parallelism_config(props):
+    """
+    Returns the auto.conf settings for dynamic parallelism: the
+    worker's CPUs are split among the builds running on it when
+    this build started, capped so each thread gets the worker's
+    configured share of its memory.
+    """
+    wcfg = _get_workercfg(props)
+    if wcfg is None or not wcfg.dynamic_threads:
+        return []
+    result = []
+    cpus = props.getProperty('worker_cpus')
+    if cpus:
+        running = props.getProperty('running_builds') or 1
+        threads = max(1, cpus // running)
+        mem_kb = props.getProperty('worker_mem_kb')
+        if mem_kb and wcfg.mem_per_thread:
+            threads = min(threads, max(1, mem_kb // running // (wcfg.mem_per_thread * 1024 * 1024)))
+        result += ['BB_NUMBER_THREADS = "%d"' % threads,
+                   'PARALLEL_MAKE = "-j %d"' % threads]
+    for resource in sorted(wcfg.pressure_limits):
+        result.append('%s = "%s"' % (PRESSURE_VARS[resource], wcfg.pressure_limits[resource]))
+    return result
+
+
+def git_reference_dir(props):
+    wcfg = _get_workercfg(props)
+    if wcfg is None or not wcfg.git_reference_dir:
+        return None
+    return wcfg.git_reference_dir
+
+
+def git_reference(codebase):
+    """
+    Returns a renderer for the path of the worker's reference
+    repository for 'codebase', or None if the worker has none.
+    """
+    @util.renderer
+    def reference_path(props):
+        if git_reference_dir(props) is None:
+            return None
+        return os.path.join(git_reference_dir(props), (codebase or 'repo') + '.git')
+
+    return reference_path
+
+
+# Size of the checkout's own object store (objects borrowed
+# from the reference repository are not counted)
+CHECKOUT_SIZE_CMD = ("find build/.git/objects build/.git/modules/*/objects -type f -printf '%s\\n' 2>/dev/null | "
+                     "awk '{s += $1} END {print s + 0}'")
+
+
+# noinspection PyUnusedLocal
+def extract_checkout_start(rc, stdout, stderr):
+    result = {}
+    for line in stdout.split('\n'):
+        name, sep, value = line.strip().partition('=')
+        if sep and name in ('checkout_start', 'checkout_start_bytes') and value.isdigit():
+            result[name] = int(value)
+    return result
+
+
+def checkout_stats_cmd(submodules):
+    """
+    Returns a renderer for a command reporting the time taken by
+    the checkout and the number of bytes it fetched.
+    """
+    @util.renderer
+    def stats_cmd(props):
+        # A clobbering checkout starts from an empty object store
+        startbytes = 0 if submodules and not incremental_build(props) else props.getProperty('checkout_start_bytes')
+        cmd = 'size=$(%s); ' % CHECKOUT_SIZE_CMD
+        cmd += 'echo "Checkout statistics: bytes=$(( ${size:-0} - %d )) seconds=$(( $(date +%%s) - %d ))"' % (
+            startbytes or 0, props.getProperty('checkout_start') or 0)
+        return ['bash', '-c', cmd]
+
+    return stats_cmd
+
+
+# Generated state that must not carry over from one build to the next;
+# the parse cache, the rest of tmp, sstate-cache and downloads are kept.
+INCREMENTAL_CLEAN_PATHS = ['conf/auto.conf', 'conf/multiconfig', 'buildhistory',
+                           'tmp/deploy', 'tmp/buildstats', 'tmp/log',
+                           'bitbake-cookerdaemon.log']
+# With tmp/deploy gone, the stamps and sstate-control manifests of the
+# tasks that write into it must go too, or bitbake would consider those
+# tasks done and never recreate the deploy tree.  They are rerun, or
+# restored from the local sstate-cache by their setscene tasks.
+INCREMENTAL_DEPLOY_STAMPS = ['do_deploy*', 'do_image*', 'do_package_write_*', 'do_populate_lic*',
+                             'do_create_spdx*', 'do_populate_sdk*']
+INCREMENTAL_DEPLOY_MANIFESTS = ['deploy*', 'image_complete', 'package_write_*', 'populate_lic',
+                                'create_spdx']
+
+
+def _find_names(patterns):
+    return '\\( %s \\)' % ' -o '.join(["-name '%s'" % pattern for pattern in patterns])
+
+
+@util.renderer
+def incremental_cleanup_cmdseq(props):
+    wcfg = _get_workercfg(props)
+    min_free_kb = (wcfg.min_free_space if wcfg else 0) * 1024 * 1024
+    cmd = 'if [ -d build ]; then '
+    cmd += 'avail=$(df -Pk build | awk \'NR == 2 {print $4}\'); '
+    cmd += 'if [ "$avail" -lt %d ]; then ' % min_free_kb
+    cmd += 'echo "Only ${avail}KiB free, removing build directory"; rm -rf build; '
+    cmd += 'else (cd build; rm -rf %s; ' % ' '.join(INCREMENTAL_CLEAN_PATHS)
+    cmd += 'if [ -d tmp/stamps ]; then find tmp/stamps -type f %s -delete; fi; ' % (
+        _find_names(['*.' + p for p in INCREMENTAL_DEPLOY_STAMPS]))
+    cmd += 'if [ -d tmp/sstate-control ]; then find tmp/sstate-control -type f %s -delete; fi); fi; fi' % (
+        _find_names(['manifest-*.' + p for p in INCREMENTAL_DEPLOY_MANIFESTS]))
+    return ['bash', '-c', cmd]
+
+
+def autoconf_text(props, with_buildnum=True, with_parallelism=True):
+    """
+    Returns the contents of auto.conf for the build.  The build
+    number setting, which differs for every build, and the thread
+    counts, which depend on the worker's load, can be left out.
+    """
     pr = is_pull_request(props)
-    result = ['INHERIT += "rm_work%s"' % ('' if pr else ' buildhistory'),
-              props.getProperty('buildnum_template') % build_tag(props)]
+    result = ['INHERIT += "rm_work%s"' % ('' if pr else ' buildhistory')]
+    if with_buildnum:
+        result.append(props.getProperty('buildnum_template') % build_tag(props))
     if is_release_build(props):
         result.append('%s = ""' % props.getProperty('release_buildname_variable'))
     if props.getProperty('downloads_dir'):
@@ -123,13 +377,36 @@ def make_autoconf(props):
         result.append(props.getProperty('dl_mirrorvar') % props.getProperty('dl_mirror'))
         if not pr:
             result.append('BB_GENERATE_MIRROR_TARBALLS = "1"')
+    # The worker-local cache tiers are tried before the shared mirrors
+    if local_cache_dir(props, 'downloads'):
+        result.append('PREMIRRORS_prepend = ".*://.*/.* file://%s/ \\n "' % local_cache_dir(props, 'downloads'))
+    if local_cache_dir(props, 'sstate') and not without_sstate(props):
+        result.append('SSTATE_MIRRORS_prepend = "file://.* file://%s/PATH \\n "' % local_cache_dir(props, 'sstate'))
     if props.getProperty('sstate_mirrorvar') != "":
         if without_sstate(props):
             result.append(props.getProperty('sstate_mirrorvar') % '/error/no/such/path')
         elif props.getProperty('sstate_mirror') is not None:
             result.append(props.getProperty('sstate_mirrorvar') % props.getProperty('sstate_mirror'))
+    # PR builds also reuse what earlier builds of the same PR staged,
+    # after anything in the main mirror
+    if pr and pr_sstate_staging_dir(props) and not without_sstate(props):
+        result.append('SSTATE_MIRRORS_append = " file://.* file://%s/PATH \\n"' % pr_sstate_staging_dir(props))
     if not pr:
         result.append('BUILDHISTORY_DIR = "${TOPDIR}/buildhistory"')
+    if props.getProperty('multiconfigs'):
+        result.append('BBMULTICONFIG = "%s"' % props.getProperty('multiconfigs'))
+    if props.getProperty('hashserve') and not without_sstate(props):
+        result.append('BB_SIGNATURE_HANDLER = "OEEquivHash"')
+        result.append('BB_HASHSERVE = "%s"' % props.getProperty('hashserve'))
+    if props.getProperty('buildstats') == 'yes':
+        result.append('INHERIT += "buildstats"')
+    if persistent_bitbake_server(props):
+        # Keep the bitbake server resident between steps; the
+        # StopBitbakeServer step shuts it down at the end of the build.
+        # A step with a different MACHINE/SDKMACHINE still reparses.
+        result.append('BB_SERVER_TIMEOUT = "-1"')
+    if with_parallelism:
+        result += parallelism_config(props)
     # Worker-specific config
     extraconfig = worker_extraconfig(props)
     if len(extraconfig) > 0:
@@ -145,13 +422,104 @@ def make_autoconf(props):
     return '\n'.join(result) + '\n'
 
 
+@util.renderer
+def make_autoconf(props):
+    return autoconf_text(props)
+
+
+def build_avoidance(props):
+    return (props.getProperty('build_avoidance') == 'yes' and not is_pull_request(props) and
+            not props.getProperty('fanout_part') and
+            not is_release_build(props) and props.getProperty('artifacts') != '')
+
+
+def check_previous_build(props):
+    # A forced rebuild still records its fingerprint for later builds
+    return build_avoidance(props) and not props.getProperty('force_rebuild')
+
+
+def build_reused(props):
+    return bool(props.getProperty('reused_build'))
+
+
+def unless_reused(condition=None):
+    """
+    Returns a doStepIf function for a step that should be skipped
+    when a previous build is being reused, and otherwise run only
+    if 'condition' (a doStepIf function, if any) says so.
+    """
+    return lambda step: (not build_reused(step.build.getProperties()) and
+                         (condition is None or condition(step)))
+
+
+def build_fingerprint(imagedict, sdktargets, sdkmachines):
+    """
+    Returns a renderer for the build's fingerprint: a hash of
+    the checked-out revision, the generated auto.conf (less the
+    build number), the worker's extra configuration, the build
+    type and the targets built.  Builds with the same fingerprint
+    produce the same artifacts.
+    """
+    @util.renderer
+    def fingerprint(props):
+        inputs = [props.getProperty('got_revision'),
+                  autoconf_text(props, with_buildnum=False, with_parallelism=False),
+                  worker_extraconfig(props),
+                  props.getProperty('buildtype'),
+                  imagedict, sdktargets if build_sdk(props) else None, sdkmachines]
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    return fingerprint
+
+
+# noinspection PyUnusedLocal
+def extract_previous_build(rc, stdout, stderr):
+    for line in (stdout + '\n' + stderr).split('\n'):
+        if line.startswith('Previous build: '):
+            return {'reused_build': line.split(': ', 1)[1].strip()}
+    return {}
+
+
+@util.renderer
+def check_previous_build_cmd(props):
+    return ['build-avoidance', 'check', imageset_output_path(props),
+            props.getProperty('build_fingerprint')]
+
+
+@util.renderer
+def link_previous_build_cmd(props):
+    return ['build-avoidance', 'link', imageset_output_path(props),
+            props.getProperty('reused_build'), build_tag(props)]
+
+
+@util.renderer
+def record_fingerprint_cmd(props):
+    return ['build-avoidance', 'record', build_output_path(props), props.getProperty('build_fingerprint')]
+
+
+def buildhistory_index_path(props):
+    return os.path.join(props.getProperty('artifacts_path'), 'buildhistory-index.db')
+
+
+@util.renderer
+def autorev_report_cmd(props):
+    cmd = ['autorev-report']
+    if props.getProperty('buildhistory_index') == 'yes':
+        cmd += ['--index=' + buildhistory_index_path(props),
+                '--builder=' + props.getProperty('buildername'),
+                '--build-tag=' + build_tag(props),
+                '--imageset=' + props.getProperty('imageset')]
+        if is_release_build(props):
+            cmd.append('--release')
+    return cmd + ['buildhistory']
+
+
 @util.renderer
 def copy_artifacts_cmdseq(props):
-    cmd = 'if [ -d tmp/deploy ]; then mkdir -p ' + build_output_path(props) + '; '
-    cmd += 'for d in ' + props.getProperty('artifacts') + '; '
-    cmd += 'do if [ -d tmp/deploy/$d ]; then cp -R tmp/deploy/$d '
-    cmd += build_output_path(props) + '; fi; done; fi'
-    return ['bash', '-c', cmd]
+    cmd = ['publish-artifacts', '--verbose', '--summarize']
+    if props.getProperty('fanout_part'):
+        cmd.append('--search-dir=' + imageset_output_path(props))
+    return cmd + [build_output_path(props)] + props.getProperty('artifacts').split()
 
 
 @util.renderer
@@ -160,25 +528,117 @@ def update_artifacts_current_symlink(props):
     return ['bash', '-c', cmd]
 
 
+def save_archive_cmd(props, subdir, srcdir, paths):
+    """
+    Returns a shell command that archives 'paths' (relative to srcdir)
+    into the 'subdir' directory of the build output, in the distro's
+    configured archive format, and adds the archive to the manifest.
+    """
+    fmt = props.getProperty('archive_format') or archive.DEFAULT_FORMAT
+    tarfile = os.path.join(subdir, props.getProperty('buildername') + archive.archive_suffix(fmt))
+    outpath = build_output_path(props)
+    cmd = 'mkdir -p ' + os.path.join(outpath, subdir) + '; '
+    cmd += 'tar -c ' + archive.compress_option(fmt, props.getProperty('archive_threads') or 0)
+    cmd += ' -f ' + os.path.join(outpath, tarfile) + ' -C ' + srcdir + ' ' + paths + ' && '
+    cmd += '(cd ' + outpath + '; sha256sum ' + tarfile + ' >> manifest.sha256)'
+    return cmd
+
+
 @util.renderer
 def save_stamps_cmdseq(props):
-    stamps_dir = os.path.join(build_output_path(props), 'stamps')
-    tarfile = props.getProperty('buildername') + '.tar.gz'
-    cmd = 'if [ -d tmp/stamps ]; then mkdir -p ' + stamps_dir + '; '
-    cmd += '(cd tmp/stamps; tar -c -z -f ' + os.path.join(stamps_dir, tarfile)
-    cmd += ' . ); fi'
+    cmd = 'if [ -d tmp/stamps ]; then ' + save_archive_cmd(props, 'stamps', 'tmp/stamps', '.') + '; fi'
+    return ['bash', '-c', cmd]
+
+
+def buildhistory_store_path(props):
+    return os.path.join(props.getProperty('artifacts_path'), histstore.STORE_NAME)
+
+
+@util.renderer
+def save_buildstats_cmdseq(props):
+    cmd = 'if [ -d tmp/buildstats ]; then ' + save_archive_cmd(props, 'buildstats', 'tmp/buildstats', '.') + '; fi'
     return ['bash', '-c', cmd]
 
 
 @util.renderer
 def save_history_cmdseq(props):
-    history_dir = os.path.join(build_output_path(props), 'buildhistory')
-    tarfile = props.getProperty('buildername') + '.tar.gz'
-    cmd = 'if [ -d buildhistory ]; then mkdir -p ' + history_dir + '; '
-    cmd += 'tar -c -z -f ' + os.path.join(history_dir, tarfile) + ' buildhistory; fi'
+    if props.getProperty('buildhistory_store') == 'yes':
+        treefile = os.path.join('buildhistory', props.getProperty('buildername') + histstore.TREE_SUFFIX)
+        outpath = build_output_path(props)
+        cmd = 'if [ -d buildhistory ]; then buildhistory-store --store-dir=' + buildhistory_store_path(props)
+        cmd += ' store ' + os.path.join(outpath, treefile) + ' buildhistory && '
+        cmd += '(cd ' + outpath + '; sha256sum ' + treefile + ' >> manifest.sha256); fi'
+    else:
+        cmd = 'if [ -d buildhistory ]; then ' + save_archive_cmd(props, 'buildhistory', '.', 'buildhistory') + '; fi'
     return ['bash', '-c', cmd]
 
 
+def sstate_history_path(props):
+    return os.path.join(props.getProperty('artifacts_path'), 'sstate-history.db')
+
+
+@util.renderer
+def sstate_history_cmd(props):
+    return ['sstate-history', '--db=' + sstate_history_path(props),
+            '--builder=' + props.getProperty('buildername'),
+            '--build-tag=' + build_tag(props),
+            json.dumps(props.getProperty('sstate_summary') or {}, sort_keys=True)]
+
+
+def buildstats_step(label, condition=None):
+    """
+    Returns a step that summarizes the buildstats from the
+    bitbake invocation in the step just before it.  If that step
+    is conditional, 'condition' should be the same test, applied
+    to the build properties.
+    """
+    return BuildstatsSummary(label=label,
+                             command=['buildstats-report', '--latest', '--property-line', 'tmp/buildstats'],
+                             workdir=util.Property('BUILDDIR'), timeout=None,
+                             name='buildstats-%s' % label,
+                             doStepIf=lambda step: (step.build.getProperty('buildstats') == 'yes' and
+                                                    not build_reused(step.build.getProperties()) and
+                                                    (condition is None or condition(step.build.getProperties()))),
+                             hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                             description=['Summarizing', 'buildstats'],
+                             descriptionDone=['Summarized', 'buildstats'])
+
+
+def fetch_all_cmdseq(imagedict, sdktargets, sdkmachines, multiconfig):
+    """
+    Returns a renderer for the FetchAll step's command: a fetch-only
+    pass over every image (and, when SDKs are being built, every SDK)
+    target, reporting the time taken and the growth of DL_DIR.
+    """
+    @util.renderer
+    def fetch_cmdseq(props):
+        cmds = []
+        if imagedict is not None:
+            if multiconfig:
+                cmds.append('bitbake --runall=fetch ' +
+                            ' '.join(['mc:%s:%s' % (tgt, imagedict[tgt]) for tgt in imagedict]))
+            else:
+                cmds += ['MACHINE=%s bitbake --runall=fetch %s' % (tgt, imagedict[tgt]) for tgt in imagedict]
+        if sdktargets is not None and build_sdk(props):
+            for tgt in sdktargets:
+                image = sdktargets[tgt]
+                if image not in ['buildtools-tarball', 'uninative-tarball', 'meta-toolchain']:
+                    image += ':do_populate_sdk'
+                for sdkmach in sdkmachines or [None]:
+                    cmds.append('MACHINE=%s %sbitbake --runall=fetch %s' % (
+                        tgt, 'SDKMACHINE=%s ' % sdkmach if sdkmach else '', image))
+        cmd = 'dlsize() { du -sb "%s" 2>/dev/null | cut -f1; }; ' % _dl_dir(props)
+        cmd += 'before=$(dlsize); start=$(date +%s); rc=0; '
+        for c in cmds:
+            cmd += 'if [ $rc -eq 0 ]; then %s || rc=$?; fi; ' % c
+        cmd += 'after=$(dlsize); '
+        cmd += 'echo "Fetch statistics: bytes=$(( ${after:-0} - ${before:-0} )) seconds=$(( $(date +%s) - start ))"; '
+        cmd += 'exit $rc'
+        return ['bash', '-c', cmd]
+
+    return fetch_cmdseq
+
+
 # noinspection PyUnusedLocal
 @util.renderer
 def datestamp(props):
@@ -188,23 +648,85 @@ def datestamp(props):
 class DistroImage(BuildFactory):
     def __init__(self, repourl, submodules=False, branch='master',
                  codebase='', imagedict=None, sdkmachines=None,
-                 sdktargets=None):
+                 sdktargets=None, multiconfig=False, parallel_postbuild=False,
+                 shallow=None, use_reference=True):
         BuildFactory.__init__(self)
         self.addStep(steps.SetProperty(property='datestamp', value=datestamp))
-        self.addStep(steps.Git(repourl=repourl, submodules=submodules,
-                               branch=branch, codebase=codebase,
-                               name='git-checkout-{}'.format(branch),
-                               mode=('full' if submodules else 'incremental'),
-                               method='clobber',
-                               doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
-                               hideStepIf=lambda results, step: results == bbres.SKIPPED))
-        self.addStep(steps.GitHub(repourl=repourl, submodules=submodules,
-                                  branch=branch, codebase=codebase,
-                                  name='git-checkout-pullrequest-ref',
-                                  mode=('full' if submodules else 'incremental'),
-                                  method='clobber',
-                                  doStepIf=lambda step: is_pull_request(step.build.getProperties()),
-                                  hideStepIf=lambda results, step: results == bbres.SKIPPED))
+        self.addStep(steps.SetProperty(property='running_builds', value=running_builds,
+                                       name='RunningBuilds',
+                                       doStepIf=lambda step: dynamic_threads(step.build.getProperties()),
+                                       hideStepIf=lambda results, step: results == bbres.SKIPPED))
+        self.addStep(steps.SetPropertyFromCommand(command=WORKER_RESOURCES_CMD,
+                                                  extract_fn=extract_worker_resources,
+                                                  workdir='.', name='WorkerResources',
+                                                  doStepIf=lambda step: dynamic_threads(step.build.getProperties()),
+                                                  hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                                  description=['Checking', 'worker', 'resources'],
+                                                  descriptionDone=['Checked', 'worker', 'resources']))
+        # Fast clean: move the old build directory (or, if the checkout is going
+        # to be clobbered anyway, the whole checkout) out of the way, and let
+        # a background process on the worker delete it.
+        self.addStep(steps.ShellCommand(command=['fast-clean', '-v', '--trash-dir=.trash', min_free_space,
+                                                 'build' if submodules else 'build/build'],
+                                        workdir='.', name='fast-clean', timeout=None,
+                                        doStepIf=lambda step: fast_clean(step.build.getProperties()),
+                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                        description=['Moving', 'old', 'build', 'directory', 'to', 'trash'],
+                                        descriptionDone=['Moved', 'old', 'build', 'directory', 'to', 'trash']))
+        # A full (clobbering) checkout would also wipe out the build directory
+        # kept by incremental builds, so those use an incremental checkout.
+        checkouts = [('full' if submodules else 'incremental', 'clobber',
+                      (lambda props: not incremental_build(props)) if submodules else (lambda props: True))]
+        if submodules:
+            checkouts.append(('incremental', None, incremental_build))
+        # Checkouts borrow objects from a persistent reference repository
+        # on the worker (submodules from the reference's modules/<name>),
+        # so only commits the reference lacks are fetched from the remote.
+        reference = git_reference(codebase) if use_reference else None
+        gitconfig = None
+        if use_reference and submodules:
+            gitconfig = {'submodule.alternateLocation': 'superproject',
+                         'submodule.alternateErrorStrategy': 'info'}
+        self.addStep(TransferStatistics(label='reference',
+                                        command=(['update-git-reference', '--verbose', '--branch=' + branch] +
+                                                 (['--submodules'] if submodules else []) + [reference, repourl]),
+                                        workdir='.', name='UpdateGitReference', timeout=None,
+                                        flunkOnFailure=False, warnOnFailure=True,
+                                        doStepIf=lambda step: (
+                                            reference is not None and
+                                            git_reference_dir(step.build.getProperties()) is not None),
+                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                        description=['Updating', 'git', 'reference'],
+                                        descriptionDone=['Updated', 'git', 'reference']))
+        self.addStep(steps.SetPropertyFromCommand(command=['bash', '-c', 'echo "checkout_start=$(date +%s)"; ' +
+                                                           'echo "checkout_start_bytes=$(' + CHECKOUT_SIZE_CMD + ')"'],
+                                                  extract_fn=extract_checkout_start,
+                                                  workdir='.', name='CheckoutStart',
+                                                  hideStepIf=lambda results, step: True))
+        for mode, method, checkout_if in checkouts:
+            self.addStep(steps.Git(repourl=repourl, submodules=submodules,
+                                   branch=branch, codebase=codebase,
+                                   name='git-checkout-{}'.format(branch),
+                                   mode=mode, method=method,
+                                   reference=reference, shallow=shallow, config=gitconfig,
+                                   doStepIf=lambda step, cif=checkout_if: (
+                                       not is_pull_request(step.build.getProperties()) and
+                                       cif(step.build.getProperties())),
+                                   hideStepIf=lambda results, step: results == bbres.SKIPPED))
+            self.addStep(steps.GitHub(repourl=repourl, submodules=submodules,
+                                      branch=branch, codebase=codebase,
+                                      name='git-checkout-pullrequest-ref',
+                                      mode=mode, method=method,
+                                      reference=reference, shallow=shallow, config=gitconfig,
+                                      doStepIf=lambda step, cif=checkout_if: (
+                                          is_pull_request(step.build.getProperties()) and
+                                          cif(step.build.getProperties())),
+                                      hideStepIf=lambda results, step: results == bbres.SKIPPED))
+        self.addStep(TransferStatistics(label='checkout', command=checkout_stats_cmd(submodules),
+                                        workdir='.', name='CheckoutStatistics',
+                                        flunkOnFailure=False, warnOnFailure=True,
+                                        description=['Measuring', 'checkout'],
+                                        descriptionDone=['Checkout']))
         env_vars = ENV_VARS.copy()
         # First, remove duplicates from PATH,
         # then strip out the virtualenv bin directory if we're in a virtualenv.
@@ -215,8 +737,17 @@ class DistroImage(BuildFactory):
         # Setup steps
 
         self.addStep(steps.RemoveDirectory('build/build', name='cleanup',
+                                           doStepIf=lambda step: not (incremental_build(step.build.getProperties()) or
+                                                                      fast_clean(step.build.getProperties())),
+                                           hideStepIf=lambda results, step: results == bbres.SKIPPED,
                                            description=['Removing', 'old', 'build', 'directory'],
                                            descriptionDone=['Removed', 'old', 'build', 'directory']))
+        self.addStep(steps.ShellCommand(command=incremental_cleanup_cmdseq, workdir='build',
+                                        name='incremental-cleanup', timeout=None,
+                                        doStepIf=lambda step: incremental_build(step.build.getProperties()),
+                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                        description=['Cleaning', 'generated', 'build', 'state'],
+                                        descriptionDone=['Cleaned', 'generated', 'build', 'state']))
         self.addStep(steps.SetPropertyFromCommand(command=['bash', '-c',
                                                            util.Interpolate(setup_cmd)],
                                                   extract_fn=extract_env_vars,
@@ -230,15 +761,84 @@ class DistroImage(BuildFactory):
 
         # Build the target image(s)
 
-        if imagedict is not None:
+        # One multiconfig per MACHINE, all built with a single bitbake
+        # invocation so parsing is shared and tasks for different machines
+        # can run in parallel.  The multiconfigs share TMPDIR, so the
+        # deploy directory layout is the same as for separate builds.
+        if imagedict is not None and multiconfig:
+            for tgt in imagedict:
+                self.addStep(steps.StringDownload(s='MACHINE = "%s"\n' % tgt, workerdest='%s.conf' % tgt,
+                                                  workdir='build/build/conf/multiconfig',
+                                                  name='make-multiconfig-%s' % tgt,
+                                                  description=['Creating', 'multiconfig', tgt],
+                                                  descriptionDone=['Created', 'multiconfig', tgt]))
+
+        # Build avoidance: if a build with the same revision and configuration
+        # has already been published, link to it instead of building again.
+        self.addStep(steps.SetProperty(property='build_fingerprint',
+                                       value=build_fingerprint(imagedict, sdktargets, sdkmachines),
+                                       name='BuildFingerprint',
+                                       doStepIf=lambda step: build_avoidance(step.build.getProperties()),
+                                       hideStepIf=lambda results, step: results == bbres.SKIPPED))
+        self.addStep(steps.SetPropertyFromCommand(command=check_previous_build_cmd,
+                                                  extract_fn=extract_previous_build,
+                                                  workdir='.', name='CheckPreviousBuild',
+                                                  doStepIf=lambda step: check_previous_build(
+                                                      step.build.getProperties()),
+                                                  hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                                  description=['Checking', 'for', 'previous', 'build'],
+                                                  descriptionDone=['Checked', 'for', 'previous', 'build']))
+
+        # Optionally fetch sources for every target up front, so the
+        # build steps that follow don't have to wait on the network.
+        self.addStep(BitbakeFetch(command=fetch_all_cmdseq(imagedict, sdktargets, sdkmachines, multiconfig),
+                                  env=env_vars, workdir=util.Property('BUILDDIR'), timeout=None,
+                                  name='FetchAll',
+                                  doStepIf=unless_reused(lambda step: step.build.getProperty('fetch_all') == 'yes'),
+                                  hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                  description=['Fetching', 'sources'],
+                                  descriptionDone=['Fetched', 'sources']))
+
+        if imagedict is not None and multiconfig:
+            mctargets = ' '.join(['mc:%s:%s' % (tgt, imagedict[tgt]) for tgt in imagedict])
+            self.addStep(MulticonfigBitbake(multiconfigs=list(imagedict.keys()),
+                                            command=['bash', '-c', 'bitbake %s' % mctargets],
+                                            env=env_vars, workdir=util.Property('BUILDDIR'), timeout=None,
+                                            name='multiconfig-build',
+                                            doStepIf=unless_reused(),
+                                            hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                            description=['Building', 'images', '(multiconfig)'],
+                                            descriptionDone=['Built', 'images', '(multiconfig)']))
+            self.addStep(buildstats_step('multiconfig-build'))
+            for tgt in imagedict:
+                self.addStep(MulticonfigResult(multiconfig=tgt, name='%s_%s' % (imagedict[tgt], tgt),
+                                               doStepIf=unless_reused(),
+                                               hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                               description=['Building', imagedict[tgt], '(' + tgt + ')'],
+                                               descriptionDone=['Built', imagedict[tgt], '(' + tgt + ')']))
+        elif imagedict is not None:
             for tgt in imagedict:
                 tgtenv = env_vars.copy()
                 tgtenv['MACHINE'] = tgt
-                self.addStep(steps.ShellCommand(command=['bash', '-c', 'bitbake %s' % imagedict[tgt]],
-                                                env=tgtenv, workdir=util.Property('BUILDDIR'), timeout=None,
-                                                name='%s_%s' % (imagedict[tgt], tgt),
-                                                description=['Building', imagedict[tgt], '(' + tgt + ')'],
-                                                descriptionDone=['Built', imagedict[tgt], '(' + tgt + ')']))
+                self.addStep(SstateBitbake(machine=tgt,
+                                           command=['bash', '-c', 'bitbake %s' % imagedict[tgt]],
+                                           env=tgtenv, workdir=util.Property('BUILDDIR'), timeout=None,
+                                           name='%s_%s' % (imagedict[tgt], tgt),
+                                           doStepIf=unless_reused(),
+                                           hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                           description=['Building', imagedict[tgt], '(' + tgt + ')'],
+                                           descriptionDone=['Built', imagedict[tgt], '(' + tgt + ')']))
+                self.addStep(buildstats_step('%s_%s' % (imagedict[tgt], tgt)))
+
+        # Track the sstate hit rate for the image builds
+        self.addStep(SstateHistory(command=sstate_history_cmd, workdir=util.Property('BUILDDIR'),
+                                   name='SstateHistory', timeout=None,
+                                   doStepIf=unless_reused(lambda step: (imagedict is not None and
+                                                                        not is_pull_request(
+                                                                            step.build.getProperties()))),
+                                   hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                   description=['Recording', 'sstate', 'hit', 'rate'],
+                                   descriptionDone=['Recorded', 'sstate', 'hit', 'rate']))
 
         # Build the SDK(s)
 
@@ -254,10 +854,12 @@ class DistroImage(BuildFactory):
                     self.addStep(steps.ShellCommand(command=['bash', '-c', 'bitbake %s' % image],
                                                     env=tgtenv, workdir=util.Property('BUILDDIR'), timeout=None,
                                                     name='sdk-%s_%s' % (image, tgt),
-                                                    doStepIf=lambda step: build_sdk(step.build.getProperties()),
+                                                    doStepIf=unless_reused(
+                                                        lambda step: build_sdk(step.build.getProperties())),
                                                     hideStepIf=lambda results, step: results == bbres.SKIPPED,
                                                     description=['Building', 'SDK', image, '(' + tgt + ')'],
                                                     descriptionDone=['Built', 'SDK', image, '(' + tgt + ')']))
+                    self.addStep(buildstats_step('sdk-%s_%s' % (sdktargets[tgt], tgt), build_sdk))
                 else:
                     for sdkmach in sdkmachines:
                         sdkenv = tgtenv.copy()
@@ -265,72 +867,255 @@ class DistroImage(BuildFactory):
                         self.addStep(steps.ShellCommand(command=['bash', '-c', 'bitbake %s' % image],
                                                         env=sdkenv, workdir=util.Property('BUILDDIR'), timeout=None,
                                                         name='sdk-%s_%s_%s' % (sdkmach, image, tgt),
-                                                        doStepIf=lambda step: build_sdk(step.build.getProperties()),
+                                                        doStepIf=unless_reused(
+                                                        lambda step: build_sdk(step.build.getProperties())),
                                                         hideStepIf=lambda results, step: results == bbres.SKIPPED,
                                                         description=['Building', sdkmach, 'SDK', image,
                                                                      '(' + tgt + ')'],
                                                         descriptionDone=['Built', sdkmach, 'SDK', image,
                                                                          '(' + tgt + ')']))
+                        self.addStep(buildstats_step('sdk-%s_%s_%s' % (sdkmach, sdktargets[tgt], tgt), build_sdk))
 
-        self.addStep(steps.ShellCommand(command=['autorev-report', 'buildhistory'],
-                                        workdir=util.Property('BUILDDIR'),
-                                        name='AutorevReport', timeout=None,
-                                        doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
+        self.addStep(steps.ShellCommand(command=['bash', '-c', 'bitbake -m'],
+                                        env=env_vars, workdir=util.Property('BUILDDIR'), timeout=None,
+                                        name='StopBitbakeServer', alwaysRun=True,
+                                        flunkOnFailure=False, warnOnFailure=True,
+                                        doStepIf=lambda step: persistent_bitbake_server(step.build.getProperties()),
                                         hideStepIf=lambda results, step: results == bbres.SKIPPED,
-                                        description=['Generating', 'AUTOREV', 'report'],
-                                        descriptionDone=['Generated', 'AUTOREV', 'report']))
+                                        description=['Stopping', 'bitbake', 'server'],
+                                        descriptionDone=['Stopped', 'bitbake', 'server']))
+
+        # Post-build steps: (task name, tasks that must finish first, step arguments).
+        # The stamps, buildhistory and buildstats are saved into the directory
+        # created by CopyArtifacts, and the current symlink must not point at
+        # the new build until all of them are in place.
+        postbuild = [('AutorevReport', [],
+                      dict(command=autorev_report_cmd,
+                           doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
+                           description=['Generating', 'AUTOREV', 'report'],
+                           descriptionDone=['Generated', 'AUTOREV', 'report'])),
+                     # Copy artifacts, stamps, buildhistory to binary repo
+                     ('CopyArtifacts', [],
+                      dict(command=copy_artifacts_cmdseq,
+                           doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
+                                                  step.build.getProperty('artifacts') != ''),
+                           description=['Copying', 'artifacts', 'to', 'binary', 'repo'],
+                           descriptionDone=['Copied', 'artifacts', 'to', 'binary', 'repo'])),
+                     ('SaveStamps', ['CopyArtifacts'],
+                      dict(command=save_stamps_cmdseq,
+                           doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
+                           description=['Saving', 'build', 'stamps'],
+                           descriptionDone=['Saved', 'build', 'stamps'])),
+                     ('SaveHistory', ['CopyArtifacts'],
+                      dict(command=save_history_cmdseq,
+                           doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
+                           description=['Saving', 'buildhistory', 'data'],
+                           descriptionDone=['Saved', 'buildhistory', 'data'])),
+                     ('SaveBuildstats', ['CopyArtifacts'],
+                      dict(command=save_buildstats_cmdseq,
+                           doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
+                                                  step.build.getProperty('buildstats') == 'yes'),
+                           description=['Saving', 'buildstats'],
+                           descriptionDone=['Saved', 'buildstats'])),
+                     ('LinkPreviousBuild', [],
+                      dict(command=link_previous_build_cmd,
+                           doStepIf=lambda step: build_reused(step.build.getProperties()),
+                           description=['Linking', 'to', 'previous', 'build'],
+                           descriptionDone=['Linked', 'to', 'previous', 'build'])),
+                     ('UpdateCurrentSymnlink', ['CopyArtifacts', 'SaveStamps', 'SaveHistory', 'SaveBuildstats',
+                                                'LinkPreviousBuild'],
+                      dict(command=update_artifacts_current_symlink,
+                           doStepIf=lambda step: update_current_symlink(step.build.getProperties()),
+                           description=['Updating', 'current', 'symlink'],
+                           descriptionDone=['Updated', 'current', 'symlink'])),
+                     ('UpdateSharedState', [],
+                      dict(command=['update-sstate-mirror', '-v', '--summarize', '-s', 'sstate-cache',
+                                    util.Property('sstate_mirror')],
+                           doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
+                                                  step.build.getProperty('skip_sstate_update') != 'yes'),
+                           description=['Updating', 'shared-state', 'mirror'],
+                           descriptionDone=['Updated', 'shared-state', 'mirror'])),
+                     ('UpdatePRSharedState', [],
+                      dict(command=['update-sstate-mirror', '-v', '--summarize', '-s', 'sstate-cache',
+                                    pr_sstate_staging],
+                           doStepIf=lambda step: (is_pull_request(step.build.getProperties()) and
+                                                  not without_sstate(step.build.getProperties()) and
+                                                  pr_sstate_staging_dir(step.build.getProperties()) is not None),
+                           description=['Updating', 'PR', 'shared-state', 'staging', 'mirror'],
+                           descriptionDone=['Updated', 'PR', 'shared-state', 'staging', 'mirror'])),
+                     ('UpdateLocalSstateCache', [],
+                      dict(command=update_local_cache_cmd('sstate', lambda props: 'sstate-cache', 'sstate_mirror'),
+                           doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
+                                                  not without_sstate(step.build.getProperties()) and
+                                                  local_cache_dir(step.build.getProperties(), 'sstate') is not None),
+                           description=['Updating', 'local', 'shared-state', 'cache'],
+                           descriptionDone=['Updated', 'local', 'shared-state', 'cache'])),
+                     ('UpdateLocalDownloadsCache', [],
+                      dict(command=update_local_cache_cmd('downloads', _dl_dir, 'dl_mirror'),
+                           doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
+                                                  local_cache_dir(step.build.getProperties(), 'downloads') is not None),
+                           description=['Updating', 'local', 'downloads', 'cache'],
+                           descriptionDone=['Updated', 'local', 'downloads', 'cache'])),
+                     ('UpdateDownloads', [],
+                      dict(command=['update-downloads', '-v', '--summarize', '-l', dl_dir,
+                                    util.Property('dl_mirror')],
+                           doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
+                                                  step.build.getProperty('dl_mirror') is not None),
+                           description=['Updating', 'downloads', 'mirror'],
+                           descriptionDone=['Updated', 'downloads', 'mirror']))]
+        if sdktargets is not None:
+            # SDK installs share the SDK root, so they run one at a time
+            prev = []
+            for tgt in sdktargets:
+                cmd = ['install-sdk', sdk_root, sdk_stamp,
+                       '--machine=%s' % tgt, '--image=%s' % sdktargets[tgt],
+                       sdk_use_current]
+                postbuild.append(('InstallSDK-%s' % tgt, prev,
+                                  dict(command=cmd, name='InstallSDKs',
+                                       doStepIf=lambda step: install_sdk(step.build.getProperties()),
+                                       description=['Installing', sdktargets[tgt], 'SDK', '(' + tgt + ')'],
+                                       descriptionDone=['Installed', sdktargets[tgt], 'SDK', '(' + tgt + ')'])))
+                prev = ['InstallSDK-%s' % tgt]
+        # A reused build only needs its link and the current symlink
+        for taskname, _, args in postbuild:
+            if taskname not in ['LinkPreviousBuild', 'UpdateCurrentSymnlink']:
+                args['doStepIf'] = unless_reused(args['doStepIf'])
+        if parallel_postbuild:
+            self.addStep(ParallelPostBuild([PostBuildTask(taskname, args['command'], args['doStepIf'], after)
+                                            for taskname, after, args in postbuild],
+                                           workdir=util.Property('BUILDDIR'), name='PostBuild', timeout=None,
+                                           description=['Running', 'post-build', 'steps'],
+                                           descriptionDone=['Ran', 'post-build', 'steps']))
+        else:
+            for taskname, _, args in postbuild:
+                args.setdefault('name', taskname)
+                self.addStep(steps.ShellCommand(workdir=util.Property('BUILDDIR'), timeout=None,
+                                                hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                                **args))
+
+        # Record the fingerprint last, so only builds that completed
+        # successfully are candidates for reuse
+        self.addStep(steps.ShellCommand(command=record_fingerprint_cmd, workdir='.',
+                                        name='RecordFingerprint', timeout=None,
+                                        doStepIf=lambda step: (build_avoidance(step.build.getProperties()) and
+                                                               not build_reused(step.build.getProperties()) and
+                                                               step.build.results in (bbres.SUCCESS, bbres.WARNINGS)),
+                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                        description=['Recording', 'build', 'fingerprint'],
+                                        descriptionDone=['Recorded', 'build', 'fingerprint']))
+
+
+@util.renderer
+def pr_sstate_finish_cmd(props):
+    cmd = ['pr-sstate-mirror', '-v', '--summarize', '--expire',
+           '--max-age=%d' % (props.getProperty('pr_sstate_max_age') or 14)]
+    if props.getProperty('merged') == 'yes':
+        cmd += ['--promote=%s' % props.getProperty('prnumber'), '--mirror=' + props.getProperty('sstate_mirror')]
+    else:
+        cmd.append('--discard=%s' % props.getProperty('prnumber'))
+    return cmd + [props.getProperty('pr_sstate_mirror')]
+
+
+class PRSstateFinish(BuildFactory):
+    """
+    Runs when a pull request is closed: the shared state its builds
+    staged is promoted into the main mirror if it was merged, and
+    discarded otherwise.  Staging directories for PRs that have gone
+    inactive are expired at the same time.
+    """
+    def __init__(self):
+        BuildFactory.__init__(self)
+        self.addStep(steps.ShellCommand(command=pr_sstate_finish_cmd, workdir='.',
+                                        name='PRSstateMirror', timeout=None,
+                                        description=['Updating', 'PR', 'shared-state', 'staging', 'mirror'],
+                                        descriptionDone=['Updated', 'PR', 'shared-state', 'staging', 'mirror']))
+
+
+@util.renderer
+def fanout_tag(props):
+    return build_tag(props)
+
+
+# noinspection PyUnusedLocal
+def extract_fanout_revision(rc, stdout, stderr):
+    for line in stdout.split('\n'):
+        fields = line.split()
+        if len(fields) == 2 and re.match('^[0-9a-f]{40}$', fields[0]):
+            return {'fanout_revision': fields[0]}
+    return {}
+
+
+def fanout_sourcestamps(repourl, branch, codebase):
+    """
+    Returns a renderer for the source stamp the children of a
+    distributed build are triggered with.  A revision resolved by
+    the parent is on the distro branch; otherwise the branch and
+    repository of the triggering change (such as a pull request
+    ref) go with its revision.
+    """
+    @util.renderer
+    def sourcestamps(props):
+        if props.getProperty('fanout_revision'):
+            return [{'codebase': codebase, 'repository': repourl, 'branch': branch,
+                     'revision': props.getProperty('fanout_revision')}]
+        return [{'codebase': codebase,
+                 'repository': props.getProperty('repository') or repourl,
+                 'branch': props.getProperty('branch') or branch,
+                 'revision': props.getProperty('revision')}]
+
+    return sourcestamps
+
 
-        # Copy artifacts, stamps, buildhistory to binary repo
+def aggregate_artifacts_cmd(parts):
+    @util.renderer
+    def aggregate_cmd(props):
+        return ['aggregate-artifacts', '--verbose', '--summarize', '--expect=' + ','.join(parts),
+                build_output_path(props), fanout_parts_path(props)]
 
-        self.addStep(steps.ShellCommand(command=copy_artifacts_cmdseq, workdir=util.Property('BUILDDIR'),
-                                        name='CopyArtifacts', timeout=None,
+    return aggregate_cmd
+
+
+class DistributedImage(BuildFactory):
+    """
+    Parent of a distributed build: triggers one child build per
+    MACHINE (or SDK target), which can run on different workers and
+    share shared-state through the mirror, then collects the artifacts
+    the children published under this build's tag.  Force and periodic
+    builds carry no revision, so the head of the branch is resolved
+    here and every child is triggered with the same commit.
+    """
+    def __init__(self, scheduler_name, parts, repourl, branch='master', codebase=''):
+        BuildFactory.__init__(self)
+        self.addStep(steps.SetProperty(property='datestamp', value=datestamp))
+        self.addStep(steps.SetPropertyFromCommand(command=['git', 'ls-remote', repourl, 'refs/heads/' + branch],
+                                                  extract_fn=extract_fanout_revision,
+                                                  workdir='.', name='ResolveRevision', haltOnFailure=True,
+                                                  doStepIf=lambda step: not step.build.getProperty('revision'),
+                                                  hideStepIf=lambda results, step: results == bbres.SKIPPED,
+                                                  description=['Resolving', branch, 'revision'],
+                                                  descriptionDone=['Resolved', branch, 'revision']))
+        self.addStep(steps.Trigger(schedulerNames=[scheduler_name], waitForFinish=True,
+                                   updateSourceStamp=False,
+                                   sourceStamps=fanout_sourcestamps(repourl, branch, codebase),
+                                   set_properties={'buildtype': util.Property('buildtype'),
+                                                   'datestamp': util.Property('datestamp'),
+                                                   'prnumber': util.Property('prnumber'),
+                                                   'fanout_tag': fanout_tag},
+                                   name='BuildMachines',
+                                   description=['Building', 'machines'],
+                                   descriptionDone=['Built', 'machines']))
+        self.addStep(steps.ShellCommand(command=aggregate_artifacts_cmd(parts), workdir='.',
+                                        name='CollectArtifacts', timeout=None, alwaysRun=True,
                                         doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
                                                                step.build.getProperty('artifacts') != ''),
                                         hideStepIf=lambda results, step: results == bbres.SKIPPED,
-                                        description=['Copying', 'artifacts', 'to', 'binary', 'repo'],
-                                        descriptionDone=['Copied', 'artifacts', 'to', 'binary', 'repo']))
-        self.addStep(steps.ShellCommand(command=save_stamps_cmdseq, workdir=util.Property('BUILDDIR'),
-                                        name='SaveStamps', timeout=None,
-                                        doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
-                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
-                                        description=['Saving', 'build', 'stamps'],
-                                        descriptionDone=['Saved', 'build', 'stamps']))
-        self.addStep(steps.ShellCommand(command=save_history_cmdseq, workdir=util.Property('BUILDDIR'),
-                                        name='SaveHistory', timeout=None,
-                                        doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
-                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
-                                        description=['Saving', 'buildhistory', 'data'],
-                                        descriptionDone=['Saved', 'buildhistory', 'data']))
-        self.addStep(steps.ShellCommand(command=update_artifacts_current_symlink, workdir=util.Property('BUILDDIR'),
-                                        name='UpdateCurrentSymnlink', timeout=None,
-                                        doStepIf=lambda step: update_current_symlink(step.build.getProperties()),
+                                        description=['Collecting', 'artifacts'],
+                                        descriptionDone=['Collected', 'artifacts']))
+        # Only move 'current' once every child has built and published
+        self.addStep(steps.ShellCommand(command=update_artifacts_current_symlink, workdir='.',
+                                        name='UpdateCurrentSymnlink',
+                                        doStepIf=lambda step: (update_current_symlink(step.build.getProperties()) and
+                                                               step.build.results in (bbres.SUCCESS, bbres.WARNINGS)),
                                         hideStepIf=lambda results, step: results == bbres.SKIPPED,
                                         description=['Updating', 'current', 'symlink'],
                                         descriptionDone=['Updated', 'current', 'symlink']))
-        self.addStep(steps.ShellCommand(command=['update-sstate-mirror', '-v', '-s', 'sstate-cache',
-                                                 util.Property('sstate_mirror')], workdir=util.Property('BUILDDIR'),
-                                        doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
-                                                               step.build.getProperty('skip_sstate_update') != 'yes'),
-                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
-                                        name='UpdateSharedState', timeout=None,
-                                        description=['Updating', 'shared-state', 'mirror'],
-                                        descriptionDone=['Updated', 'shared-state', 'mirror']))
-        self.addStep(steps.ShellCommand(command=['update-downloads', '-v', '-l', dl_dir,
-                                                 util.Property('dl_mirror')], workdir=util.Property('BUILDDIR'),
-                                        doStepIf=lambda step: (not is_pull_request(step.build.getProperties()) and
-                                                               step.build.getProperty('dl_mirror') is not None),
-                                        hideStepIf=lambda results, step: results == bbres.SKIPPED,
-                                        name='UpdateDownloads', timeout=None,
-                                        description=['Updating', 'downloads', 'mirror'],
-                                        descriptionDone=['Updated', 'downloads', 'mirror']))
-        if sdktargets is not None:
-            for tgt in sdktargets:
-                cmd = ['install-sdk', sdk_root, sdk_stamp,
-                       '--machine=%s' % tgt, '--image=%s' % sdktargets[tgt],
-                       sdk_use_current]
-                self.addStep(steps.ShellCommand(command=cmd, workdir=util.Property('BUILDDIR'),
-                                                name='InstallSDKs', timeout=None,
-                                                doStepIf=lambda step: install_sdk(step.build.getProperties()),
-                                                hideStepIf=lambda results, step: results == bbres.SKIPPED,
-                                                description=['Installing', sdktargets[tgt], 'SDK', '(' + tgt + ')'],
-                                                descriptionDone=['Installed', sdktargets[tgt], 'SDK', '(' + tgt + ')']))
@@ -0,0 +1,90 @@
+# Copyright (c) 2018 by Matthew Madison
+# Distributed under license.
+
+"""
+Buildbot service for running a bitbake hash equivalence server
+alongside the master.
+"""
+import os
+from twisted.internet import defer, protocol, reactor
+from twisted.python import log
+from buildbot.util import service
+
+
+class HashServProcessProtocol(protocol.ProcessProtocol):
+    def __init__(self, svc):
+        self.svc = svc
+
+    def outReceived(self, data):
+        for line in data.decode('utf-8', 'replace').splitlines():
+            log.msg('hashserv: %s' % line)
+
+    errReceived = outReceived
+
+    def processEnded(self, reason):
+        self.svc.process_ended(reason)
+
+
+class HashEquivService(service.BuildbotService):
+    """
+    Runs bitbake-hashserv as a child of the master, restarting it
+    if it exits.  The database file persists across restarts of
+    both the server and the master.
+    """
+    name = 'HashEquivService'
+    RESTART_DELAY = 30
+
+    def __init__(self, *args, **kwargs):
+        self.command = None
+        self.bind = None
+        self.dbfile = None
+        self.process = None
+        self.restart_call = None
+        self.stopped_d = None
+        service.BuildbotService.__init__(self, *args, **kwargs)
+
+    def checkConfig(self, command, bind, dbfile):
+        if not command:
+            from buildbot import config
+            config.error('HashEquivService requires a server command')
+
+    @defer.inlineCallbacks
+    def reconfigService(self, command, bind, dbfile):
+        if (command, bind, dbfile) == (self.command, self.bind, self.dbfile) and self.process is not None:
+            return
+        yield self.stop_server()
+        self.command, self.bind, self.dbfile = command, bind, dbfile
+        self.start_server()
+
+    def start_server(self):
+        self.restart_call = None
+        dbdir = os.path.dirname(self.dbfile)
+        if dbdir and not os.path.isdir(dbdir):
+            os.makedirs(dbdir)
+        args = [self.command, '--bind', self.bind, '--database', self.dbfile]
+        log.msg('starting hash equivalence server: %s' % ' '.join(args))
+        self.process = reactor.spawnProcess(HashServProcessProtocol(self), self.command, args, env=os.environ)
+
+    def process_ended(self, reason):
+        self.process = None
+        if self.stopped_d is not None:
+            d, self.stopped_d = self.stopped_d, None
+            d.callback(None)
+        elif self.running:
+            log.msg('hash equivalence server exited (%s), restarting in %ds' % (reason.value, self.RESTART_DELAY))
+            self.restart_call = reactor.callLater(self.RESTART_DELAY, self.start_server)
+
+    def stop_server(self):
+        if self.restart_call is not None and self.restart_call.active():
+            self.restart_call.cancel()
+        self.restart_call = None
+        if self.process is None:
+            return defer.succeed(None)
+        self.stopped_d = defer.Deferred()
+        self.process.signalProcess('TERM')
+        return self.stopped_d
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield self.stop_server()
+        yield service.BuildbotService.stopService(self)
@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import shutil
+import optparse
+
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.2'
+
+log = Log(__name__)
+
+MANIFEST = 'manifest.sha256'
+
+
+def read_manifest(dirname):
+    result = {}
+    manifest = os.path.join(dirname, MANIFEST)
+    if not os.path.exists(manifest):
+        return result
+    with open(manifest, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('  ', 1)
+            if len(fields) == 2:
+                result[fields[1]] = fields[0]
+    return result
+
+
+def link_into(src, dst):
+    """
+    Hard-links (or, for symlinks, recreates) src at dst, so the
+    part keeps its copy until the collected build is in place.
+    """
+    dstdir = os.path.dirname(dst)
+    if not os.path.isdir(dstdir):
+        os.makedirs(dstdir)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dst)
+    else:
+        try:
+            os.link(src, dst)
+        except OSError:
+            shutil.copy2(src, dst)
+
+
+def merge_part(partdir, stagedir, manifest):
+    """
+    Links the files (and symlinks) published by one part build into
+    the staging directory, adding their checksums to 'manifest'.
+    A file already supplied by another part is left out, with a
+    warning if its contents differ.  Returns the number of files linked.
+    """
+    partmanifest = read_manifest(partdir)
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(partdir):
+        for name in dirnames + filenames:
+            src = os.path.join(dirpath, name)
+            relpath = os.path.relpath(src, partdir)
+            if name in dirnames and not os.path.islink(src):
+                continue
+            if name in dirnames:
+                dirnames.remove(name)
+            if relpath == MANIFEST:
+                continue
+            dst = os.path.join(stagedir, relpath)
+            if os.path.lexists(dst):
+                if relpath in partmanifest and partmanifest[relpath] != manifest.get(relpath):
+                    log.warn('%s from %s differs from the copy already collected, skipping',
+                             relpath, os.path.basename(partdir))
+                continue
+            link_into(src, dst)
+            if relpath in partmanifest:
+                manifest[relpath] = partmanifest[relpath]
+            log.event('link', relpath, 'Collected %s', relpath)
+            count += 1
+    return count
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] destdir partsdir
+
+Collects the artifacts published by the child builds of a
+distributed build -- one subdirectory of partsdir per MACHINE
+or SDK target -- into a single build directory, destdir, with
+a combined manifest.  Files are hard-linked, not copied, and
+partsdir is removed only once destdir is complete, so a failure
+part-way through leaves the parts as they were.
+""")
+
+    parser.add_option('-e', '--expect', help='comma-separated list of expected parts',
+                      action='store', dest='expect', default='')
+    parser.add_option('-S', '--summarize',
+                      help='summarize per-file operations instead of logging each one',
+                      action='store_true', dest='summarize')
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        raise RuntimeError('destination and parts directories must be specified')
+    log.set_level(options.debug, options.verbose)
+    destdir = os.path.abspath(args[0])
+    partsdir = os.path.abspath(args[1])
+    parts = sorted(os.listdir(partsdir)) if os.path.isdir(partsdir) else []
+    for missing in [p for p in options.expect.split(',') if p and p not in parts]:
+        log.warn('no artifacts published for %s', missing)
+    if not parts:
+        log.note('no artifacts to collect')
+        return 0
+    if os.path.exists(destdir):
+        log.error('destination directory %s already exists', destdir)
+        return 1
+    if options.summarize:
+        log.aggregate()
+    parent = os.path.dirname(destdir)
+    stagedir = os.path.join(parent, '.%s.tmp-%d' % (os.path.basename(destdir), os.getpid()))
+    os.makedirs(stagedir)
+    manifest = {}
+    total = 0
+    try:
+        for part in parts:
+            total += merge_part(os.path.join(partsdir, part), stagedir, manifest)
+        with open(os.path.join(stagedir, MANIFEST), 'w') as f:
+            for relpath in sorted(manifest):
+                f.write('%s  %s\n' % (manifest[relpath], relpath))
+        os.rename(stagedir, destdir)
+    except Exception:
+        shutil.rmtree(stagedir, ignore_errors=True)
+        raise
+    shutil.rmtree(partsdir, ignore_errors=True)
+    log.end_aggregation()
+    log.note('Collected %d files from %d parts (%s) into %s', total, len(parts), ', '.join(parts), destdir)
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
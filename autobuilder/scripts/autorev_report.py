@@ -4,16 +4,19 @@
 
 import os
 import sys
-import re
+import shutil
+import tempfile
 import optparse
 
+import autobuilder.utils.locks as locks
+from autobuilder.utils import archive, buildhistory, histstore
 from autobuilder.utils.logutils import Log
 
-__version__ = '0.1'
+__version__ = '0.3'
 
 log = Log(__name__)
 
-AUTOREV_PAT = re.compile(r'^#\s*SRCREV\s*=\s*"\${AUTOREV}"')
+AUTOREV_PAT = buildhistory.AUTOREV_PAT
 
 
 def is_autorev(info_file):
@@ -31,37 +34,143 @@ def is_autorev(info_file):
     return retval
 
 
+def report_package_changes(db, package, builder):
+    changes = buildhistory.package_changes(db, package, builder)
+    if len(changes) == 0:
+        log.plain('no indexed builds contain package %s' % package)
+        return
+    for bname, tag, pv, pr, pkgsize in changes:
+        log.plain('%s %s: %s %s-%s (%s bytes)' % (bname, tag, package, pv, pr,
+                                                  'unknown' if pkgsize is None else pkgsize))
+
+
+def report_image_size_delta(db, image, builder):
+    deltas = buildhistory.image_size_delta(db, image, builder)
+    if len(deltas) == 0:
+        log.plain('no indexed builds contain image %s' % image)
+        return
+    for bname, machine, reltag, relsize, tag, size in deltas:
+        if reltag is None or relsize is None or size is None:
+            log.plain('%s %s (%s): %s KiB, no release build for comparison' % (bname, image, machine, size))
+        else:
+            log.plain('%s %s (%s): %s KiB in %s, %+d KiB since release %s' % (bname, image, machine, size,
+                                                                               tag, size - relsize, reltag))
+
+
+def report(options, buildhistbase):
+    """
+    Reports (and, with --index, indexes) the AUTOREV recipes
+    in an unpacked buildhistory directory.
+    """
+    if options.index:
+        if not options.builder or not options.build_tag:
+            log.error('--builder and --build-tag are required for indexing')
+            return 1
+        dbfile = os.path.realpath(options.index)
+        lock = locks.lockfile(dbfile + '.lock')
+        try:
+            db = buildhistory.open_index(dbfile)
+            indexer = buildhistory.BuildhistoryIndexer(db, buildhistbase, log)
+            indexer.ingest(options.builder, options.build_tag, imageset=options.imageset,
+                           release=options.release)
+            db.close()
+        finally:
+            locks.unlockfile(lock)
+        log.verbose('indexed buildhistory for %s %s in %s' % (options.builder, options.build_tag, dbfile))
+        autorev_recipes = indexer.autorev_recipes
+    else:
+        autorev_recipes = []
+        for dirpath, _, filenames in os.walk(os.path.join(buildhistbase, 'packages')):
+            if 'latest_srcrev' in filenames:
+                if is_autorev(os.path.join(dirpath, 'latest_srcrev')):
+                    autorev_recipes.append(os.path.basename(dirpath))
+    for recipe in autorev_recipes:
+        log.note('recipe %s uses AUTOREV' % recipe)
+    autorevcount = len(autorev_recipes)
+    log.plain('%d recipe%s use AUTOREV' % (autorevcount, '' if autorevcount == 1 else 's'))
+    return 0
+
+
 def main():
     global log
     parser = optparse.OptionParser(
         version="%prog version " + __version__,
         usage="""%prog [options] buildhistory-dirname
+       %prog --index=dbfile [--builder=name] --package-changes=pkg
+       %prog --index=dbfile [--builder=name] --image-size-delta=image
 
 Generates a report of packages for which AUTOREV was used for
 the source revision during a build, by walking the buildhistory
 directory tree and examining the latest_srcrev files.
+
+With --index, the buildhistory for the build is also recorded in
+an SQLite index database (recipe and package versions, package sizes,
+SRCREVs, and image contents), keyed by --builder and --build-tag.
+The --package-changes and --image-size-delta options query an
+existing index instead of reading a buildhistory directory.
+
+A saved buildhistory archive (in any of the supported archive
+formats), or a tree file from a buildhistory store, may be given
+in place of the buildhistory directory.
 """)
 
     parser.add_option('-d', '--debug', help='increase the debug level',
                       action='count', dest='debug', default=0)
     parser.add_option('-v', '--verbose', help='verbose output',
                       action='store_true', dest='verbose')
+    parser.add_option('-i', '--index', help='buildhistory index database file',
+                      action='store', dest='index')
+    parser.add_option('-b', '--builder', help='builder name for indexing or queries',
+                      action='store', dest='builder')
+    parser.add_option('-t', '--build-tag', help='build tag to record in the index',
+                      action='store', dest='build_tag')
+    parser.add_option('', '--imageset', help='image set name to record in the index',
+                      action='store', dest='imageset')
+    parser.add_option('-r', '--release', help='mark the indexed build as a release build',
+                      action='store_true', dest='release')
+    parser.add_option('-s', '--store-dir', help='buildhistory store for reading a tree file',
+                      action='store', dest='store_dir')
+    parser.add_option('', '--package-changes', help='list builds that changed a package',
+                      action='store', dest='package_changes')
+    parser.add_option('', '--image-size-delta', help='report image size change since the last release',
+                      action='store', dest='image_size_delta')
     options, args = parser.parse_args()
+    log.set_level(options.debug, options.verbose)
+    if options.package_changes or options.image_size_delta:
+        if not options.index or not os.path.exists(options.index):
+            log.error('no buildhistory index database found')
+            return 1
+        db = buildhistory.open_index(options.index)
+        if options.package_changes:
+            report_package_changes(db, options.package_changes, options.builder)
+        if options.image_size_delta:
+            report_image_size_delta(db, options.image_size_delta, options.builder)
+        db.close()
+        return 0
     if len(args) < 1:
         raise RuntimeError('no buildhistory directory name specified')
-    log.set_level(options.debug, options.verbose)
+    if os.path.isfile(args[0]) and args[0].endswith(histstore.TREE_SUFFIX):
+        storedir = options.store_dir or histstore.find_store(args[0])
+        if not storedir:
+            log.error('no buildhistory store found for %s' % args[0])
+            return 1
+        tmpdir = tempfile.mkdtemp(prefix='autorev-report-')
+        try:
+            histstore.HistoryStore(storedir).materialize(args[0], os.path.join(tmpdir, 'buildhistory'))
+            return report(options, os.path.join(tmpdir, 'buildhistory'))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+    if os.path.isfile(args[0]) and archive.detect_format(args[0]) is not None:
+        tmpdir = tempfile.mkdtemp(prefix='autorev-report-')
+        try:
+            archive.extract(args[0], tmpdir)
+            return report(options, os.path.join(tmpdir, 'buildhistory'))
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
     if not os.path.isdir(args[0]):
         log.note('buildhistory directory %s not found, nothing to do' % args[0])
         return 0
-    buildhistbase = os.path.realpath(args[0])
-    autorevcount = 0
-    for dirpath, _, filenames in os.walk(os.path.join(buildhistbase, 'packages')):
-        if 'latest_srcrev' in filenames:
-            if is_autorev(os.path.join(dirpath, 'latest_srcrev')):
-                log.note('recipe %s uses AUTOREV' % os.path.basename(dirpath))
-                autorevcount += 1
-    log.plain('%d recipe%s use AUTOREV' % (autorevcount, '' if autorevcount == 1 else 's'))
-    return 0
+    return report(options, os.path.realpath(args[0]))
 
 
 if __name__ == "__main__":
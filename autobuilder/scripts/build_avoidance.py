@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import optparse
+
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.1'
+
+log = Log(__name__)
+
+FINGERPRINT_FILE = 'build-fingerprint'
+
+
+def read_fingerprint(builddir):
+    try:
+        with open(os.path.join(builddir, FINGERPRINT_FILE)) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def find_previous(outputdir, fingerprint):
+    """
+    Returns the name of the most recent build directory under
+    outputdir that holds a completed build with the given
+    fingerprint, or None.  Symlinks (the 'current' link, and
+    builds that were themselves reused) are not considered.
+    """
+    candidates = []
+    for entry in os.listdir(outputdir):
+        builddir = os.path.join(outputdir, entry)
+        if os.path.islink(builddir) or not os.path.isdir(builddir):
+            continue
+        if read_fingerprint(builddir) == fingerprint:
+            candidates.append((os.path.getmtime(os.path.join(builddir, FINGERPRINT_FILE)), entry))
+    if not candidates:
+        return None
+    return sorted(candidates)[-1][1]
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] check outputdir fingerprint
+       %prog [options] record builddir fingerprint
+       %prog [options] link outputdir previous-tag new-tag
+
+Supports build avoidance for the autobuilder.  A completed build
+records its fingerprint (a hash of the source revision and build
+configuration) in its output directory.  'check' looks through
+the builds published in outputdir for one with a matching
+fingerprint, printing 'Previous build: <tag>' if one is found;
+'link' then makes the new build's tag a symlink to that build.
+""")
+
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    log.set_level(options.debug, options.verbose)
+    if len(args) < 3:
+        raise RuntimeError('missing command or arguments')
+    command = args[0]
+    if command == 'check':
+        outputdir = os.path.realpath(args[1])
+        if not os.path.isdir(outputdir):
+            log.note('no builds published in %s', outputdir)
+            return 0
+        previous = find_previous(outputdir, args[2])
+        if previous is None:
+            log.note('no previous build with fingerprint %s', args[2])
+        else:
+            log.plain('Previous build: %s' % previous)
+    elif command == 'record':
+        builddir = os.path.realpath(args[1])
+        if not os.path.isdir(builddir):
+            log.error('build directory %s not found', builddir)
+            return 1
+        tmpname = os.path.join(builddir, '.' + FINGERPRINT_FILE)
+        with open(tmpname, 'w') as f:
+            f.write(args[2] + '\n')
+        os.rename(tmpname, os.path.join(builddir, FINGERPRINT_FILE))
+        log.verbose('recorded fingerprint %s in %s', args[2], builddir)
+    elif command == 'link':
+        if len(args) < 4:
+            raise RuntimeError('missing new build tag')
+        outputdir = os.path.realpath(args[1])
+        if read_fingerprint(os.path.join(outputdir, args[2])) is None:
+            log.error('no completed build %s in %s', args[2], outputdir)
+            return 1
+        newpath = os.path.join(outputdir, args[3])
+        if os.path.lexists(newpath):
+            log.error('%s already exists', newpath)
+            return 1
+        os.symlink(args[2], newpath)
+        log.note('Linked %s to previous build %s', args[3], args[2])
+    else:
+        raise RuntimeError('unrecognized command: %s' % command)
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
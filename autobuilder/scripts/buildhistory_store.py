@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import optparse
+
+from autobuilder.utils.histstore import HistoryStore, find_store
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.1'
+
+log = Log(__name__)
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] store treefile [buildhistory-dirname]
+       %prog [options] materialize treefile destdir
+
+Saves a buildhistory directory into a shared, content-addressed
+history store, writing a tree file that describes the directory.
+Only files whose contents are not already in the store are added.
+
+The materialize command recreates the buildhistory directory
+described by a tree file from the objects in the store.  If no
+store directory is specified, the store is located by searching
+upward from the tree file for a 'buildhistory-store' directory.
+""")
+
+    parser.add_option('-s', '--store-dir', help='location of the history store',
+                      action='store', dest='store_dir')
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        raise RuntimeError('no command and tree file specified')
+    log.set_level(options.debug, options.verbose)
+    command, treefile = args[0], args[1]
+    storedir = options.store_dir
+    if not storedir and command == 'materialize':
+        storedir = find_store(treefile)
+    if not storedir:
+        log.error('no history store directory specified')
+        return 1
+    store = HistoryStore(os.path.realpath(storedir))
+    if command == 'store':
+        histdir = args[2] if len(args) > 2 else 'buildhistory'
+        if not os.path.isdir(histdir):
+            log.note('buildhistory directory %s not found, nothing to do', histdir)
+            return 0
+        entries, newobjs, written = store.store_tree(histdir, treefile)
+        log.note('Stored %s: %d entries, %d new objects (%d bytes)', histdir, entries, newobjs, written,
+                 entries=entries, new_objects=newobjs, bytes=written)
+    elif command == 'materialize':
+        if len(args) < 3:
+            raise RuntimeError('no destination directory specified')
+        if os.path.exists(args[2]):
+            log.error('destination directory %s already exists', args[2])
+            return 1
+        store.materialize(treefile, args[2])
+        log.verbose('Materialized %s in %s', treefile, args[2])
+    else:
+        log.error('unrecognized command: %s', command)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
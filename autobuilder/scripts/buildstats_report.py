@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import json
+import optparse
+
+from autobuilder.utils import buildstats
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.1'
+
+log = Log(__name__)
+
+PROPERTY_PREFIX = 'Buildstats summary: '
+
+
+def print_summary(summary):
+    log.plain('%d tasks, %.0fs wall time, %.0fs CPU time' % (summary['tasks'], summary['wall'], summary['cpu']))
+    log.plain('Critical path estimate: %.0fs through %d tasks, longest:' % (summary['critical_path']['seconds'],
+                                                                          summary['critical_path']['length']))
+    for name, elapsed in summary['critical_path']['tasks']:
+        log.plain('  %8.1fs  %s' % (elapsed, name))
+    log.plain('Top tasks by wall time:')
+    for name, elapsed in summary['top_wall']:
+        log.plain('  %8.1fs  %s' % (elapsed, name))
+    log.plain('Top tasks by CPU time:')
+    for name, cpu in summary['top_cpu']:
+        log.plain('  %8.1fs  %s' % (cpu, name))
+    log.plain('Top recipes by total task time (wall, CPU):')
+    for recipe, elapsed, cpu in summary['recipes']:
+        log.plain('  %8.1fs %8.1fs  %s' % (elapsed, cpu, recipe))
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] [buildstats-dirname]
+
+Summarizes the bitbake buildstats for a build: overall wall and CPU
+time, the tasks taking the most wall and CPU time, per-recipe totals,
+and an estimate of the critical path.  The directory (default
+tmp/buildstats) may be a single bitbake invocation's BUILDNAME
+directory, or, with --latest, the top-level buildstats directory,
+in which case the most recent invocation is summarized.
+""")
+
+    parser.add_option('-l', '--latest', help='summarize the most recent bitbake invocation',
+                      action='store_true', dest='latest')
+    parser.add_option('-n', '--top', help='number of tasks and recipes to list (default 10)',
+                      action='store', dest='top', type='int', default=10)
+    parser.add_option('-o', '--output', help='also write the summary, as JSON, to this file',
+                      action='store', dest='output')
+    parser.add_option('-p', '--property-line',
+                      help='print the summary as a JSON line for the build step to record',
+                      action='store_true', dest='property_line')
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    log.set_level(options.debug, options.verbose)
+    statsdir = args[0] if len(args) > 0 else 'tmp/buildstats'
+    if options.latest:
+        statsdir = buildstats.latest_buildstats(statsdir)
+    if statsdir is None or not os.path.isdir(statsdir):
+        log.note('no buildstats found, nothing to do')
+        return 0
+    log.verbose('Reading buildstats from %s', statsdir)
+    summary = buildstats.summarize(buildstats.read_buildstats(statsdir), options.top)
+    if summary['tasks'] == 0:
+        log.note('no completed tasks in %s', statsdir)
+        return 0
+    print_summary(summary)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if options.property_line:
+        log.plain(PROPERTY_PREFIX + json.dumps(summary, sort_keys=True))
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
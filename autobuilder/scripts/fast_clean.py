@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import optparse
+import subprocess
+
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.1'
+
+log = Log(__name__)
+
+REAPER_LOCK = '.reaper-lock'
+
+
+def free_space_gb(path):
+    """
+    Returns the free space, in GB, on the filesystem containing path.
+    """
+    st = os.statvfs(path)
+    return float(st.f_bavail * st.f_frsize) / (1024 * 1024 * 1024)
+
+
+def trash_entries(trashdir):
+    if not os.path.isdir(trashdir):
+        return []
+    return [os.path.join(trashdir, e) for e in os.listdir(trashdir) if e != REAPER_LOCK]
+
+
+def _make_writable(func, path, exc_info):
+    """
+    Error handler for shutil.rmtree: entries in the trash can be
+    read-only (sstate, or git objects), so make the containing
+    directory, and the entry itself if it is a directory,
+    accessible, then retry the failed operation once.
+    """
+    try:
+        os.chmod(os.path.dirname(path), 0o700)
+        if os.path.isdir(path) and not os.path.islink(path):
+            os.chmod(path, 0o700)
+        func(path)
+    except OSError as err:
+        log.debug(1, 'could not remove %s: %s', path, err)
+
+
+def remove_entry(entry):
+    if os.path.isdir(entry) and not os.path.islink(entry):
+        shutil.rmtree(entry, onerror=_make_writable)
+    else:
+        try:
+            os.unlink(entry)
+        except OSError as err:
+            _make_writable(os.unlink, entry, err)
+
+
+def empty_trash(trashdir):
+    """
+    Removes everything in the trash directory.  Returns the
+    number of entries actually removed, so callers can tell
+    when a pass has made no progress.
+    """
+    count = 0
+    for entry in trash_entries(trashdir):
+        log.verbose('Removing %s', entry)
+        remove_entry(entry)
+        if os.path.lexists(entry):
+            log.warn('could not completely remove %s', entry)
+        else:
+            count += 1
+    return count
+
+
+def reap(trashdir):
+    """
+    Background reaper: empties the trash directory at idle
+    I/O and CPU priority.  Only one reaper runs at a time
+    for a given trash directory.
+    """
+    lockf = open(os.path.join(trashdir, REAPER_LOCK), 'a+')
+    try:
+        fcntl.flock(lockf.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError) as err:
+        if err.errno in (errno.EAGAIN, errno.EACCES):
+            log.debug(1, 'reaper already running for %s', trashdir)
+            return 0
+        raise
+    os.nice(19)
+    # noinspection PyBroadException
+    try:
+        subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())],
+                        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    except Exception:
+        pass
+    # Loop in case more trash arrives while we're working, stopping
+    # once a pass removes nothing, so an entry that cannot be
+    # deleted doesn't keep us spinning
+    while empty_trash(trashdir) > 0:
+        pass
+    fcntl.flock(lockf.fileno(), fcntl.LOCK_UN)
+    lockf.close()
+    return 0
+
+
+def start_reaper(trashdir):
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, '-m', 'autobuilder.scripts.fast_clean', '--reap', trashdir],
+                     stdin=devnull, stdout=devnull, stderr=devnull,
+                     close_fds=True, preexec_fn=os.setsid)
+    devnull.close()
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] dirname
+
+Quickly cleans out a build directory by renaming it into a trash
+directory on the same filesystem, then starting a background process
+that deletes the trash at idle I/O priority.  The trash directory
+defaults to '.trash' alongside the directory being cleaned.
+
+If free space on the filesystem is below --min-free GB, any trash left
+over from earlier builds is removed before returning, so a build does
+not start on a nearly-full disk.
+""")
+
+    parser.add_option('-t', '--trash-dir', help='trash directory location',
+                      action='store', dest='trash_dir')
+    parser.add_option('-m', '--min-free',
+                      help='free space, in GB, below which old trash is removed synchronously',
+                      action='store', dest='min_free', type='int', default=0)
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    parser.add_option('', '--no-reap', help='do not start the background reaper',
+                      action='store_true', dest='no_reap')
+    parser.add_option('', '--reap', help=optparse.SUPPRESS_HELP,
+                      action='store_true', dest='reap')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        raise RuntimeError('no directory name specified')
+    log.set_level(options.debug, options.verbose)
+    if options.reap:
+        return reap(os.path.realpath(args[0]))
+
+    target = os.path.abspath(args[0])
+    trashdir = os.path.abspath(options.trash_dir or os.path.join(os.path.dirname(target), '.trash'))
+    if not os.path.isdir(trashdir):
+        os.makedirs(trashdir)
+
+    if options.min_free > 0:
+        avail = free_space_gb(trashdir)
+        if avail < options.min_free and len(trash_entries(trashdir)) > 0:
+            log.note('%.1fGB free, less than %dGB: removing old trash', avail, options.min_free)
+            empty_trash(trashdir)
+
+    if os.path.lexists(target):
+        trashname = os.path.join(trashdir, '%s-%d-%d' % (os.path.basename(target), time.time(), os.getpid()))
+        try:
+            os.rename(target, trashname)
+            log.note('Moved %s to %s', target, trashname)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            log.warn('%s is not on the same filesystem as %s, removing directly', target, trashdir)
+            shutil.rmtree(target)
+    else:
+        log.verbose('%s not present', target)
+
+    if not options.no_reap and len(trash_entries(trashdir)) > 0:
+        start_reaper(trashdir)
+        log.verbose('Started background removal of %s', trashdir)
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
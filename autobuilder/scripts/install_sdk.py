@@ -8,11 +8,12 @@ import sys
 import re
 import optparse
 import time
+import collections
 
 from autobuilder.utils.logutils import Log
 from autobuilder.utils import process
 
-__version__ = "0.2.1"
+__version__ = "0.3.0"
 
 log = Log(__name__)
 
@@ -122,10 +123,25 @@ the SDKs that the script can locate.
     parser.add_option('-m', '--machine', help='Target MACHINE name',
                       action='store', dest='machine')
     parser.add_option('', '--image', help='Image name', action='store', dest='image')
+    parser.add_option('-t', '--timeout', help='maximum time, in seconds, for each SDK installation',
+                      action='store', dest='timeout', type='int')
+    parser.add_option('', '--idle-timeout',
+                      help='abort an SDK installation that produces no output for this many seconds',
+                      action='store', dest='idle_timeout', type='int')
+    parser.add_option('-j', '--jobs', help='number of SDKs to install in parallel (default 1)',
+                      action='store', dest='jobs', type='int', default=1)
+    parser.add_option('', '--json-log', help='emit log output as JSON lines',
+                      action='store_true', dest='json_log')
+    parser.add_option('', '--usage-log',
+                      help='append resource usage of executed commands to this file as JSON lines',
+                      action='store', dest='usage_log')
 
     options, args = parser.parse_args()
 
     log.set_level(options.debug, options.verbose)
+    log.set_structured(options.json_log)
+    if options.usage_log:
+        process.record_usage(options.usage_log)
 
     hdir = os.path.realpath(os.path.join(options.history_dir, 'sdk'))
     if not os.path.isdir(hdir):
@@ -176,6 +192,8 @@ the SDKs that the script can locate.
         options.date_stamp = time.strftime("%Y%m%d")
 
     error_count = 0
+    installs = []
+    planned = set()
 
     for sdk in sdklist:
         target = options.machine.replace('_', '-')
@@ -186,14 +204,14 @@ the SDKs that the script can locate.
             else:
                 lastdir = sdk.sdk_version().replace('-snapshot', '') + '-' + options.date_stamp
             destdir = os.path.join(options.install_root, target, lastdir)
-            if os.path.exists(destdir):
+            if os.path.exists(destdir) or destdir in planned:
                 if options.nostamp:
                     log.error("destination directory %s exists - skipping", destdir)
                     error_count += 1
                     break
                 for tagnum in range(99):
                     tag = "-%02d" % (tagnum + 1)
-                    if not os.path.exists(destdir + tag):
+                    if not os.path.exists(destdir + tag) and destdir + tag not in planned:
                         destdir += tag
                         break
                 else:
@@ -202,6 +220,7 @@ the SDKs that the script can locate.
                     error_count += 1
                     continue
                 log.verbose("Destination: %s", destdir)
+            planned.add(destdir)
         else:
             destdir = None
             default_dest = find_default_install_dir(installer)
@@ -216,37 +235,57 @@ the SDKs that the script can locate.
         if options.dry_run:
             log.plain("bash %s%s -y", installer,
                       (" -d %s" % destdir) if destdir else "")
-        else:
-            # noinspection PyBroadException
-            try:
-                if destdir is not None:
-                    cmd = "%s -d %s -y" % (installer, destdir)
-                else:
-                    cmd = "%s -y" % installer
-                log.note("executing %s", cmd)
-                (output, errors) = process.run(cmd)
-                log.plain("%s", output)
-            except Exception:
-                # noinspection PyUnboundLocalVariable
-                log.error("error installing %s:\n%s", sdk.name, errors)
-                error_count += 1
-                continue
+            if destdir is not None and options.update_current:
+                (parent, dest) = os.path.split(destdir)
+                log.plain("ln -snf %s %s", dest, os.path.join(parent, 'current'))
+            continue
 
         if destdir is not None:
+            cmd = "%s -d %s -y" % (installer, destdir)
+        else:
+            cmd = "%s -y" % installer
+        installs.append((sdk, cmd, destdir))
+
+    if len(installs) == 0:
+        return error_count
+
+    def install_runner(cmd, **kwargs):
+        log.note("executing %s", cmd)
+        if options.jobs > 1:
+            prefix = os.path.basename(cmd.split()[0]) + ': '
+        else:
+            prefix = ''
+        return process.run_streaming(cmd, callback=lambda name, line: log.plain("%s%s", prefix, line.rstrip('\n')),
+                                     **kwargs)
+
+    try:
+        results = process.run_parallel([cmd for _, cmd, _ in installs], jobs=options.jobs,
+                                       runner=install_runner, timeout=options.timeout,
+                                       idle_timeout=options.idle_timeout)
+    except process.BatchError as err:
+        results = err.results
+
+    # Several SDKs may share a 'current' symlink; the last one listed wins,
+    # as it would if they were installed one at a time.
+    symlinks = collections.OrderedDict()
+    for (sdk, cmd, destdir), result in zip(installs, results):
+        if isinstance(result, Exception):
+            log.error("error installing %s:\n%s", sdk.name, result)
+            error_count += 1
+            continue
+        if destdir is not None and options.update_current:
             (parent, dest) = os.path.split(destdir)
-            if options.update_current:
-                cmd = "ln -snf %s %s" % (dest, os.path.join(parent, 'current'))
-                if options.dry_run:
-                    log.plain(cmd)
-                    continue
-                else:
-                    # noinspection PyBroadException
-                    try:
-                        log.note("executing %s", cmd)
-                        (output, errors) = process.run(cmd)
-                        log.plain("%s", output)
-                    except Exception:
-                        log.warn("error updating current symlink:\n%s", errors)
+            symlinks[os.path.join(parent, 'current')] = dest
+
+    symlink_cmds = ["ln -snf %s %s" % (dest, link) for link, dest in symlinks.items()]
+    if len(symlink_cmds) > 0:
+        for cmd in symlink_cmds:
+            log.note("executing %s", cmd)
+        try:
+            process.run_parallel(symlink_cmds, jobs=options.jobs)
+        except process.BatchError as err:
+            for result in err.errors:
+                log.warn("error updating current symlink:\n%s", result)
 
     return error_count
 
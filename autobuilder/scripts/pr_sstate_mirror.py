@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import time
+import errno
+import shutil
+import optparse
+
+import autobuilder.utils.locks as locks
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.1'
+
+log = Log(__name__)
+
+PR_PREFIX = 'pr-'
+
+
+def pr_dirname(stagingbase, prnumber):
+    return os.path.join(stagingbase, '%s%s' % (PR_PREFIX, prnumber))
+
+
+def promote(prdir, mirrorbase, dry_run=False):
+    """
+    Moves the shared-state packages a PR build produced into the
+    main mirror, skipping any the mirror already has.  Moves within
+    a filesystem are just renames.  Returns (files promoted, bytes).
+    """
+    count = 0
+    total = 0
+    for dirpath, _, filenames in os.walk(prdir):
+        for filename in filenames:
+            if not (filename.endswith('.tgz') or filename.endswith('.siginfo')):
+                continue
+            stagedfile = os.path.join(dirpath, filename)
+            mirrorfile = os.path.join(mirrorbase, os.path.relpath(stagedfile, prdir))
+            if os.path.islink(stagedfile) or os.path.exists(mirrorfile):
+                continue
+            size = os.path.getsize(stagedfile)
+            if dry_run:
+                log.plain('mv %s %s', stagedfile, mirrorfile)
+            else:
+                mirrordir = os.path.dirname(mirrorfile)
+                if not os.path.isdir(mirrordir):
+                    os.makedirs(mirrordir)
+                try:
+                    os.rename(stagedfile, mirrorfile)
+                except OSError as err:
+                    if err.errno != errno.EXDEV:
+                        raise
+                    shutil.copy2(stagedfile, mirrorfile + '.tmp')
+                    os.rename(mirrorfile + '.tmp', mirrorfile)
+                # Promoted packages start their mirror life as just used
+                os.utime(mirrorfile, None)
+                log.event('copy', mirrorfile, 'Promoted %s', mirrorfile, bytes=size)
+            count += 1
+            total += size
+    return count, total
+
+
+def remove_prdir(prdir, dry_run=False):
+    if dry_run:
+        log.plain('rm -rf %s', prdir)
+    else:
+        log.event('remove', prdir, 'Removing %s', prdir)
+        shutil.rmtree(prdir, ignore_errors=True)
+
+
+def newest_mtime(prdir):
+    newest = os.path.getmtime(prdir)
+    for dirpath, _, filenames in os.walk(prdir):
+        for filename in filenames:
+            newest = max(newest, os.path.getmtime(os.path.join(dirpath, filename)))
+    return newest
+
+
+def expire(stagingbase, max_age, dry_run=False):
+    """
+    Removes the staging directories of PRs that have not been built
+    for max_age days (PRs that were abandoned, or whose close event
+    was missed).  Returns the number of directories removed.
+    """
+    count = 0
+    cutoff = time.time() - max_age * 86400
+    for entry in sorted(os.listdir(stagingbase)):
+        prdir = os.path.join(stagingbase, entry)
+        if not entry.startswith(PR_PREFIX) or not os.path.isdir(prdir):
+            continue
+        if newest_mtime(prdir) < cutoff:
+            remove_prdir(prdir, dry_run)
+            count += 1
+    return count
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] staging-dirname
+
+Manages a staging shared-state mirror for pull request builds.
+Each PR's builds write the sstate packages they create into their
+own pr-<number> subdirectory of the staging mirror.
+
+  --promote=N moves PR N's packages into the main mirror (--mirror)
+              after the PR has been merged, then removes its directory
+  --discard=N removes PR N's directory without promoting anything
+  --expire    removes the directories of PRs that have not been
+              built for --max-age days
+
+--expire may be combined with --promote or --discard.
+""")
+
+    parser.add_option('-p', '--promote', help='promote the packages for a merged PR',
+                      action='store', dest='promote')
+    parser.add_option('-x', '--discard', help='discard the packages for a closed PR',
+                      action='store', dest='discard')
+    parser.add_option('-m', '--mirror', help='main sstate mirror location (for --promote)',
+                      action='store', dest='mirror')
+    parser.add_option('-e', '--expire', help='remove directories for inactive PRs',
+                      action='store_true', dest='expire')
+    parser.add_option('-a', '--max-age', help='age, in days, after which inactive PRs expire (default 14)',
+                      action='store', dest='max_age', type='int', default=14)
+    parser.add_option('-n', '--dry-run', help='display commands instead of executing them',
+                      action='store_true', dest='dry_run')
+    parser.add_option('-S', '--summarize',
+                      help='summarize per-file operations instead of logging each one',
+                      action='store_true', dest='summarize')
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        raise RuntimeError('no staging mirror directory name specified')
+    log.set_level(options.debug, options.verbose)
+    stagingbase = os.path.realpath(args[0])
+    if not os.path.isdir(stagingbase):
+        log.note('staging mirror %s not found, nothing to do', stagingbase)
+        return 0
+    if options.summarize:
+        log.aggregate()
+    if options.promote:
+        if not options.mirror:
+            log.error('--mirror is required for --promote')
+            return 1
+        prdir = pr_dirname(stagingbase, options.promote)
+        if os.path.isdir(prdir):
+            mirrorbase = os.path.realpath(options.mirror)
+            # Same lock as update-sstate-mirror, so promotion doesn't race mirror updates
+            lock = locks.lockfile(os.path.join(mirrorbase, '.updatelock'))
+            try:
+                count, total = promote(prdir, mirrorbase, options.dry_run)
+            finally:
+                locks.unlockfile(lock)
+            remove_prdir(prdir, options.dry_run)
+            log.note('Promoted %d packages (%d bytes) from PR %s', count, total, options.promote)
+        else:
+            log.note('no staged packages for PR %s', options.promote)
+    elif options.discard:
+        prdir = pr_dirname(stagingbase, options.discard)
+        if os.path.isdir(prdir):
+            remove_prdir(prdir, options.dry_run)
+            log.note('Discarded staged packages for PR %s', options.discard)
+    if options.expire:
+        count = expire(stagingbase, options.max_age, options.dry_run)
+        log.note('Expired %d inactive PR staging director%s', count, 'y' if count == 1 else 'ies')
+    log.end_aggregation()
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
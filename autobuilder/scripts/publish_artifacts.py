@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import optparse
+from concurrent.futures import ThreadPoolExecutor
+
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.2'
+
+log = Log(__name__)
+
+MANIFEST = 'manifest.sha256'
+BUFSIZE = 1024 * 1024
+
+
+def read_manifest(dirname):
+    """
+    Reads the checksum manifest from a published build directory,
+    returning a dict mapping relative path to sha256 checksum.
+    """
+    result = {}
+    manifest = os.path.join(dirname, MANIFEST)
+    if not os.path.exists(manifest):
+        return result
+    with open(manifest, 'r') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('  ', 1)
+            if len(fields) == 2:
+                result[fields[1]] = fields[0]
+    return result
+
+
+def find_previous(parent, exclude):
+    """
+    Locates the most recently published build directory under
+    parent (other than exclude), identified by its manifest.
+    """
+    best = None
+    besttime = 0
+    if not os.path.isdir(parent):
+        return None
+    for entry in os.listdir(parent):
+        path = os.path.join(parent, entry)
+        if path == exclude or entry.startswith('.') or os.path.islink(path):
+            continue
+        manifest = os.path.join(path, MANIFEST)
+        if os.path.exists(manifest):
+            mtime = os.path.getmtime(manifest)
+            if mtime > besttime:
+                best, besttime = path, mtime
+    return best
+
+
+def checksum(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            buf = f.read(BUFSIZE)
+            if not buf:
+                break
+            h.update(buf)
+    return h.hexdigest()
+
+
+def copy_with_checksum(src, dst):
+    """
+    Copies src to dst, computing the sha256 checksum of the
+    contents on the way through.
+    """
+    h = hashlib.sha256()
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            while True:
+                buf = fsrc.read(BUFSIZE)
+                if not buf:
+                    break
+                h.update(buf)
+                fdst.write(buf)
+    shutil.copystat(src, dst)
+    return h.hexdigest()
+
+
+class Publisher(object):
+    def __init__(self, stagedir, previous):
+        self.stagedir = stagedir
+        self.previous = previous
+        self.prev_manifest = read_manifest(previous) if previous else {}
+
+    def publish_file(self, src, relpath):
+        """
+        Publishes one file, hardlinking it to the previous build's copy
+        if the contents are identical.  Returns (relpath, checksum, linked).
+        """
+        dst = os.path.join(self.stagedir, relpath)
+        prevsum = self.prev_manifest.get(relpath)
+        if prevsum is not None:
+            prevfile = os.path.join(self.previous, relpath)
+            try:
+                same_size = os.path.getsize(prevfile) == os.path.getsize(src)
+            except OSError:
+                same_size = False
+            if same_size:
+                cksum = checksum(src)
+                if cksum == prevsum:
+                    try:
+                        os.link(prevfile, dst)
+                        return relpath, cksum, True
+                    except OSError as err:
+                        if err.errno not in (errno.EXDEV, errno.EMLINK, errno.EPERM):
+                            raise
+        return relpath, copy_with_checksum(src, dst), False
+
+    def publish(self, deploydir, subdirs, jobs):
+        """
+        Copies the named subdirectories of deploydir into the staging
+        directory using a pool of workers, then writes the manifest.
+        Returns (files copied, files linked).
+        """
+        files = []
+        for subdir in subdirs:
+            srcbase = os.path.join(deploydir, subdir)
+            if not os.path.isdir(srcbase):
+                log.debug(1, 'no %s directory in %s', subdir, deploydir)
+                continue
+            for dirpath, dirnames, filenames in os.walk(srcbase):
+                reldir = os.path.relpath(dirpath, deploydir)
+                os.makedirs(os.path.join(self.stagedir, reldir))
+                for name in dirnames + filenames:
+                    src = os.path.join(dirpath, name)
+                    relpath = os.path.join(reldir, name)
+                    if os.path.islink(src):
+                        os.symlink(os.readlink(src), os.path.join(self.stagedir, relpath))
+                        if name in dirnames:
+                            dirnames.remove(name)
+                    elif name in filenames:
+                        files.append((src, relpath))
+        results = []
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for result in executor.map(lambda f: self.publish_file(*f), files):
+                relpath, _, linked = result
+                log.event('link' if linked else 'copy', relpath, '%s %s',
+                          'Linked' if linked else 'Copied', relpath)
+                results.append(result)
+        with open(os.path.join(self.stagedir, MANIFEST), 'w') as f:
+            for relpath, cksum, _ in sorted(results):
+                f.write('%s  %s\n' % (cksum, relpath))
+        linkcount = len([r for r in results if r[2]])
+        return len(results) - linkcount, linkcount
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] destdir subdir...
+
+Publishes build artifacts from the named subdirectories of the
+deploy directory into destdir.  Files are copied by multiple workers
+into a staging directory alongside destdir; files identical to those
+published by the previous build are hardlinked instead of copied.
+A manifest of sha256 checksums (manifest.sha256) is written, and the staging
+directory is then renamed to destdir.
+
+The previous build defaults to the most recently published sibling
+of destdir (or, with --search-dir, entry of that directory) that has
+a manifest.
+""")
+
+    parser.add_option('-D', '--deploy-dir',
+                      help='location of deploy directory (default is tmp/deploy)',
+                      action='store', dest='deploy_dir', default='tmp/deploy')
+    parser.add_option('-p', '--previous', help='previously published build directory',
+                      action='store', dest='previous')
+    parser.add_option('-s', '--search-dir', help='directory to search for the previous build',
+                      action='store', dest='search_dir')
+    parser.add_option('-j', '--jobs', help='number of copy workers (default 4)',
+                      action='store', dest='jobs', type='int', default=4)
+    parser.add_option('-S', '--summarize',
+                      help='summarize per-file operations instead of logging each one',
+                      action='store_true', dest='summarize')
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    if len(args) < 1:
+        raise RuntimeError('no destination directory specified')
+    log.set_level(options.debug, options.verbose)
+    if options.summarize:
+        log.aggregate()
+    deploydir = os.path.realpath(options.deploy_dir)
+    if not os.path.isdir(deploydir):
+        log.note('deploy directory %s not found, nothing to do', deploydir)
+        return 0
+    destdir = os.path.abspath(args[0])
+    subdirs = [a for a in ' '.join(args[1:]).split() if a]
+    if os.path.exists(destdir):
+        log.error('destination directory %s already exists', destdir)
+        return 1
+    parent = os.path.dirname(destdir)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    previous = options.previous or find_previous(os.path.abspath(options.search_dir or parent), destdir)
+    if previous:
+        log.note('Linking files unchanged since %s', previous)
+    stagedir = os.path.join(parent, '.%s.tmp-%d' % (os.path.basename(destdir), os.getpid()))
+    os.makedirs(stagedir)
+    try:
+        copied, linked = Publisher(stagedir, previous).publish(deploydir, subdirs, options.jobs)
+        os.rename(stagedir, destdir)
+    except Exception:
+        shutil.rmtree(stagedir, ignore_errors=True)
+        raise
+    log.end_aggregation()
+    log.note('Published %s: %d files copied, %d unchanged files linked', destdir, copied, linked)
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
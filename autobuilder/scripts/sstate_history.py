@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import json
+import optparse
+
+import autobuilder.utils.locks as locks
+from autobuilder.utils import sstate_history
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.2'
+
+log = Log(__name__)
+
+
+def _pct(rate):
+    return 'n/a' if rate is None else '%.1f%%' % (rate * 100.0)
+
+
+def report(db, builder, machine, limit):
+    for tag, _, counts in sstate_history.history(db, builder, machine, limit):
+        log.plain('%s %s %s: wanted %s local %s mirrors %s missed %s (%s, mirror %s)' % (
+            builder, machine, tag, counts['wanted'], counts['local'], counts['mirrors'],
+            counts['missed'], _pct(sstate_history.hit_rate(counts)),
+            _pct(sstate_history.mirror_hit_rate(counts))))
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] --builder=name --build-tag=tag counts
+       %prog [options] --builder=name --report=machine
+
+Records the sstate counts for a build in the history database.
+The counts argument is a JSON object mapping each machine to its
+counts (wanted, local, mirrors, missed, current), as collected from
+the bitbake 'Sstate summary' lines.  The mirror hit rate for each
+machine -- the fraction of the objects not in the local cache that
+were found on a mirror -- is compared with the median of the previous
+builds, and a drop of more than the threshold is reported as a warning.
+
+With --report, the recorded history for a machine is listed instead.
+""")
+
+    parser.add_option('-D', '--db', help='sstate history database file',
+                      action='store', dest='db')
+    parser.add_option('-b', '--builder', help='builder name',
+                      action='store', dest='builder')
+    parser.add_option('-t', '--build-tag', help='build tag to record',
+                      action='store', dest='build_tag')
+    parser.add_option('-w', '--window', help='number of earlier builds to compare against (default 5)',
+                      action='store', dest='window', type='int', default=5)
+    parser.add_option('-T', '--threshold', help='mirror hit rate drop, in percent, to warn about (default 20)',
+                      action='store', dest='threshold', type='float', default=20.0)
+    parser.add_option('-r', '--report', help='list recorded history for a machine',
+                      action='store', dest='report')
+    parser.add_option('-n', '--limit', help='number of builds to list with --report',
+                      action='store', dest='limit', type='int', default=20)
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    log.set_level(options.debug, options.verbose)
+    if not options.db or not options.builder:
+        log.error('--db and --builder are required')
+        return 1
+    dbfile = os.path.realpath(options.db)
+    if options.report:
+        if not os.path.exists(dbfile):
+            log.error('no sstate history database found')
+            return 1
+        db = sstate_history.open_history(dbfile)
+        report(db, options.builder, options.report, options.limit)
+        db.close()
+        return 0
+
+    if len(args) < 1 or not options.build_tag:
+        raise RuntimeError('no build tag or counts specified')
+    counts = json.loads(args[0]) if args[0] else {}
+    if not counts:
+        log.note('no sstate counts recorded for this build, nothing to do')
+        return 0
+    lock = locks.lockfile(dbfile + '.lock')
+    try:
+        db = sstate_history.open_history(dbfile)
+        for machine in sorted(counts):
+            sstate_history.record(db, options.builder, options.build_tag, machine, counts[machine])
+            rate, baseline, dropped = sstate_history.check_drop(db, options.builder, options.build_tag, machine,
+                                                                options.window, options.threshold / 100.0)
+            if dropped:
+                log.warn('%s: sstate mirror hit rate dropped to %s (from a median of %s over recent builds)',
+                         machine, _pct(rate), _pct(baseline))
+            else:
+                log.plain('%s: sstate mirror hit rate %s (recent median %s)' % (machine, _pct(rate),
+                                                                                 _pct(baseline)))
+        db.close()
+    finally:
+        locks.unlockfile(lock)
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
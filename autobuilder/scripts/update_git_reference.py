@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import time
+import optparse
+
+import autobuilder.utils.locks as locks
+from autobuilder.utils import process
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.1'
+
+log = Log(__name__)
+
+
+def git(refrepo, *args, **kwargs):
+    output, _ = process.run(['git', '--git-dir=' + refrepo] + list(args), **kwargs)
+    return process._text(output)
+
+
+def objects_size(refrepo):
+    total = 0
+    for dirpath, _, filenames in os.walk(os.path.join(refrepo, 'objects')):
+        for filename in filenames:
+            total += os.path.getsize(os.path.join(dirpath, filename))
+    return total
+
+
+def resolve_url(baseurl, url):
+    """
+    Resolves a submodule URL, which may be relative
+    to the URL of the superproject.
+    """
+    if not (url.startswith('./') or url.startswith('../')):
+        return url
+    base = baseurl.rstrip('/')
+    while True:
+        if url.startswith('./'):
+            url = url[2:]
+        elif url.startswith('../'):
+            url = url[3:]
+            base = base.rsplit('/', 1)[0]
+        else:
+            break
+    return base + '/' + url
+
+
+def init_reference(refrepo, url):
+    if not os.path.isdir(refrepo):
+        log.note('Creating reference repository %s', refrepo)
+        process.run(['git', 'init', '--quiet', '--bare', refrepo])
+        # Checkouts borrow objects from here, so never prune any
+        git(refrepo, 'config', 'gc.pruneExpire', 'never')
+        git(refrepo, 'remote', 'add', '--no-tags', 'origin', url)
+    elif git(refrepo, 'config', 'remote.origin.url').strip() != url:
+        git(refrepo, 'remote', 'set-url', 'origin', url)
+
+
+def fetch(refrepo):
+    log.verbose('fetching into %s', refrepo)
+    try:
+        git(refrepo, 'fetch', '--quiet', 'origin')
+    except process.CmdError as err:
+        # A stale reference just means more to fetch at checkout
+        log.warn('%s', err)
+
+
+def submodules(refrepo, uri, branch):
+    """
+    Returns (name, URL) for each submodule listed in .gitmodules
+    on 'branch' of the superproject.  Only the top level of
+    submodules is covered.
+    """
+    rev = 'refs/remotes/origin/%s:.gitmodules' % branch
+    try:
+        output = git(refrepo, 'config', '--blob', rev, '--get-regexp', r'^submodule\..*\.url$')
+    except process.CmdError:
+        return []
+    result = []
+    for line in output.splitlines():
+        key, _, url = line.partition(' ')
+        if url:
+            result.append((key[len('submodule.'):-len('.url')], resolve_url(uri, url.strip())))
+    return result
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] refrepo uri
+
+Creates or updates a bare reference repository on the worker,
+for checkouts to borrow objects from (git clone --reference),
+so each build only fetches the commits the reference lacks.
+With --submodules, the submodules listed in the superproject's
+.gitmodules get reference repositories under refrepo/modules/<name>,
+where git finds them when submodule.alternateLocation is set to
+'superproject'.
+
+The number of bytes added to the reference repository and the
+time taken are reported on a 'Reference statistics' line.
+""")
+
+    parser.add_option('-b', '--branch', help='branch to read .gitmodules from (default master)',
+                      action='store', dest='branch', default='master')
+    parser.add_option('-s', '--submodules', help='also fetch submodule repositories',
+                      action='store_true', dest='submodules')
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        raise RuntimeError('reference repository path and URI must be specified')
+    log.set_level(options.debug, options.verbose)
+    refrepo = os.path.abspath(args[0])
+    uri = args[1]
+    starttime = time.time()
+    lock = locks.lockfile(refrepo + '.lock')
+    try:
+        init_reference(refrepo, uri)
+        before = objects_size(refrepo)
+        fetch(refrepo)
+        added = objects_size(refrepo) - before
+        if options.submodules:
+            for name, url in submodules(refrepo, uri, options.branch):
+                smrepo = os.path.join(refrepo, 'modules', name)
+                init_reference(smrepo, url)
+                before = objects_size(smrepo)
+                fetch(smrepo)
+                added += objects_size(smrepo) - before
+    finally:
+        locks.unlockfile(lock)
+    log.plain('Reference statistics: bytes=%d seconds=%d' % (added, int(time.time() - starttime)))
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# Copyright 2018 by Matthew Madison
+# Distributed under license.
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import optparse
+
+import autobuilder.utils.locks as locks
+from autobuilder.utils.logutils import Log
+
+__version__ = '0.1'
+
+log = Log(__name__)
+
+TIERS = ['local', 'shared', 'none']
+
+
+def _under(path, topdir):
+    return topdir is not None and (path + os.sep).startswith(topdir + os.sep)
+
+
+def cache_entries(cachedir, kind):
+    """
+    Yields the paths, relative to cachedir, of the files that
+    the local cache tier holds: shared-state packages for the
+    sstate cache, or top-level download files (not their
+    .done and .lock markers) for the downloads cache.
+    """
+    if kind == 'downloads':
+        for name in sorted(os.listdir(cachedir)):
+            path = os.path.join(cachedir, name)
+            if name.endswith('.done') or name.endswith('.lock') or name.startswith('.'):
+                continue
+            if os.path.isfile(path):
+                yield name
+        return
+    for dirpath, _, filenames in os.walk(cachedir):
+        for filename in filenames:
+            if filename.endswith('.siginfo') or '.tgz' in filename or '.tar.' in filename:
+                yield os.path.relpath(os.path.join(dirpath, filename), cachedir)
+
+
+def copy_into(src, dst):
+    dstdir = os.path.dirname(dst)
+    if not os.path.isdir(dstdir):
+        os.makedirs(dstdir)
+    fd, tmpname = tempfile.mkstemp(dir=dstdir, prefix='.tmp-')
+    os.close(fd)
+    try:
+        shutil.copy2(src, tmpname)
+        os.rename(tmpname, dst)
+    except Exception:
+        os.unlink(tmpname)
+        raise
+    # Copied objects count as just used for LRU purposes
+    os.utime(dst, None)
+
+
+def update_cache(cachedir, localdir, shareddir, kind, dry_run=False):
+    """
+    Classifies each object in the build's cache by the tier it came
+    from -- symlinks into the local cache or the shared mirror are hits
+    in those tiers, regular files were produced (or fetched) by the
+    build -- and copies anything not already in the local cache there.
+    Local hits are touched in both tiers, so neither ages them out.
+    Returns (hits per tier, files copied, bytes copied).
+    """
+    hits = dict((tier, 0) for tier in TIERS)
+    copied = 0
+    copied_bytes = 0
+    for relpath in cache_entries(cachedir, kind):
+        path = os.path.join(cachedir, relpath)
+        target = os.path.realpath(path)
+        if os.path.islink(path) and _under(target, localdir):
+            hits['local'] += 1
+            log.event('hit', relpath, 'Local cache hit: %s', relpath)
+            if not dry_run:
+                for tierfile in [target, os.path.join(shareddir, os.path.relpath(target, localdir))
+                                 if shareddir else None]:
+                    if tierfile and os.path.exists(tierfile):
+                        # noinspection PyBroadException
+                        try:
+                            os.utime(tierfile, None)
+                        except Exception:
+                            log.warn('Error occurred trying to update %s', tierfile)
+            continue
+        if os.path.islink(path) and _under(target, shareddir):
+            hits['shared'] += 1
+        else:
+            hits['none'] += 1
+        localfile = os.path.join(localdir, relpath)
+        if not os.path.exists(target) or os.path.exists(localfile):
+            continue
+        size = os.path.getsize(target)
+        if dry_run:
+            log.plain('cp %s %s', target, localfile)
+        else:
+            try:
+                copy_into(target, localfile)
+            except (IOError, OSError) as err:
+                log.warn('Error occurred (errno=%d) copying %s to %s', err.errno, target, localfile)
+                continue
+        log.event('copy', localfile, 'Copied %s to local cache', relpath, bytes=size)
+        copied += 1
+        copied_bytes += size
+    return hits, copied, copied_bytes
+
+
+def prune_cache(localdir, max_bytes, dry_run=False):
+    """
+    Removes the least recently used files from the local cache
+    until its total size is at most max_bytes.  Returns
+    (files removed, bytes removed).
+    """
+    entries = []
+    total = 0
+    for dirpath, _, filenames in os.walk(localdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.startswith('.') or os.path.islink(path):
+                continue
+            st = os.stat(path)
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    removed = 0
+    removed_bytes = 0
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        if dry_run:
+            log.plain('rm -f %s', path)
+        else:
+            log.event('remove', path, 'Removing: %s', path, bytes=size)
+            os.unlink(path)
+        total -= size
+        removed += 1
+        removed_bytes += size
+    return removed, removed_bytes
+
+
+def main():
+    global log
+    parser = optparse.OptionParser(
+        version="%prog version " + __version__,
+        usage="""%prog [options] cachedir localdir [shareddir]
+
+Maintains a worker-local cache tier in front of a shared sstate or
+downloads mirror.  The build's cache directory (sstate-cache or
+downloads) is examined to count the objects that came from the local
+cache, from the shared mirror, and from neither; objects not already
+in the local cache are copied there, and the local cache is then
+trimmed to its size limit, removing the least recently used files
+first.
+""")
+
+    parser.add_option('-k', '--kind', help='kind of cache: sstate (default) or downloads',
+                      action='store', dest='kind', default='sstate', choices=['sstate', 'downloads'])
+    parser.add_option('-m', '--max-size', help='size limit for the local cache, in GB (default 100)',
+                      action='store', dest='max_size', type='int', default=100)
+    parser.add_option('-n', '--dry-run', help='do not perform any copies or removals',
+                      action='store_true', dest='dry_run')
+    parser.add_option('-S', '--summarize',
+                      help='summarize per-file operations instead of logging each one',
+                      action='store_true', dest='summarize')
+    parser.add_option('-d', '--debug', help='increase the debug level',
+                      action='count', dest='debug', default=0)
+    parser.add_option('-v', '--verbose', help='verbose output',
+                      action='store_true', dest='verbose')
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        raise RuntimeError('cache and local cache directories must be specified')
+    log.set_level(options.debug, options.verbose)
+    cachedir = os.path.realpath(args[0])
+    if not os.path.isdir(cachedir):
+        log.note('%s not found, nothing to do', args[0])
+        return 0
+    localdir = os.path.realpath(args[1])
+    shareddir = os.path.realpath(args[2]) if len(args) > 2 and args[2] else None
+    if not os.path.isdir(localdir):
+        os.makedirs(localdir)
+    if options.summarize:
+        log.aggregate()
+    starttime = time.time()
+    lock = locks.lockfile(os.path.join(localdir, '.lock'))
+    try:
+        hits, copied, copied_bytes = update_cache(cachedir, localdir, shareddir, options.kind, options.dry_run)
+        removed, removed_bytes = prune_cache(localdir, options.max_size * 1024 * 1024 * 1024, options.dry_run)
+    finally:
+        locks.unlockfile(lock)
+    log.end_aggregation()
+    total = sum(hits.values())
+    log.note('%s: %d objects, %d from local cache, %d from shared mirror, %d in neither',
+             options.kind, total, hits['local'], hits['shared'], hits['none'],
+             local_hits=hits['local'], shared_hits=hits['shared'], misses=hits['none'])
+    log.note('%s: copied %d files (%d bytes) to local cache, pruned %d files (%d bytes) in %.1fs',
+             options.kind, copied, copied_bytes, removed, removed_bytes, time.time() - starttime)
+    return 0
+
+
+if __name__ == "__main__":
+    # noinspection PyBroadException
+    try:
+        ret = main()
+        sys.exit(ret)
+    except SystemExit:
+        pass
+    except Exception:
+        import traceback
+
+        traceback.print_exc(5)
+        sys.exit(1)
@@ -8,6 +8,7 @@ import re
 import stat
 import optparse
 import shutil
+import time
 import autobuilder.utils.locks as locks
 from datetime import date, timedelta
 from autobuilder.utils.logutils import Log
@@ -38,7 +39,7 @@ def do_cleanup(mirrorbase, subdir, options):
             if os.path.islink(mirrorfile):
                 log.warn('Found symlink in mirror: %s', mirrorfile)
                 if not options.dry_run:
-                    log.verbose('Removing symlink from mirror: %s', mirrorfile)
+                    log.event('remove', mirrorfile, 'Removing symlink from mirror: %s', mirrorfile)
                     os.unlink(mirrorfile)
                 continue
             statinfo = os.stat(mirrorfile)
@@ -57,7 +58,7 @@ def do_cleanup(mirrorbase, subdir, options):
                 if options.dry_run:
                     log.plain('rm -f %s', mirrorfile)
                 else:
-                    log.verbose('Removing: %s', mirrorfile)
+                    log.event('remove', mirrorfile, 'Removing: %s', mirrorfile, bytes=statinfo.st_size)
                     os.unlink(mirrorfile)
     return removal_count
 
@@ -85,7 +86,7 @@ def do_copy(cachebase, subdir, mirrorbase, options):
                 if not options.touch:
                     continue
                 mirrorfile = os.path.realpath(os.readlink(cachefile))
-                log.verbose('Updating modification time of %s', mirrorfile)
+                log.event('touch', mirrorfile, 'Updating modification time of %s', mirrorfile)
                 if options.dry_run:
                     log.plain('touch %s', mirrorfile)
                 else:
@@ -100,17 +101,24 @@ def do_copy(cachebase, subdir, mirrorbase, options):
             relpath = os.path.relpath(cachefile, cachebase)
             mirrorfile = os.path.join(mirrorbase, relpath)
             mirrordir = os.path.dirname(mirrorfile)
+            # Files left over from an earlier build in a retained build
+            # directory will already be in the mirror.
+            if os.path.exists(mirrorfile) and os.path.getsize(mirrorfile) == os.path.getsize(cachefile):
+                log.debug(2, 'Already in mirror: %s', cachefile)
+                continue
             copy_count += 1
             if options.dry_run:
                 log.plain('test -d %s || mkdir -p %s', mirrordir, mirrordir)
                 log.plain('cp %s %s', cachefile, mirrordir)
             else:
-                log.verbose('Copying %s to %s', cachefile, mirrordir)
                 if not os.path.isdir(mirrordir):
                     os.makedirs(mirrordir)
                 try:
+                    starttime = time.time()
                     shutil.copy(cachefile, mirrorfile)
-                except IOError as err:
+                    log.event('copy', mirrorfile, 'Copying %s to %s', cachefile, mirrordir,
+                              bytes=os.path.getsize(mirrorfile), duration=time.time() - starttime)
+                except (IOError, OSError) as err:
                     log.warn('Error occurred (errno=%d) copying %s to %s',
                              err.errno, cachefile, mirrorfile)
     return copy_count
@@ -151,6 +159,14 @@ packages.
                       action='count', dest='debug', default=0)
     parser.add_option('-v', '--verbose', help='verbose output',
                       action='store_true', dest='verbose')
+    parser.add_option('-S', '--summarize',
+                      help='summarize per-file operations instead of logging each one',
+                      action='store_true', dest='summarize')
+    parser.add_option('', '--detail-log',
+                      help='write per-file operations to this gzip-compressed file',
+                      action='store', dest='detail_log')
+    parser.add_option('', '--json-log', help='emit log output as JSON lines',
+                      action='store_true', dest='json_log')
     parser.add_option('-t', '--touch', help='touch symlinked files and use mtime for pruning checks',
                       action='store_true', dest='touch')
     parser.add_option('-n', '--dry-run',
@@ -168,6 +184,9 @@ packages.
         else:
             raise RuntimeError('sstate-mirror directory %s not found' % args[0])
     log.set_level(options.debug, options.verbose)
+    log.set_structured(options.json_log)
+    if options.summarize or options.detail_log:
+        log.aggregate(detail_file=options.detail_log)
     mirrorbase = os.path.realpath(args[0])
     lock = locks.lockfile(os.path.join(mirrorbase, '.updatelock'))
     if not lock:
@@ -186,6 +205,7 @@ packages.
             log.note('sstate-cache directory %s not found - nothing to do',
                      options.sstate_dir)
             locks.unlockfile(lock)
+            log.end_aggregation()
             return 0
         lsbstr = None
         twohex = re.compile(r'^[0-9a-f][0-9a-f]$')
@@ -214,6 +234,7 @@ packages.
         else:
             log.note('Copied %d new entries', cpcount)
         locks.unlockfile(lock)
+    log.end_aggregation()
     return 0
 
 
@@ -0,0 +1,72 @@
+# Copyright (c) 2018 Matthew Madison
+# Distributed under license
+
+"""
+archive
+
+Helpers for the tar archives (stamps, buildhistory) saved
+with each build's artifacts.  The compression format is
+configurable per distro; the format of an existing archive
+is identified by its file name suffix, which is also what
+gets recorded in the artifact manifest.
+"""
+
+import os
+
+from autobuilder.utils import process
+
+# format name -> (file suffix, compressor for creating, tar option for extracting)
+FORMATS = {
+    'gzip': ('.tar.gz', None, '-z'),
+    'pigz': ('.tar.gz', 'pigz', '-z'),
+    'zstd': ('.tar.zst', 'zstd', '--use-compress-program=zstd'),
+    'xz': ('.tar.xz', 'xz', '-J'),
+}
+
+DEFAULT_FORMAT = 'gzip'
+
+
+def archive_suffix(fmt):
+    return FORMATS[fmt][0]
+
+
+def compress_option(fmt, threads=0):
+    """
+    Returns the tar option for creating an archive in format
+    'fmt' using 'threads' compression threads (0 meaning one per
+    CPU, for the compressors that support multithreading).
+    """
+    compressor = FORMATS[fmt][1]
+    if compressor is None:
+        return '-z'
+    if fmt == 'pigz':
+        if threads > 0:
+            compressor += ' -p %d' % threads
+    else:
+        compressor += ' -T%d' % threads
+    return "--use-compress-program='%s'" % compressor
+
+
+def detect_format(filename):
+    """
+    Returns the name of the format of an archive, based on its
+    suffix, or None if the file is not a recognized archive.
+    """
+    if filename.endswith('.tgz'):
+        return DEFAULT_FORMAT
+    for fmt in sorted(FORMATS):
+        if filename.endswith(FORMATS[fmt][0]):
+            return fmt
+    return None
+
+
+def extract(filename, destdir):
+    """
+    Unpacks an archive of any supported format into destdir.
+    """
+    fmt = detect_format(filename)
+    if fmt is None:
+        raise RuntimeError('unrecognized archive format: %s' % filename)
+    if not os.path.exists(destdir):
+        os.makedirs(destdir)
+    process.run(['tar', '-x', FORMATS[fmt][2], '-f', filename, '-C', destdir])
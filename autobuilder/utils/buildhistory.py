@@ -0,0 +1,287 @@
+# Copyright (c) 2018 Matthew Madison
+# Distributed under license
+
+"""
+buildhistory
+
+Support for indexing the contents of a bitbake buildhistory
+directory into an SQLite database, so that questions about
+package versions, sizes, source revisions, and image contents
+across builds can be answered without unpacking the per-build
+buildhistory tarballs.
+
+Each build is ingested once, keyed by builder name and build tag;
+re-ingesting the same build replaces its earlier entries.
+"""
+
+import os
+import re
+import time
+import sqlite3
+
+VAR_PAT = re.compile(r'^([A-Za-z0-9_\-:.\[\]${}]+)\s*=\s*(.*)$')
+AUTOREV_PAT = re.compile(r'^#\s*SRCREV\s*=\s*"\${AUTOREV}"')
+SRCREV_PAT = re.compile(r'^(SRCREV(?:_\S+)?)\s*=\s*"(.*)"')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS builds (
+    id INTEGER PRIMARY KEY,
+    builder TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    imageset TEXT,
+    release INTEGER NOT NULL DEFAULT 0,
+    timestamp INTEGER NOT NULL,
+    UNIQUE (builder, tag)
+);
+CREATE TABLE IF NOT EXISTS recipes (
+    build_id INTEGER NOT NULL,
+    arch TEXT NOT NULL,
+    recipe TEXT NOT NULL,
+    pe TEXT,
+    pv TEXT,
+    pr TEXT,
+    autorev INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS srcrevs (
+    build_id INTEGER NOT NULL,
+    recipe TEXT NOT NULL,
+    name TEXT NOT NULL,
+    srcrev TEXT
+);
+CREATE TABLE IF NOT EXISTS packages (
+    build_id INTEGER NOT NULL,
+    arch TEXT NOT NULL,
+    recipe TEXT NOT NULL,
+    package TEXT NOT NULL,
+    pv TEXT,
+    pr TEXT,
+    pkgsize INTEGER
+);
+CREATE TABLE IF NOT EXISTS images (
+    build_id INTEGER NOT NULL,
+    machine TEXT NOT NULL,
+    image TEXT NOT NULL,
+    imagesize INTEGER
+);
+CREATE TABLE IF NOT EXISTS image_packages (
+    build_id INTEGER NOT NULL,
+    machine TEXT NOT NULL,
+    image TEXT NOT NULL,
+    package TEXT NOT NULL,
+    size INTEGER
+);
+CREATE INDEX IF NOT EXISTS recipes_idx ON recipes (recipe, build_id);
+CREATE INDEX IF NOT EXISTS srcrevs_idx ON srcrevs (recipe, build_id);
+CREATE INDEX IF NOT EXISTS packages_idx ON packages (package, build_id);
+CREATE INDEX IF NOT EXISTS images_idx ON images (image, build_id);
+CREATE INDEX IF NOT EXISTS image_packages_idx ON image_packages (build_id, image);
+"""
+
+BUILD_TABLES = ['recipes', 'srcrevs', 'packages', 'images', 'image_packages']
+
+
+def read_vars(filename):
+    """
+    Reads a buildhistory 'latest' or '*-info.txt' file, returning
+    a dict of the VAR = value assignments it contains.
+    """
+    result = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            m = VAR_PAT.match(line.rstrip('\n'))
+            if m is not None:
+                result[m.group(1)] = m.group(2)
+    return result
+
+
+def read_srcrevs(filename):
+    """
+    Parses a 'latest_srcrev' file, returning a tuple of
+    (autorev, {name: srcrev}), where autorev is True if
+    the file contains the comment indicating that AUTOREV
+    was used.
+    """
+    autorev = False
+    srcrevs = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            if AUTOREV_PAT.match(line) is not None:
+                autorev = True
+                continue
+            m = SRCREV_PAT.match(line)
+            if m is not None:
+                srcrevs[m.group(1)] = m.group(2)
+    return autorev, srcrevs
+
+
+def _intval(val):
+    try:
+        return int(val)
+    except (TypeError, ValueError):
+        return None
+
+
+def open_index(dbfile):
+    """
+    Opens (creating, if necessary) a buildhistory index database.
+    """
+    dbdir = os.path.dirname(dbfile)
+    if dbdir and not os.path.exists(dbdir):
+        os.makedirs(dbdir)
+    db = sqlite3.connect(dbfile)
+    db.executescript(SCHEMA)
+    return db
+
+
+class BuildhistoryIndexer(object):
+    """
+    Walks a buildhistory directory and records its contents
+    in an index database for a single build.
+    """
+
+    def __init__(self, db, histdir, log=None):
+        self.db = db
+        self.histdir = histdir
+        self.log = log
+        self.autorev_recipes = []
+
+    def _debug(self, *args):
+        if self.log is not None:
+            self.log.debug(*args)
+
+    def ingest(self, builder, tag, imageset=None, release=False, timestamp=None):
+        """
+        Indexes the buildhistory for build 'tag' of 'builder', replacing
+        any earlier entries for that build.  Returns the build ID.
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+        cur = self.db.cursor()
+        cur.execute('SELECT id FROM builds WHERE builder = ? AND tag = ?', (builder, tag))
+        row = cur.fetchone()
+        if row is not None:
+            build_id = row[0]
+            for table in BUILD_TABLES:
+                cur.execute('DELETE FROM %s WHERE build_id = ?' % table, (build_id,))
+            cur.execute('UPDATE builds SET imageset = ?, release = ?, timestamp = ? WHERE id = ?',
+                        (imageset, 1 if release else 0, timestamp, build_id))
+        else:
+            cur.execute('INSERT INTO builds (builder, tag, imageset, release, timestamp) VALUES (?, ?, ?, ?, ?)',
+                        (builder, tag, imageset, 1 if release else 0, timestamp))
+            build_id = cur.lastrowid
+        self._ingest_packages(cur, build_id)
+        self._ingest_images(cur, build_id)
+        self.db.commit()
+        return build_id
+
+    def _ingest_packages(self, cur, build_id):
+        pkgbase = os.path.join(self.histdir, 'packages')
+        if not os.path.isdir(pkgbase):
+            return
+        for arch in sorted(os.listdir(pkgbase)):
+            archdir = os.path.join(pkgbase, arch)
+            if not os.path.isdir(archdir):
+                continue
+            for recipe in sorted(os.listdir(archdir)):
+                recipedir = os.path.join(archdir, recipe)
+                if not os.path.isdir(recipedir):
+                    continue
+                autorev = False
+                srcrevfile = os.path.join(recipedir, 'latest_srcrev')
+                if os.path.exists(srcrevfile):
+                    autorev, srcrevs = read_srcrevs(srcrevfile)
+                    cur.executemany('INSERT INTO srcrevs (build_id, recipe, name, srcrev) VALUES (?, ?, ?, ?)',
+                                    [(build_id, recipe, name, srcrevs[name]) for name in sorted(srcrevs)])
+                    if autorev:
+                        self.autorev_recipes.append(recipe)
+                latest = os.path.join(recipedir, 'latest')
+                rvars = read_vars(latest) if os.path.exists(latest) else {}
+                cur.execute('INSERT INTO recipes (build_id, arch, recipe, pe, pv, pr, autorev) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (build_id, arch, recipe, rvars.get('PE'), rvars.get('PV'),
+                             rvars.get('PR'), 1 if autorev else 0))
+                self._debug(2, 'indexed recipe %s (%s)', recipe, arch)
+                rows = []
+                for pkg in sorted(os.listdir(recipedir)):
+                    pkglatest = os.path.join(recipedir, pkg, 'latest')
+                    if not os.path.isfile(pkglatest):
+                        continue
+                    pvars = read_vars(pkglatest)
+                    rows.append((build_id, arch, recipe, pkg, pvars.get('PKGV', pvars.get('PV')),
+                                 pvars.get('PKGR', pvars.get('PR')), _intval(pvars.get('PKGSIZE'))))
+                cur.executemany('INSERT INTO packages (build_id, arch, recipe, package, pv, pr, pkgsize) '
+                                'VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _ingest_images(self, cur, build_id):
+        imgbase = os.path.join(self.histdir, 'images')
+        if not os.path.isdir(imgbase):
+            return
+        for machine in sorted(os.listdir(imgbase)):
+            for dirpath, _, filenames in os.walk(os.path.join(imgbase, machine)):
+                if 'image-info.txt' not in filenames:
+                    continue
+                image = os.path.basename(dirpath)
+                ivars = read_vars(os.path.join(dirpath, 'image-info.txt'))
+                cur.execute('INSERT INTO images (build_id, machine, image, imagesize) VALUES (?, ?, ?, ?)',
+                            (build_id, machine, image, _intval(ivars.get('IMAGESIZE'))))
+                self._debug(2, 'indexed image %s (%s)', image, machine)
+                sizefile = os.path.join(dirpath, 'installed-package-sizes.txt')
+                if not os.path.exists(sizefile):
+                    continue
+                rows = []
+                with open(sizefile, 'r') as f:
+                    for line in f:
+                        fields = line.split()
+                        if len(fields) < 3:
+                            continue
+                        rows.append((build_id, machine, image, fields[2], _intval(fields[0])))
+                cur.executemany('INSERT INTO image_packages (build_id, machine, image, package, size) '
+                                'VALUES (?, ?, ?, ?, ?)', rows)
+
+
+def package_changes(db, package, builder=None):
+    """
+    Returns a list of (builder, tag, pv, pr, pkgsize) tuples for each
+    build in which the version or size of 'package' differed from the
+    previous indexed build of the same builder.
+    """
+    query = ('SELECT b.builder, b.tag, p.pv, p.pr, p.pkgsize FROM packages p '
+             'JOIN builds b ON b.id = p.build_id WHERE p.package = ?')
+    params = [package]
+    if builder:
+        query += ' AND b.builder = ?'
+        params.append(builder)
+    query += ' ORDER BY b.builder, b.timestamp, b.id'
+    result = []
+    prev = {}
+    for bname, tag, pv, pr, pkgsize in db.execute(query, params):
+        if prev.get(bname) != (pv, pr, pkgsize):
+            result.append((bname, tag, pv, pr, pkgsize))
+            prev[bname] = (pv, pr, pkgsize)
+    return result
+
+
+def image_size_delta(db, image, builder=None):
+    """
+    Compares the size of 'image' in the most recent indexed build
+    against the most recent release build.  Returns a list of
+    (builder, machine, release_tag, release_size, tag, size) tuples.
+    """
+    query = ('SELECT b.builder, i.machine, b.tag, b.release, i.imagesize FROM images i '
+             'JOIN builds b ON b.id = i.build_id WHERE i.image = ?')
+    params = [image]
+    if builder:
+        query += ' AND b.builder = ?'
+        params.append(builder)
+    query += ' ORDER BY b.timestamp, b.id'
+    latest = {}
+    release = {}
+    for bname, machine, tag, is_release, size in db.execute(query, params):
+        latest[(bname, machine)] = (tag, size)
+        if is_release:
+            release[(bname, machine)] = (tag, size)
+    result = []
+    for key in sorted(latest):
+        reltag, relsize = release.get(key, (None, None))
+        result.append(key + (reltag, relsize) + latest[key])
+    return result
@@ -0,0 +1,151 @@
+# Copyright (c) 2018 Matthew Madison
+# Distributed under license
+
+"""
+buildstats
+
+Support for summarizing the per-task statistics written by
+bitbake's buildstats class (tmp/buildstats/<BUILDNAME>/<PF>/<task>),
+so the recipes and tasks that account for a build's time can be
+identified without trawling through the raw files.
+"""
+
+import os
+import bisect
+import collections
+
+Task = collections.namedtuple('Task', 'recipe task start end elapsed cpu')
+
+# Clock ticks per second for the utime/stime fields in older buildstats files
+CLOCK_TICKS = 100.0
+
+
+def _float(val):
+    try:
+        return float(val.split()[0])
+    except (ValueError, IndexError, AttributeError):
+        return None
+
+
+def read_task(filename):
+    """
+    Parses one buildstats task file, returning a dict of its
+    'Key: value' entries.
+    """
+    result = {}
+    with open(filename, 'r') as f:
+        for line in f:
+            key, sep, value = line.partition(':')
+            if sep:
+                result[key.strip()] = value.strip()
+    return result
+
+
+def _cpu_time(entries):
+    rusage = ['rusage ru_utime', 'rusage ru_stime', 'Child rusage ru_utime', 'Child rusage ru_stime']
+    if any([key in entries for key in rusage]):
+        return sum([_float(entries.get(key)) or 0.0 for key in rusage])
+    ticks = sum([_float(entries.get(key)) or 0.0 for key in ['utime', 'stime', 'cutime', 'cstime']])
+    return ticks / CLOCK_TICKS
+
+
+def read_buildstats(statsdir):
+    """
+    Reads all of the task files for one bitbake invocation (a
+    tmp/buildstats/<BUILDNAME> directory), returning a list of Tasks.
+    Tasks that never finished are skipped.
+    """
+    tasks = []
+    for recipe in sorted(os.listdir(statsdir)):
+        recipedir = os.path.join(statsdir, recipe)
+        if not os.path.isdir(recipedir):
+            continue
+        for taskname in sorted(os.listdir(recipedir)):
+            if not taskname.startswith('do_'):
+                continue
+            entries = read_task(os.path.join(recipedir, taskname))
+            start = _float(entries.get('Started'))
+            end = _float(entries.get('Ended'))
+            if start is None or end is None:
+                continue
+            elapsed = _float(entries.get('Elapsed time'))
+            tasks.append(Task(recipe, taskname, start, end,
+                              end - start if elapsed is None else elapsed,
+                              _cpu_time(entries)))
+    return tasks
+
+
+def latest_buildstats(topdir):
+    """
+    Returns the most recently written BUILDNAME directory
+    under a buildstats directory, or None.
+    """
+    if not os.path.isdir(topdir):
+        return None
+    candidates = [os.path.join(topdir, d) for d in os.listdir(topdir)
+                  if os.path.isdir(os.path.join(topdir, d))]
+    if not candidates:
+        return None
+    return max(candidates, key=os.path.getmtime)
+
+
+def critical_path(tasks, slack=1.0):
+    """
+    Estimates the critical path by walking back from the last task
+    to finish, at each point choosing the task that finished most
+    recently before the current one started (within 'slack' seconds).
+    buildstats does not record task dependencies, so this is the
+    chain of tasks that kept the build busy, not necessarily the
+    true dependency chain.
+    """
+    if not tasks:
+        return []
+    by_end = sorted(tasks, key=lambda t: t.end)
+    ends = [t.end for t in by_end]
+    current = by_end[-1]
+    path = [current]
+    while True:
+        i = bisect.bisect_right(ends, current.start + slack) - 1
+        while i >= 0 and by_end[i].start >= current.start:
+            i -= 1
+        if i < 0:
+            break
+        current = by_end[i]
+        path.append(current)
+    path.reverse()
+    return path
+
+
+def _taskname(t):
+    return '%s:%s' % (t.recipe, t.task)
+
+
+def summarize(tasks, top=10):
+    """
+    Condenses a list of Tasks into a summary dict: overall wall and
+    CPU time, the top tasks by wall and CPU time, the recipes with the
+    largest totals, and the critical path estimate (with its longest
+    tasks, in order).
+    """
+    if not tasks:
+        return {'tasks': 0}
+    recipes = collections.defaultdict(lambda: [0.0, 0.0])
+    for t in tasks:
+        recipes[t.recipe][0] += t.elapsed
+        recipes[t.recipe][1] += t.cpu
+    path = critical_path(tasks)
+    path_top = sorted(sorted(path, key=lambda t: -t.elapsed)[:top], key=lambda t: t.start)
+    return {
+        'tasks': len(tasks),
+        'wall': round(max([t.end for t in tasks]) - min([t.start for t in tasks]), 1),
+        'cpu': round(sum([t.cpu for t in tasks]), 1),
+        'top_wall': [[_taskname(t), round(t.elapsed, 1)]
+                     for t in sorted(tasks, key=lambda t: -t.elapsed)[:top]],
+        'top_cpu': [[_taskname(t), round(t.cpu, 1)]
+                    for t in sorted(tasks, key=lambda t: -t.cpu)[:top]],
+        'recipes': [[r, round(recipes[r][0], 1), round(recipes[r][1], 1)]
+                    for r in sorted(recipes, key=lambda r: -recipes[r][0])[:top]],
+        'critical_path': {'seconds': round(path[-1].end - path[0].start, 1),
+                          'length': len(path),
+                          'tasks': [[_taskname(t), round(t.elapsed, 1)] for t in path_top]}
+    }
@@ -0,0 +1,155 @@
+# Copyright (c) 2018 Matthew Madison
+# Distributed under license
+
+"""
+histstore
+
+A content-addressed store for buildhistory data.  Each file
+is stored once, compressed, under the SHA-256 of its contents;
+a build's buildhistory is recorded as a tree file listing the
+paths, modes, and content hashes (or symlink targets) of every
+entry, so only files that changed since earlier builds add
+anything to the store.  Any build's buildhistory can be
+materialized again from its tree file.
+
+Objects are written to a temporary name and renamed into place,
+so several builders can share a store without locking.
+"""
+
+import os
+import gzip
+import zlib
+import hashlib
+import tempfile
+
+TREE_SUFFIX = '.tree.gz'
+STORE_NAME = 'buildhistory-store'
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+class HistoryStore(object):
+    def __init__(self, storedir):
+        self.storedir = storedir
+        self.objdir = os.path.join(storedir, 'objects')
+
+    def object_path(self, digest):
+        return os.path.join(self.objdir, digest[:2], digest[2:])
+
+    def put(self, data):
+        """
+        Adds data to the store (if it isn't already present).
+        Returns (digest, number of bytes written).
+        """
+        digest = _hash(data)
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        objdir = os.path.dirname(path)
+        if not os.path.isdir(objdir):
+            try:
+                os.makedirs(objdir)
+            except OSError:
+                if not os.path.isdir(objdir):
+                    raise
+        compressed = zlib.compress(data)
+        fd, tmpname = tempfile.mkstemp(dir=objdir, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(compressed)
+            os.rename(tmpname, path)
+        except Exception:
+            os.unlink(tmpname)
+            raise
+        return digest, len(compressed)
+
+    def get(self, digest):
+        with open(self.object_path(digest), 'rb') as f:
+            data = zlib.decompress(f.read())
+        if _hash(data) != digest:
+            raise RuntimeError('corrupted object in history store: %s' % digest)
+        return data
+
+    def store_tree(self, srcdir, treefile):
+        """
+        Stores the contents of srcdir and writes the tree file
+        describing it.  Returns (entries, new objects, bytes written).
+        """
+        entries = []
+        newobjs = 0
+        written = 0
+        for dirpath, dirnames, filenames in os.walk(srcdir):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                path = os.path.join(dirpath, name)
+                relpath = os.path.relpath(path, srcdir)
+                if os.path.islink(path):
+                    entries.append(('l', '-', os.readlink(path), relpath))
+                elif name in filenames:
+                    with open(path, 'rb') as f:
+                        digest, count = self.put(f.read())
+                    if count > 0:
+                        newobjs += 1
+                        written += count
+                    entries.append(('f', '%o' % (os.stat(path).st_mode & 0o7777), digest, relpath))
+                elif not os.listdir(path):
+                    entries.append(('d', '-', '-', relpath))
+        treedir = os.path.dirname(treefile)
+        if treedir and not os.path.isdir(treedir):
+            os.makedirs(treedir)
+        with gzip.open(treefile, 'wb') as f:
+            for entry in entries:
+                f.write(('%s %s %s\t%s\n' % entry).encode('utf-8'))
+        return len(entries), newobjs, written
+
+    def materialize(self, treefile, destdir):
+        """
+        Recreates the directory described by a tree file in destdir.
+        """
+        for etype, mode, value, relpath in read_tree(treefile):
+            path = os.path.join(destdir, relpath)
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            if etype == 'd':
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+            elif etype == 'l':
+                os.symlink(value, path)
+            else:
+                with open(path, 'wb') as f:
+                    f.write(self.get(value))
+                os.chmod(path, int(mode, 8))
+
+
+def read_tree(treefile):
+    """
+    Returns the list of (type, mode, hash-or-target, relpath)
+    entries in a tree file.
+    """
+    result = []
+    with gzip.open(treefile, 'rb') as f:
+        for line in f:
+            fields, relpath = line.decode('utf-8').rstrip('\n').split('\t', 1)
+            etype, mode, value = fields.split(' ', 2)
+            result.append((etype, mode, value, relpath))
+    return result
+
+
+def find_store(treefile):
+    """
+    Locates the history store for a published tree file, which
+    is kept at the top of the artifacts path the tree file was
+    published under.
+    """
+    dirname = os.path.dirname(os.path.realpath(treefile))
+    while True:
+        candidate = os.path.join(dirname, STORE_NAME)
+        if os.path.isdir(os.path.join(candidate, 'objects')):
+            return candidate
+        parent = os.path.dirname(dirname)
+        if parent == dirname:
+            return None
+        dirname = parent
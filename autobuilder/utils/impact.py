@@ -0,0 +1,57 @@
+# Copyright (c) 2018 Matthew Madison
+# Distributed under license
+
+"""
+impact
+
+Maps the files touched by a change to the imagesets they can
+affect, so a push only schedules builds for those imagesets.
+Each imageset may list path patterns (fnmatch-style, relative
+to the top of the distro repository); a pattern that names a
+directory, such as a layer or a submodule, also matches
+everything beneath it.  An imageset with no patterns is
+affected by every change.
+"""
+
+import fnmatch
+
+
+def path_matches(path, pattern):
+    """
+    Returns True if 'path' matches 'pattern' or lies within
+    a directory that matches it.
+    """
+    pattern = pattern.rstrip('/')
+    if fnmatch.fnmatch(path, pattern):
+        return True
+    parts = path.split('/')
+    for i in range(1, len(parts)):
+        if fnmatch.fnmatch('/'.join(parts[:i]), pattern):
+            return True
+    return False
+
+
+def is_affected(files, patterns, common=None):
+    """
+    Returns True if any of 'files' matches one of 'patterns' or,
+    since they affect every imageset, one of 'common'.  With no
+    file list (as for force builds), or no patterns, everything
+    is considered affected.
+    """
+    if not files or patterns is None:
+        return True
+    for path in files:
+        for pattern in list(patterns) + list(common or []):
+            if path_matches(path, pattern):
+                return True
+    return False
+
+
+def affected_builders(files, builder_patterns, common=None):
+    """
+    Returns the sorted names of the builders in 'builder_patterns'
+    (a dict mapping builder name to its pattern list, or None)
+    that are affected by a change to 'files'.
+    """
+    return sorted([name for name in builder_patterns
+                   if is_affected(files, builder_patterns[name], common)])
@@ -7,14 +7,36 @@ output only.
 
 Note that setting a debug level implies verbose as well.
 
+For per-file operations that can number in the tens of thousands,
+use Log.event() instead of Log.verbose().  Normally events are logged
+just like verbose messages, but after calling Log.aggregate() they are
+counted by category and directory, with periodic summaries and a few
+samples per category going to the log, and the full detail optionally
+going to a gzip-compressed side file.
+
+Log.set_structured() switches the output to JSON lines, carrying
+any keyword fields passed to the logging methods (path, bytes,
+duration, etc.) in a 'fields' object, for easier extraction from
+build logs.
+
 To use:
 from logutils import Log
 log = Log(...)
 
 """
 
+import collections
+import gzip
+import json
 import logging
+import os
 import sys
+import time
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
 
 
 class Log:
@@ -35,6 +57,7 @@ class Log:
         self.handler.setLevel(logging.INFO)
         self.debug_level = 0
         self.verbosity = False
+        self.aggregator = None
 
     def set_level(self, debug_level, verbose=False):
         """
@@ -58,61 +81,172 @@ class Log:
         """
         return self.debug_level, self.verbosity
 
-    def plain(self, *args):
+    def _log(self, level, args, fields, event=None):
+        # Checking the level first means suppressed messages cost
+        # nothing beyond the call itself: no formatting, no record.
+        if not self.mylog.isEnabledFor(level):
+            return
+        self.mylog.log(level, *args, extra={'event': event, 'fields': fields})
+
+    def enabled(self, debug_level=0, verbose=False):
+        """
+        Returns True if messages at the specified debug level (or,
+        with verbose=True, verbose messages) would be logged.  Useful
+        for skipping expensive argument computation.
+        """
+        if debug_level > 0:
+            return self.mylog.isEnabledFor(logging.DEBUG - debug_level + 1)
+        return self.mylog.isEnabledFor(logging.INFO - 1 if verbose else logging.INFO)
+
+    def set_structured(self, structured=True):
+        """
+        Switches between plain text output and structured output,
+        which emits one JSON object per line with timestamp, level,
+        event type, message, and a 'fields' object holding any fields
+        passed to the logging call.
+        """
+        self.formatter = JSONFormatter() if structured else MyFormatter('%(levelname)s: %(message)s')
+        self.handler.setFormatter(self.formatter)
+
+    def plain(self, *args, **fields):
         """
         Plain output, not subject to verobsity or debug settings.
         """
-        self.mylog.log(logging.INFO + 1, *args)
+        self._log(logging.INFO + 1, args, fields)
 
-    def note(self, *args):
+    def note(self, *args, **fields):
         """
         Plain output, prefixed by Note:, not subject
         to verbosity or debug settings.
         """
-        self.mylog.info(*args)
+        self._log(logging.INFO, args, fields)
 
-    def verbose(self, *args):
+    def verbose(self, *args, **fields):
         """
         Logs output only when verbosity is enabled.
         """
-        self.mylog.log(logging.INFO - 1, *args)
+        self._log(logging.INFO - 1, args, fields)
 
-    # noinspection PyUnboundLocalVariable
-    def debug(self, level, *args):
+    def debug(self, level, *args, **fields):
         """
         Logs output only when the current debug level
         is >= the level specified in the call.
         """
-        try:
-            basestring
-        except NameError:
-            basestring = str
-        if isinstance(level, basestring):
+        if isinstance(level, string_types):
             args = (level,) + args
             level = 1
-        self.mylog.log(logging.DEBUG - level + 1, *args)
+        self._log(logging.DEBUG - level + 1, args, fields)
 
-    def warn(self, *args):
+    def warn(self, *args, **fields):
         """
         Logs a warning.  Not subject to debug/verbosity
         settings.
         """
-        self.mylog.warning(*args)
+        self._log(logging.WARNING, args, fields)
 
-    def error(self, *args):
+    def error(self, *args, **fields):
         """
         Logs an error.  Not subject to debug/verbosity
         settings.
         """
-        self.mylog.error(*args)
+        self._log(logging.ERROR, args, fields)
 
-    def fatal(self, *args):
+    def fatal(self, *args, **fields):
         """
         Logs a fatal error and exits.
         """
-        self.mylog.critical(*args)
+        self._log(logging.CRITICAL, args, fields)
         sys.exit(1)
 
+    def aggregate(self, interval=60, samples=5, detail_file=None, top_dirs=5):
+        """
+        Switches event() calls to aggregated mode.  A summary of event
+        counts is logged every 'interval' seconds, the first 'samples'
+        events of each category are logged individually, and every event
+        is written to 'detail_file' (gzip-compressed), if specified.
+        """
+        self.end_aggregation()
+        self.aggregator = EventAggregator(self, interval, samples, detail_file, top_dirs)
+
+    def end_aggregation(self):
+        """
+        Logs a final summary and ends aggregated mode, if active.
+        """
+        if self.aggregator is not None:
+            self.aggregator.close()
+            self.aggregator = None
+
+    def event(self, category, path, *args, **fields):
+        """
+        Logs a per-file event in the named category (e.g., 'copy').
+        Without aggregation, this is equivalent to verbose(*args),
+        with the category as the event type and the path (plus
+        any other fields, such as bytes or duration) as fields.
+        """
+        if self.aggregator is None:
+            fields['path'] = path
+            self._log(logging.INFO - 1, args, fields, event=category)
+        else:
+            self.aggregator.add(category, path, args, fields)
+
+
+class EventAggregator(object):
+    """
+    Collects per-file events for Log.event() in aggregated mode.
+    """
+
+    def __init__(self, log, interval, samples, detail_file, top_dirs):
+        self.log = log
+        self.interval = interval
+        self.samples = samples
+        self.top_dirs = top_dirs
+        self.counts = collections.Counter()
+        self.bytecounts = collections.Counter()
+        self.dircounts = collections.defaultdict(collections.Counter)
+        self.detail = None
+        if detail_file:
+            self.detail = gzip.open(detail_file, 'wt')
+        self.last_summary = time.time()
+
+    def add(self, category, path, args, fields):
+        self.counts[category] += 1
+        self.dircounts[category][os.path.dirname(path)] += 1
+        if fields.get('bytes'):
+            self.bytecounts[category] += fields['bytes']
+        if self.detail is not None and args:
+            self.detail.write('%s: %s\n' % (category, args[0] % args[1:]))
+        if self.counts[category] <= self.samples:
+            fields['path'] = path
+            self.log._log(logging.INFO - 1, args, fields, event=category)
+            if self.counts[category] == self.samples:
+                self.log.verbose('(further %s events will be summarized)', category)
+        if self.interval and time.time() - self.last_summary >= self.interval:
+            self.summarize()
+
+    def summarize(self, final=False):
+        self.last_summary = time.time()
+        for category in sorted(self.counts):
+            fields = {'category': category, 'count': self.counts[category], 'final': final}
+            if self.bytecounts[category]:
+                fields['bytes'] = self.bytecounts[category]
+                self.log._log(logging.INFO, ('%s%s: %d (%d bytes)', 'Total ' if final else '', category,
+                                             self.counts[category], self.bytecounts[category]),
+                              fields, event='summary')
+            else:
+                self.log._log(logging.INFO, ('%s%s: %d', 'Total ' if final else '', category,
+                                             self.counts[category]),
+                              fields, event='summary')
+            if final:
+                for dirname, count in self.dircounts[category].most_common(self.top_dirs):
+                    self.log._log(logging.INFO - 1, ('    %d in %s', count, dirname),
+                                  {'category': category, 'count': count, 'path': dirname}, event='summary')
+
+    def close(self):
+        self.summarize(final=True)
+        if self.detail is not None:
+            self.detail.close()
+            self.detail = None
+
 
 class MyFormatter(logging.Formatter):
     """
@@ -157,3 +291,33 @@ class MyFormatter(logging.Formatter):
             return record.getMessage()
         record.levelname = self.get_level_name(record.levelno)
         return logging.Formatter.format(self, record)
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Logging formatter for structured output: one JSON object per line.
+    """
+
+    levelnames = {
+        MyFormatter.CRITICAL: 'fatal',
+        MyFormatter.ERROR: 'error',
+        MyFormatter.WARNING: 'warning',
+        MyFormatter.PLAIN: 'plain',
+        MyFormatter.NOTE: 'note',
+        MyFormatter.VERBOSE: 'verbose',
+        MyFormatter.DEBUG: 'debug',
+        MyFormatter.DEBUG2: 'debug2',
+        MyFormatter.DEBUG3: 'debug3',
+        MyFormatter.DEBUG4: 'debug4'
+    }
+
+    def format(self, record):
+        entry = {'timestamp': record.created,
+                 'level': self.levelnames.get(record.levelno, str(record.levelno)),
+                 'event': getattr(record, 'event', None) or 'message',
+                 'message': record.getMessage()}
+        # Kept apart so they can't overwrite the keys above
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry['fields'] = fields
+        return json.dumps(entry, sort_keys=True, default=str)
@@ -9,13 +9,84 @@
 # Much of this is borrowed from bitbake.
 #
 
+import os
 import sys
+import time
+import errno
+import json
+import select
+import collections
 import subprocess
 import signal
+from concurrent.futures import ThreadPoolExecutor, FIRST_EXCEPTION, wait
 
+DEFAULT_TAIL_LINES = 100
+MAX_LINE_LENGTH = 65536
+KILL_GRACE_PERIOD = 5
 
-def subproc_preexec():
-    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+# When set (via record_usage or the environment), the resource
+# usage of every command run through this module is appended to
+# this file as a JSON line.
+USAGE_LOG = os.getenv('AUTOBUILDER_USAGE_LOG')
+
+
+def _text(output):
+    if isinstance(output, bytes):
+        return output.decode('utf-8', 'replace')
+    return output
+
+
+def record_usage(filename):
+    """
+    Enables (or, with None, disables) logging of per-command resource
+    usage, as JSON lines, to the named file.
+    """
+    global USAGE_LOG
+    USAGE_LOG = filename
+
+
+class ResourceUsage(object):
+    """
+    Resource usage for a single command: wall-clock time, user and
+    system CPU time (in seconds), maximum resident set size (KiB), and
+    block input/output operations.
+    """
+
+    def __init__(self, command, exitcode=None, wall_time=0.0, rusage=None):
+        if not isinstance(command, str):
+            command = subprocess.list2cmdline(command)
+        self.command = command
+        self.exitcode = exitcode
+        self.wall_time = wall_time
+        self.utime = rusage.ru_utime if rusage else None
+        self.stime = rusage.ru_stime if rusage else None
+        self.maxrss = rusage.ru_maxrss if rusage else None
+        self.inblock = rusage.ru_inblock if rusage else None
+        self.oublock = rusage.ru_oublock if rusage else None
+
+    def as_dict(self):
+        return {'command': self.command, 'exitcode': self.exitcode,
+                'wall_time': round(self.wall_time, 3),
+                'utime': self.utime, 'stime': self.stime, 'maxrss': self.maxrss,
+                'inblock': self.inblock, 'oublock': self.oublock}
+
+    def __str__(self):
+        return 'wall %.2fs, user %.2fs, sys %.2fs, maxrss %s KiB, blocks in/out %s/%s' % (
+            self.wall_time, self.utime or 0.0, self.stime or 0.0,
+            self.maxrss, self.inblock, self.oublock)
+
+
+def _log_usage(usage):
+    if not USAGE_LOG or usage is None:
+        return
+    entry = usage.as_dict()
+    entry['timestamp'] = time.time()
+    # noinspection PyBroadException
+    try:
+        with open(USAGE_LOG, 'a') as f:
+            f.write(json.dumps(entry, sort_keys=True) + '\n')
+    except Exception:
+        pass
 
 
 class CmdError(RuntimeError):
@@ -23,13 +94,8 @@ class CmdError(RuntimeError):
         self.command = command
         self.msg = msg
 
-    # noinspection PyUnboundLocalVariable
     def __str__(self):
-        try:
-            basestring
-        except NameError:
-            basestring = str
-        if not isinstance(self.command, basestring):
+        if not isinstance(self.command, str):
             cmd = subprocess.list2cmdline(self.command)
         else:
             cmd = self.command
@@ -46,28 +112,44 @@ class NotFoundError(CmdError):
 
 
 class ExecutionError(CmdError):
-    def __init__(self, command, exitcode, stdout=None, stderr=None):
+    def __init__(self, command, exitcode, stdout=None, stderr=None, usage=None):
         CmdError.__init__(self, command)
         self.exitcode = exitcode
         self.stdout = stdout
         self.stderr = stderr
+        self.usage = usage
 
     def __str__(self):
         message = ""
         if self.stderr:
-            message += self.stderr
+            message += _text(self.stderr)
         if self.stdout:
-            message += self.stdout
+            message += _text(self.stdout)
         if message:
             message = ":\n" + message
         return (CmdError.__str__(self) +
                 " with exit code %s" % self.exitcode + message)
 
 
+class ExecutionTimeout(CmdError):
+    def __init__(self, command, msg, output=None, usage=None):
+        CmdError.__init__(self, command, msg)
+        self.output = output
+        self.usage = usage
+
+    def __str__(self):
+        message = CmdError.__str__(self)
+        if self.output:
+            message += ":\n" + self.output
+        return message
+
+
 class Popen(subprocess.Popen):
     defaults = {
         "close_fds": True,
-        "preexec_fn": subproc_preexec,
+        # Not preexec_fn, which is unsafe with threads (run_parallel);
+        # restore_signals resets SIGPIPE to its default
+        "restore_signals": True,
         "stdout": subprocess.PIPE,
         "stderr": subprocess.PIPE,
         "stdin": subprocess.PIPE,
@@ -77,27 +159,304 @@ class Popen(subprocess.Popen):
     def __init__(self, *args, **kwargs):
         options = dict(self.defaults)
         options.update(kwargs)
+        self.start_time = time.time()
+        self.end_time = None
+        self.rusage = None
         subprocess.Popen.__init__(self, *args, **options)
 
+    def wait(self, timeout=None):
+        """
+        Waits for the process to exit, reaping it with wait4() so its
+        resource usage is available.  Everything that waits on the
+        process -- communicate() included -- goes through here, and
+        once returncode is set subprocess does no reaping of its own.
+        """
+        if self.returncode is not None:
+            return self.returncode
+        endtime = None if timeout is None else time.time() + timeout
+        delay = 0.0005
+        while True:
+            try:
+                pid, sts, rusage = os.wait4(self.pid, 0 if endtime is None else os.WNOHANG)
+            except ChildProcessError:
+                # Already reaped by someone else, so no usage to collect
+                return subprocess.Popen.wait(self, timeout=timeout)
+            if pid == self.pid:
+                self.rusage = rusage
+                self.end_time = time.time()
+                if os.WIFSIGNALED(sts):
+                    self.returncode = -os.WTERMSIG(sts)
+                else:
+                    self.returncode = os.WEXITSTATUS(sts)
+                return self.returncode
+            remaining = endtime - time.time()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            delay = min(delay * 2, remaining, 0.05)
+            time.sleep(delay)
+
+    def usage(self, command):
+        """
+        Returns a ResourceUsage object for the (completed) process.
+        """
+        end_time = self.end_time or time.time()
+        return ResourceUsage(command, self.returncode, end_time - self.start_time, self.rusage)
+
+
+class CmdResult(tuple):
+    """
+    (stdout, stderr) tuple returned by run(), with the
+    command's resource usage in its usage attribute.
+    """
+
+    def __new__(cls, stdout, stderr, usage=None):
+        result = tuple.__new__(cls, (stdout, stderr))
+        result.usage = usage
+        return result
+
 
 def run(cmd, input=None, errignore=False, **options):
     """Convenience function to run a command and return its output, raising an
     exception when the command fails"""
 
-    if isinstance(cmd, basestring) and "shell" not in options:
+    if isinstance(cmd, str) and "shell" not in options:
         options["shell"] = True
 
     try:
         pipe = Popen(cmd, **options)
     except OSError:
-        exc = sys.exc_info()[0]
-        if exc.errno == 2:
+        exc = sys.exc_info()[1]
+        if exc.errno == errno.ENOENT:
             raise NotFoundError(cmd)
         else:
             raise CmdError(cmd, exc)
 
     stdout, stderr = pipe.communicate(input)
+    usage = pipe.usage(cmd)
+    _log_usage(usage)
 
     if pipe.returncode != 0 and not errignore:
-        raise ExecutionError(cmd, pipe.returncode, stdout, stderr)
-    return stdout, stderr
+        raise ExecutionError(cmd, pipe.returncode, stdout, stderr, usage)
+    return CmdResult(stdout, stderr, usage)
+
+
+class StreamingCommand(object):
+    """
+    Runs a command, yielding its output line by line as
+    (stream-name, line) tuples while the command executes,
+    where stream-name is 'stdout' or 'stderr'.
+
+    Only the last tail_lines lines of output are retained,
+    for inclusion in the exception raised on failure.  The
+    command is run in its own process group; if it runs longer
+    than timeout seconds, or produces no output for idle_timeout
+    seconds, the entire process group is killed and ExecutionTimeout
+    is raised.  A non-zero exit code raises ExecutionError, unless
+    errignore is set.  The exit code and resource usage are available
+    in the returncode and usage attributes after iteration completes.
+    """
+
+    def __init__(self, cmd, input=None, errignore=False, timeout=None,
+                 idle_timeout=None, tail_lines=DEFAULT_TAIL_LINES, **options):
+        self.cmd = cmd
+        self.input = input
+        self.errignore = errignore
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.returncode = None
+        self.usage = None
+        if isinstance(cmd, str) and "shell" not in options:
+            options["shell"] = True
+        options.setdefault("start_new_session", True)
+        self.options = options
+
+    def tail_output(self):
+        return ''.join(self.tail)
+
+    def _kill(self, pipe):
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(pipe.pid, sig)
+            except OSError:
+                break
+            try:
+                pipe.wait(timeout=KILL_GRACE_PERIOD)
+                return
+            except subprocess.TimeoutExpired:
+                pass
+        pipe.wait()
+
+    def _record_usage(self, pipe):
+        self.returncode = pipe.returncode
+        self.usage = pipe.usage(self.cmd)
+        _log_usage(self.usage)
+
+    def __iter__(self):
+        try:
+            pipe = Popen(self.cmd, **self.options)
+        except OSError:
+            exc = sys.exc_info()[1]
+            if exc.errno == errno.ENOENT:
+                raise NotFoundError(self.cmd)
+            else:
+                raise CmdError(self.cmd, exc)
+
+        names = {pipe.stdout.fileno(): 'stdout', pipe.stderr.fileno(): 'stderr'}
+        partial = {fd: b'' for fd in names}
+        writefds = []
+        pending_input = self.input
+        if pending_input and not isinstance(pending_input, bytes):
+            pending_input = pending_input.encode('utf-8')
+        if pending_input:
+            writefds.append(pipe.stdin.fileno())
+        else:
+            pipe.stdin.close()
+        start = last_output = time.time()
+        readfds = list(names.keys())
+        try:
+            while readfds:
+                now = time.time()
+                waittime = None
+                if self.timeout is not None:
+                    waittime = start + self.timeout - now
+                    if waittime <= 0:
+                        raise ExecutionTimeout(self.cmd, 'timed out after %d seconds' % self.timeout,
+                                               self.tail_output())
+                if self.idle_timeout is not None:
+                    idlewait = last_output + self.idle_timeout - now
+                    if idlewait <= 0:
+                        raise ExecutionTimeout(self.cmd, 'no output for %d seconds' % self.idle_timeout,
+                                               self.tail_output())
+                    waittime = idlewait if waittime is None else min(waittime, idlewait)
+                try:
+                    rlist, wlist, _ = select.select(readfds, writefds, [], waittime)
+                except select.error as err:
+                    if err.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if wlist:
+                    written = os.write(wlist[0], pending_input[:select.PIPE_BUF])
+                    pending_input = pending_input[written:]
+                    if not pending_input:
+                        writefds = []
+                        pipe.stdin.close()
+                for fd in rlist:
+                    data = os.read(fd, 65536)
+                    if not data:
+                        readfds.remove(fd)
+                        if partial[fd]:
+                            yield self._line(names[fd], partial[fd])
+                            partial[fd] = b''
+                        continue
+                    last_output = time.time()
+                    buf = partial[fd] + data
+                    chunks = buf.split(b'\n')
+                    partial[fd] = chunks.pop()
+                    if len(partial[fd]) > MAX_LINE_LENGTH:
+                        chunks.append(partial[fd])
+                        partial[fd] = b''
+                    for chunk in chunks:
+                        yield self._line(names[fd], chunk + b'\n')
+            # The command can close its output and keep running, so
+            # the overall timeout still applies while waiting for it
+            remaining = None
+            if self.timeout is not None:
+                remaining = max(start + self.timeout - time.time(), 0)
+            try:
+                pipe.wait(timeout=remaining)
+            except subprocess.TimeoutExpired:
+                raise ExecutionTimeout(self.cmd, 'timed out after %d seconds' % self.timeout,
+                                       self.tail_output())
+        except BaseException as err:
+            if pipe.returncode is None:
+                self._kill(pipe)
+            self._record_usage(pipe)
+            if isinstance(err, ExecutionTimeout):
+                err.usage = self.usage
+            raise
+        finally:
+            for f in (pipe.stdin, pipe.stdout, pipe.stderr):
+                if f and not f.closed:
+                    f.close()
+
+        self._record_usage(pipe)
+        if pipe.returncode != 0 and not self.errignore:
+            raise ExecutionError(self.cmd, pipe.returncode, None, self.tail_output(), self.usage)
+
+    def _line(self, name, data):
+        line = data.decode('utf-8', 'replace')
+        self.tail.append(line)
+        return name, line
+
+
+def run_streaming(cmd, callback=None, **kwargs):
+    """
+    Runs a command, passing each line of output to callback(stream-name, line)
+    as it is produced, rather than buffering the output in memory.  Accepts
+    the same keyword arguments as StreamingCommand.  Returns the exit code,
+    raising an exception when the command fails or times out; the resource
+    usage is recorded as for run().
+    """
+    sc = StreamingCommand(cmd, **kwargs)
+    for name, line in sc:
+        if callback is not None:
+            callback(name, line)
+    return sc.returncode
+
+
+class BatchError(CmdError):
+    """
+    Raised by run_parallel when one or more commands in a batch fail.
+    The results attribute holds one entry per command, in input order:
+    the command's result, the exception it raised, or None if it was
+    never started (fail-fast mode).
+    """
+
+    def __init__(self, commands, results):
+        self.results = results
+        self.errors = [r for r in results if isinstance(r, Exception)]
+        CmdError.__init__(self, [c for c, r in zip(commands, results) if isinstance(r, Exception)],
+                          '%d of %d commands failed' % (len(self.errors), len(commands)))
+
+    def __str__(self):
+        return '%s:\n%s' % (self.msg, '\n'.join([str(e) for e in self.errors]))
+
+
+def run_parallel(cmds, jobs=None, fail_fast=False, runner=None, **options):
+    """
+    Runs a batch of independent commands, at most 'jobs' at a time
+    (default: number of CPUs), returning their results in input order.
+    Each command is run with runner(cmd, **options), using run() by default.
+
+    If any command fails, BatchError is raised once the batch completes.
+    With fail_fast, no further commands are started after the first
+    failure, although commands already running are allowed to finish.
+    """
+    if runner is None:
+        runner = run
+    cmds = list(cmds)
+    if jobs is None or jobs < 1:
+        jobs = os.cpu_count() or 1
+    results = [None] * len(cmds)
+    with ThreadPoolExecutor(max_workers=min(jobs, max(len(cmds), 1))) as executor:
+        futures = [executor.submit(runner, cmd, **options) for cmd in cmds]
+        if fail_fast:
+            wait(futures, return_when=FIRST_EXCEPTION)
+            for f in futures:
+                f.cancel()
+        wait(futures)
+    failed = False
+    for i, f in enumerate(futures):
+        if f.cancelled():
+            failed = True
+            continue
+        err = f.exception()
+        if err is not None:
+            results[i] = err
+            failed = True
+        else:
+            results[i] = f.result()
+    if failed:
+        raise BatchError(cmds, results)
+    return results
@@ -0,0 +1,130 @@
+# Copyright (c) 2018 Matthew Madison
+# Distributed under license
+
+"""
+sstate_history
+
+Records the shared-state (setscene) counts reported by bitbake
+for each build in an SQLite database, so the sstate mirror hit
+rate can be tracked over time and sudden drops flagged.  Objects
+found in the local sstate cache are left out of the mirror hit
+rate, so an incremental build (or a well-populated local cache)
+can't hide a mirror that has stopped serving objects.
+"""
+
+import os
+import time
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sstate (
+    id INTEGER PRIMARY KEY,
+    builder TEXT NOT NULL,
+    tag TEXT NOT NULL,
+    machine TEXT NOT NULL,
+    timestamp INTEGER NOT NULL,
+    wanted INTEGER NOT NULL,
+    local INTEGER,
+    mirrors INTEGER,
+    missed INTEGER,
+    current INTEGER,
+    UNIQUE (builder, tag, machine)
+);
+"""
+
+COUNT_NAMES = ['wanted', 'local', 'mirrors', 'missed', 'current']
+
+
+def open_history(dbfile):
+    """
+    Opens (creating, if necessary) an sstate history database.
+    """
+    dbdir = os.path.dirname(dbfile)
+    if dbdir and not os.path.exists(dbdir):
+        os.makedirs(dbdir)
+    db = sqlite3.connect(dbfile)
+    db.executescript(SCHEMA)
+    return db
+
+
+def hit_rate(counts):
+    """
+    Returns the fraction of wanted sstate objects that were found
+    (locally or on a mirror), or None if nothing was wanted.
+    """
+    wanted = counts.get('wanted')
+    if not wanted:
+        return None
+    if counts.get('missed') is not None:
+        return float(wanted - counts['missed']) / wanted
+    found = counts.get('found', (counts.get('local') or 0) + (counts.get('mirrors') or 0))
+    return float(found) / wanted
+
+
+def mirror_hit_rate(counts):
+    """
+    Returns the fraction of the sstate objects not found locally
+    that were found on a mirror, or None if nothing had to come
+    from a mirror.  Older bitbake versions report only a combined
+    'found' count, for which the overall hit rate is returned.
+    """
+    if counts.get('mirrors') is None:
+        return hit_rate(counts)
+    needed = (counts.get('wanted') or 0) - (counts.get('local') or 0)
+    if needed <= 0:
+        return None
+    return float(counts['mirrors']) / needed
+
+
+def record(db, builder, tag, machine, counts, timestamp=None):
+    """
+    Records the counts for one machine of one build, replacing any
+    earlier entry for the same build and machine.
+    """
+    if timestamp is None:
+        timestamp = int(time.time())
+    if counts.get('missed') is None and 'found' in counts:
+        counts = dict(counts, missed=counts['wanted'] - counts['found'])
+    db.execute('INSERT OR REPLACE INTO sstate (builder, tag, machine, timestamp, wanted, local, mirrors, '
+               'missed, current) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+               (builder, tag, machine, timestamp) + tuple([counts.get(n) for n in COUNT_NAMES]))
+    db.commit()
+
+
+def history(db, builder, machine, limit=None):
+    """
+    Returns the recorded counts for a builder and machine, oldest
+    first, as a list of (tag, timestamp, counts) tuples.
+    """
+    query = ('SELECT tag, timestamp, %s FROM sstate WHERE builder = ? AND machine = ? '
+             'ORDER BY timestamp DESC, id DESC' % ', '.join(COUNT_NAMES))
+    params = [builder, machine]
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    result = [(row[0], row[1], dict(zip(COUNT_NAMES, row[2:]))) for row in db.execute(query, params)]
+    result.reverse()
+    return result
+
+
+def check_drop(db, builder, tag, machine, window=5, threshold=0.2):
+    """
+    Compares the mirror hit rate for a build against the median of the
+    previous 'window' builds for the same builder and machine.
+    Returns (rate, baseline, dropped), where dropped is True if
+    the rate fell more than 'threshold' below the baseline.  The
+    baseline is None if there is no earlier history.
+    """
+    entries = history(db, builder, machine)
+    current = [e for e in entries if e[0] == tag]
+    if not current:
+        return None, None, False
+    earlier = [mirror_hit_rate(e[2]) for e in entries if e[0] != tag and e[1] <= current[0][1]]
+    earlier = [r for r in earlier if r is not None][-window:]
+    rate = mirror_hit_rate(current[0][2])
+    if not earlier or rate is None:
+        return rate, None, False
+    earlier.sort()
+    mid = len(earlier) // 2
+    baseline = earlier[mid] if len(earlier) % 2 else (earlier[mid - 1] + earlier[mid]) / 2.0
+    return rate, baseline, baseline - rate > threshold
@@ -12,7 +12,17 @@ setup(
             'update-sstate-mirror = autobuilder.scripts.update_sstate_mirror:main',
             'update-downloads = autobuilder.scripts.update_downloads:main',
             'install-sdk = autobuilder.scripts.install_sdk:main',
-            'autorev-report = autobuilder.scripts.autorev_report:main'
+            'autorev-report = autobuilder.scripts.autorev_report:main',
+            'fast-clean = autobuilder.scripts.fast_clean:main',
+            'publish-artifacts = autobuilder.scripts.publish_artifacts:main',
+            'buildhistory-store = autobuilder.scripts.buildhistory_store:main',
+            'buildstats-report = autobuilder.scripts.buildstats_report:main',
+            'sstate-history = autobuilder.scripts.sstate_history:main',
+            'update-local-cache = autobuilder.scripts.update_local_cache:main',
+            'pr-sstate-mirror = autobuilder.scripts.pr_sstate_mirror:main',
+            'build-avoidance = autobuilder.scripts.build_avoidance:main',
+            'update-git-reference = autobuilder.scripts.update_git_reference:main',
+            'aggregate-artifacts = autobuilder.scripts.aggregate_artifacts:main'
         ]
     },
     include_package_data=True,